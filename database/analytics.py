@@ -0,0 +1,141 @@
+'''
+Vectorized analytics on the columns of the sales, as loaded by columnar.load or read by
+columnar.read_export: the metrics of query_data computed over whole arrays instead of rows.
+
+With NumPy, filtering a period is one boolean mask and a group-by is a stable sort followed by
+numpy.add.reduceat, in exact 64-bit integer arithmetic. Without NumPy the same functions fall back
+to plain loops over the arrays, with the same results.
+
+Unlike the reports, which read the monthly rollups, the periods can start and end on any day. The
+rows are keyed by ids (office_id, agent_id, zip_code): names are looked up by the caller.
+'''
+import bisect
+import itertools
+from datetime import date
+from columnar import array_of, numpy
+import commissions
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def select_period(columns, period):
+    '''
+    Returns the columns restricted to the sales of a period.
+    '''
+    start, end = period.start.toordinal() - _EPOCH, period.end.toordinal() - _EPOCH
+    sell_day = columns['sell_day']
+    if numpy is not None:
+        mask = (sell_day >= start) & (sell_day < end)
+        return {name: values[mask] for name, values in columns.items()}
+    mask = [start <= day < end for day in sell_day]
+    return {name: array_of(itertools.compress(values, mask)) for name, values in columns.items()}
+
+
+def group_sum(keys, values):
+    '''
+    Returns the (key, count, sum of values) of every distinct key, by key.
+    '''
+    if numpy is not None:
+        if not len(keys):
+            return []
+        order = numpy.argsort(keys, kind='stable')
+        unique, starts, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+        sums = numpy.add.reduceat(values[order], starts)
+        return list(zip(unique.tolist(), counts.tolist(), sums.tolist()))
+    groups = {}
+    for key, value in zip(keys, values):
+        count, total = groups.get(key, (0, 0))
+        groups[key] = (count + 1, total + value)
+    return [(key, count, total) for key, (count, total) in sorted(groups.items())]
+
+
+def _total(values):
+    return int(values.sum()) if numpy is not None else sum(values)
+
+
+def _top(groups, limit):
+    ranked = sorted(groups, key=lambda group: group[1], reverse=True)
+    return ranked if limit is None else ranked[:limit]
+
+
+def office_totals(columns, period, limit=None):
+    '''
+    Returns the (office_id, total sale price) of the offices, the highest first.
+    '''
+    sales = select_period(columns, period)
+    return _top([(office, total) for office, _, total in group_sum(sales['office_id'], sales['sale_price'])], limit)
+
+
+def agent_totals(columns, period, limit=None):
+    '''
+    Returns the (agent_id, total sale price) of the agents, the highest first.
+    '''
+    sales = select_period(columns, period)
+    return _top([(agent, total) for agent, _, total in group_sum(sales['agent_id'], sales['sale_price'])], limit)
+
+
+def agent_commissions(columns, period):
+    '''
+    Returns the (agent_id, total commission) of the agents, by agent id.
+    '''
+    sales = select_period(columns, period)
+    return [(agent, total) for agent, _, total in group_sum(sales['agent_id'], sales['agent_commissions'])]
+
+
+def avg_days_on_market(columns, period):
+    '''
+    Returns the average number of days the houses sold in the period were on the market, or None. The
+    sales whose days are unknown (-1) are left out of the average.
+    '''
+    days = select_period(columns, period)['days_on_market']
+    if numpy is not None:
+        days = days[days >= 0]
+    else:
+        days = [value for value in days if value >= 0]
+    return _total(days) / len(days) if len(days) else None
+
+
+def avg_sale_price(columns, period):
+    '''
+    Returns the average selling price of the houses sold in the period, in cents, or None.
+    '''
+    sales = select_period(columns, period)
+    return _total(sales['sale_price']) / len(sales['sale_id']) if len(sales['sale_id']) else None
+
+
+def zip_averages(columns, period, limit=None):
+    '''
+    Returns the (zip_code, average sale price) of the zip codes, the highest first.
+    '''
+    sales = select_period(columns, period)
+    return _top([(zip_code, total / count) for zip_code, count, total in group_sum(sales['zip_code'], sales['sale_price'])],
+                limit)
+
+
+def commissions_for(prices, tiers):
+    '''
+    Returns the commission of every price, as commissions.commission_for computes it for one price.
+    '''
+    min_prices = [min_price for min_price, _ in tiers]
+    if numpy is not None:
+        rates = numpy.array([0] + [rate for _, rate in tiers], dtype=numpy.int64)
+        return (prices * rates[numpy.searchsorted(min_prices, prices, side='right')] + 5000) // 10000
+    return array_of(commissions.commission_for(price, tiers) for price in prices)
+
+
+def commission_tiers(columns, tiers, period=None):
+    '''
+    Returns the (min_price, rate, sale count, total commission) of every commission tier, the commissions
+    being computed from the tiers rather than read from the stored ones, e.g. to preview new tiers.
+    '''
+    sales = columns if period is None else select_period(columns, period)
+    prices = sales['sale_price']
+    min_prices = [min_price for min_price, _ in tiers]
+    if numpy is not None:
+        positions = numpy.searchsorted(min_prices, prices, side='right')
+    else:
+        positions = array_of(bisect.bisect_right(min_prices, price) for price in prices)
+    by_tier = {position: (count, total) for position, count, total in
+               group_sum(positions, commissions_for(prices, tiers))}
+    return [(min_price, rate) + by_tier.get(position, (0, 0)) for position, (min_price, rate) in enumerate(tiers, start=1)]
+
@@ -0,0 +1,113 @@
+'''
+Async variants of the sale ingestion and of the reports, for callers running in an event loop:
+
+    engine = db.make_async_engine()
+    Session = async_api.sessionmaker(engine)
+    async with Session() as session:
+        rows = await async_api.top_offices(session, Period.month(2023, 1))
+
+The coroutines run the code of insert_data, commissions and reports with AsyncSession.run_sync: the
+statements are the same, and so are the validation, the report cache and the instrumentation labels,
+but every database call awaits the driver (aiosqlite for SQLite, which runs each connection in its
+own thread) instead of blocking the event loop.
+
+An AsyncSession must not be shared by concurrent tasks: run_reports gives every report its own
+session, so the reports of a request run concurrently on as many pooled connections, up to the
+pool_size and max_overflow settings of the engine.
+'''
+import asyncio
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from period import Period
+import commissions
+import insert_data
+import reports
+
+
+def sessionmaker(bind):
+    '''
+    Returns the AsyncSession factory of an AsyncEngine. The objects stay loaded after a commit, as they
+    cannot be refreshed lazily from async code.
+    '''
+    return async_sessionmaker(bind, expire_on_commit=False)
+
+
+async def ingest_sales(session, sales, chunk_size=500):
+    '''
+    Records a batch of sales, as insert_data.ingest_sales does, and returns the same (inserted, failures).
+    '''
+    return await session.run_sync(lambda sync_session: insert_data.ingest_sales(sales, chunk_size, sync_session))
+
+
+async def update_sales_info(session, sale):
+    '''
+    Records one sale, as insert_data.update_sales_info does, raising a ValueError if it is rejected.
+    '''
+    _, failures = await ingest_sales(session, [sale], chunk_size=1)
+    if failures:
+        raise ValueError(failures[0][2])
+
+
+async def run_commission_job(session):
+    '''
+    Runs commissions.run_commission_job and returns the (year, month) periods it updated.
+    '''
+    return await session.run_sync(commissions.run_commission_job)
+
+
+async def top_offices(session, period, limit=5):
+    return await session.run_sync(reports.top_offices, period, limit)
+
+
+async def top_agents(session, period, limit=5):
+    return await session.run_sync(reports.top_agents, period, limit)
+
+
+async def agent_commissions(session, period):
+    return await session.run_sync(reports.agent_commissions, period)
+
+
+async def avg_days_on_market(session, period):
+    return await session.run_sync(reports.avg_days_on_market, period)
+
+
+async def avg_sale_price(session, period):
+    return await session.run_sync(reports.avg_sale_price, period)
+
+
+async def top_zip_codes(session, period, limit=5):
+    return await session.run_sync(reports.top_zip_codes, period, limit)
+
+
+async def run_reports(sessions, year=2023, month=1):
+    '''
+    Runs the commission job, then every report of query_data.run_reports concurrently, each in its own
+    session.
+
+    Args:
+        sessions (async_sessionmaker): The session factory, see sessionmaker().
+        year (int): The year of the reports.
+        month (int): The month of the reports.
+
+    Returns:
+        dict: The rows of each report by report name, as query_data.run_reports returns them.
+    '''
+    month_period, year_period = Period.month(year, month), Period.year(year)
+    async with sessions() as session:
+        await run_commission_job(session)
+
+    async def run(report, *args):
+        async with sessions() as session:
+            return await report(session, *args)
+
+    names = ['top offices', 'top agents of the month', 'top agents of the year', 'agent commissions',
+             'average days on the market', 'average selling price', 'top zip codes']
+    results = await asyncio.gather(
+        run(top_offices, month_period, 5),
+        run(top_agents, month_period, 5),
+        run(top_agents, year_period, 5),
+        run(agent_commissions, month_period),
+        run(avg_days_on_market, month_period),
+        run(avg_sale_price, month_period),
+        run(top_zip_codes, month_period, 5),
+    )
+    return dict(zip(names, results))
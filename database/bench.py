@@ -0,0 +1,365 @@
+'''
+Benchmarks of the database application, run from the database folder:
+
+    python3 bench.py startup [--runs N]    time importing the models, in fresh interpreters
+    python3 bench.py suite [--scales 1000 10000] [--runs N] [--output FILE] [--baseline FILE] [--threshold 0.2]
+                                           time the ingestion and the reports on generated datasets
+    python3 bench.py concurrency [--scale N] [--requests N] [--concurrency N]
+                                           compare the request throughput of the sync and async reports
+
+The suite prints its results as JSON (or writes them to --output). With --baseline, the results are
+compared with a previous output of the suite, and the command exits with status 1 if a measure got
+worse by more than the threshold, so a change can be checked against the baseline of the main branch:
+
+    python3 bench.py suite --output baseline.json         on the main branch
+    python3 bench.py suite --baseline baseline.json       on the branch of the change
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_IMPORT_PROBE = '''
+import json, time
+start = time.perf_counter()
+import sqlalchemy.orm
+middle = time.perf_counter()
+import create
+end = time.perf_counter()
+print(json.dumps({"sqlalchemy": middle - start, "models": end - middle,
+                  "connections": create.engine.pool.checkedout() + create.engine.pool.checkedin()}))
+'''
+
+
+def startup(runs=10):
+    '''
+    Times importing the models module (create) in fresh interpreters started from an empty folder,
+    and checks that the import neither opens a connection nor creates files. The import of SQLAlchemy
+    itself is timed apart, as it is paid by any process using the database.
+
+    Args:
+        runs (int): The number of interpreters to start.
+
+    Returns:
+        dict: The median and max import times in milliseconds, and whether any run did I/O.
+    '''
+    timings = []
+    sqlalchemy_timings = []
+    did_io = False
+    environment = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as folder:
+            output = subprocess.run([sys.executable, '-c', _IMPORT_PROBE], cwd=folder, env=environment,
+                                    capture_output=True, text=True, check=True).stdout
+            probe = json.loads(output.strip().splitlines()[-1])
+            timings.append(probe['models'] * 1000)
+            sqlalchemy_timings.append(probe['sqlalchemy'] * 1000)
+            did_io = did_io or probe['connections'] > 0 or bool(os.listdir(folder))
+    return {'runs': runs, 'median_ms': statistics.median(timings), 'max_ms': max(timings),
+            'sqlalchemy_median_ms': statistics.median(sqlalchemy_timings), 'did_io': did_io}
+
+
+# the reports of query_data, timed for one month of the generated data
+REPORTS = ['top_offices', 'top_agents', 'agent_commissions', 'avg_days_on_market', 'avg_sale_price', 'top_zip_codes']
+REPORT_MONTH = (2022, 5)
+
+
+def _percentiles(timings):
+    timings = sorted(timings)
+    # nearest rank, so that p99 is an actual timing even with few runs
+    rank = lambda percent: timings[max(0, -(-len(timings) * percent // 100) - 1)]
+    return {'p50_ms': rank(50) * 1000, 'p99_ms': rank(99) * 1000}
+
+
+def ingestion(bind, sales=1000, chunk_size=500, single=100):
+    '''
+    Times recording sales on a database: in chunks, as ingest_sales does by default, and one sale per
+    transaction, as update_sales_info does. The houses sold are added first, with an available listing.
+
+    Args:
+        bind (Engine): The engine of a database with at least one customer, agent and office.
+        sales (int): The number of sales recorded in chunks.
+        chunk_size (int): The number of sales per chunk.
+        single (int): The number of sales recorded one per transaction.
+
+    Returns:
+        dict: The sales per second of both ways.
+    '''
+    from sqlalchemy import func, insert, select
+    from sqlalchemy.orm import Session
+    from create import House, Listing
+    import insert_data
+
+    with bind.begin() as connection:
+        first = (connection.execute(select(func.max(House.id))).scalar() or 0) + 1
+        house_ids = range(first, first + sales + single)
+        connection.execute(insert(House.__table__), [
+            {'id': house_id, 'no_of_bedrooms': 3, 'no_of_bathrooms': 2, 'address': f'{house_id} Bench Street, CA',
+             'zip_code': 94111, 'office': 1} for house_id in house_ids])
+        connection.execute(insert(Listing.__table__), [
+            {'house_id': house_id, 'seller_id': 1, 'listing_date': datetime(2022, 4, 1), 'listing_agent_id': 1,
+             'listing_office_id': 1, 'listing_price': 90000000, 'listing_state': 'AVAILABLE'} for house_id in house_ids])
+    records = [{'buyer_id': 1, 'sale_price': 90000000, 'sell_date': date(2022, 5, 1 + index % 28), 'agent_id': 1,
+                'house_id': house_id} for index, house_id in enumerate(house_ids)]
+
+    result = {}
+    for name, batch, size in [('chunked', records[:sales], chunk_size), ('single', records[sales:], 1)]:
+        start = time.perf_counter()
+        inserted, failures = insert_data.ingest_sales(batch, chunk_size=size, session=Session(bind))
+        elapsed = time.perf_counter() - start
+        if failures:
+            raise RuntimeError(f'{len(failures)} sales were rejected by the benchmark: {failures[0][2]}')
+        result[f'{name}_rows_per_s'] = inserted / elapsed
+    return result
+
+
+def report_latencies(bind, runs=50):
+    '''
+    Times every report for REPORT_MONTH, in three states:
+    cold: a new engine, so new connections with an empty page cache, and an empty result cache;
+    query: an open connection, but an empty result cache, so what the SQL costs;
+    warm: the result is cached.
+
+    Returns:
+        dict: The p50 and p99 latencies of each state, by report name.
+    '''
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from period import Period
+    import report_cache
+    import reports
+
+    period = Period.month(*REPORT_MONTH)
+    result = {}
+    for name in REPORTS:
+        report = getattr(reports, name)
+        timings = {'cold': [], 'query': [], 'warm': []}
+        for _ in range(runs):
+            cold = create_engine(bind.url)
+            with Session(cold) as session:
+                start = time.perf_counter()
+                report(session, period)
+                timings['cold'].append(time.perf_counter() - start)
+            cold.dispose()
+        with Session(bind) as session:
+            for _ in range(runs):
+                report_cache.clear(bind)
+                start = time.perf_counter()
+                report(session, period)
+                timings['query'].append(time.perf_counter() - start)
+            for _ in range(runs):
+                start = time.perf_counter()
+                report(session, period)
+                timings['warm'].append(time.perf_counter() - start)
+        result[name] = {state: _percentiles(values) for state, values in timings.items()}
+    return result
+
+
+def suite(scales=(1000, 10000), runs=50, startup_runs=5, seed=0, folder=None):
+    '''
+    Generates a dataset for each scale, then times the reports and the ingestion on it, and the
+    import of the models.
+
+    Args:
+        scales (List[int]): The numbers of sales of the datasets.
+        runs (int): The number of times each report is run in each state.
+        startup_runs (int): The number of interpreters started to time the import, 0 to skip it.
+        seed (int): The seed of the generated data.
+        folder (str): Where the datasets are written, defaults to a temporary folder.
+
+    Returns:
+        dict: The results, in the format read by compare().
+    '''
+    from db import make_engine
+    from generate import generate
+    import commissions
+    from sqlalchemy.orm import Session
+
+    result = {'scales': {}}
+    with tempfile.TemporaryDirectory(dir=folder) as folder:
+        for scale in scales:
+            bind = make_engine(f"sqlite:///{os.path.join(folder, f'bench{scale}.db')}")
+            generate(bind, scale=scale, seed=seed)
+            with Session(bind) as session:
+                commissions.run_commission_job(session)
+            # the reports first, as the ingestion adds sales to the month they read
+            result['scales'][str(scale)] = {'reports': report_latencies(bind, runs),
+                                            'ingestion': ingestion(bind, sales=min(scale, 1000))}
+            bind.dispose()
+    if startup_runs:
+        result['startup'] = startup(startup_runs)
+    return result
+
+
+def concurrency(scale=10000, requests=200, concurrency=16, seed=0, folder=None):
+    '''
+    Compares the sync reports, called from an event loop as an async API would call them, with the
+    coroutines of async_api, under concurrent requests. A request runs the six reports for one month,
+    the months going round the dataset, and the result cache is off so that every report queries.
+    A ticker task measures how long the event loop is blocked.
+
+    Args:
+        scale (int): The number of sales of the generated dataset.
+        requests (int): The number of requests.
+        concurrency (int): The number of requests in flight at a time, for the async reports.
+
+    Returns:
+        dict: The requests per second and the longest event loop stall in ms, of both ways.
+    '''
+    from sqlalchemy.orm import Session
+    from db import make_async_engine, make_engine
+    from generate import FIRST_DAY, LAST_DAY, generate
+    from period import Period
+    import async_api
+    import report_cache
+    import reports
+
+    months = [Period.month(year, month) for year in range(FIRST_DAY.year, LAST_DAY.year + 1) for month in range(1, 13)]
+    names = ['top_offices', 'top_agents', 'agent_commissions', 'avg_days_on_market', 'avg_sale_price', 'top_zip_codes']
+    report_cache.configure(max_entries=0)
+
+    async def measure(requests_done):
+        stall = 0.0
+
+        async def ticker():
+            nonlocal stall
+            while True:
+                before = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stall = max(stall, time.perf_counter() - before - 0.001)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await requests_done()
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.01)  # lets the ticker see a stall that lasted until the end
+        task.cancel()
+        return requests / elapsed, stall * 1000
+
+    result = {'scale': scale, 'requests': requests, 'concurrency': concurrency}
+    with tempfile.TemporaryDirectory(dir=folder) as folder:
+        url = f"sqlite:///{os.path.join(folder, 'concurrency.db')}"
+        bind = make_engine(url)
+        generate(bind, scale=scale, seed=seed)
+
+        async def sync_requests():
+            with Session(bind) as session:
+                for index in range(requests):
+                    for name in names:
+                        getattr(reports, name)(session, months[index % len(months)])
+                    session.rollback()
+
+        result['sync_requests_per_s'], result['sync_max_stall_ms'] = asyncio.run(measure(sync_requests))
+        bind.dispose()
+
+        async def async_requests():
+            async_engine = make_async_engine(url)
+            sessions = async_api.sessionmaker(async_engine)
+            slots = asyncio.Semaphore(concurrency)
+
+            async def request(index):
+                async with slots:
+                    async def report(name):
+                        async with sessions() as session:
+                            await getattr(async_api, name)(session, months[index % len(months)])
+                    await asyncio.gather(*[report(name) for name in names])
+
+            await asyncio.gather(*[request(index) for index in range(requests)])
+            await async_engine.dispose()
+
+        result['async_requests_per_s'], result['async_max_stall_ms'] = asyncio.run(measure(async_requests))
+    report_cache.configure()
+    return result
+
+
+def _measures(result, prefix=''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from _measures(value, f'{prefix}{key}.')
+        elif key.endswith('_ms') or key.endswith('_per_s'):
+            yield prefix + key, value
+
+
+def compare(result, baseline, threshold=0.2, min_ms=0.05):
+    '''
+    Compares the results of the suite with a baseline, measure by measure.
+
+    Args:
+        result (dict): The results, as returned by suite().
+        baseline (dict): The results of an earlier run.
+        threshold (float): The relative change above which a measure regressed, 0.2 for 20%.
+        min_ms (float): Latencies changing by less than this many milliseconds never regress, as they are noise.
+
+    Returns:
+        List[str]: A description of every regression, empty if there are none.
+    '''
+    baseline = dict(_measures(baseline))
+    regressions = []
+    for name, value in _measures(result):
+        before = baseline.get(name)
+        if not before:
+            continue
+        if name.endswith('_per_s'):
+            worse = value < before * (1 - threshold)
+        else:
+            worse = value > before * (1 + threshold) and value - before > min_ms
+        if worse:
+            regressions.append(f'{name}: {before:.3f} -> {value:.3f} ({(value - before) / before:+.0%})')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the database application')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('startup', help='time importing the models')
+    command.add_argument('--runs', type=int, default=10)
+    command = commands.add_parser('suite', help='time the ingestion and the reports on generated datasets')
+    command.add_argument('--scales', type=int, nargs='+', default=[1000, 10000], help='the numbers of sales')
+    command.add_argument('--runs', type=int, default=50, help='the number of runs of each report')
+    command.add_argument('--startup-runs', type=int, default=5)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--output', help='the file the JSON results are written to, instead of printing them')
+    command.add_argument('--baseline', help='the JSON results to compare with')
+    command.add_argument('--threshold', type=float, default=0.2, help='the relative slowdown counted as a regression')
+    command = commands.add_parser('concurrency', help='compare the throughput of the sync and async reports')
+    command.add_argument('--scale', type=int, default=10000, help='the number of sales')
+    command.add_argument('--requests', type=int, default=200)
+    command.add_argument('--concurrency', type=int, default=16, help='the number of async requests in flight')
+    args = parser.parse_args(argv)
+
+    if args.command == 'concurrency':
+        print(json.dumps(concurrency(args.scale, args.requests, args.concurrency), indent=2))
+
+    if args.command == 'suite':
+        result = suite(args.scales, args.runs, args.startup_runs, args.seed)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(result, file, indent=2)
+        else:
+            print(json.dumps(result, indent=2))
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = compare(result, json.load(file), args.threshold)
+            for regression in regressions:
+                print('Regression:', regression, file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+
+    if args.command == 'startup':
+        result = startup(args.runs)
+        print(f"import create: median {result['median_ms']:.1f} ms, max {result['max_ms']:.1f} ms "
+              f"over {result['runs']} runs (plus {result['sqlalchemy_median_ms']:.1f} ms for sqlalchemy), "
+              f"I/O: {'yes' if result['did_io'] else 'none'}")
+
+
+if __name__ == '__main__':
+    main()
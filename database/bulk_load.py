@@ -0,0 +1,238 @@
+'''
+Bulk loader of the houses, listings and sales of an office joining the head office, from CSV files
+(with a header line) or JSON lines files, e.g. written by another system or by `cli.py export`:
+
+    python3 cli.py bulk-load --houses houses.csv --listings listings.jsonl --sales sales.csv --defer-indexes
+
+Every file is read in chunks of chunk_size rows, and each chunk is inserted with one executemany in
+a transaction of its own, so the memory used does not depend on the size of the files. The rows
+reference the dimensions by their natural keys, which are resolved through maps held in memory,
+read once at the start (and completed with the houses the load inserts):
+
+    houses      office_name
+    listings    house_address, seller_email, listing_agent_email, listing_office_name
+    sales       house_address, buyer_email, agent_email
+
+The *_id columns can be given instead, and the ids of the houses and listings are kept if given (the
+sales always get new ones). A row whose references do not resolve, or whose values are
+missing or malformed, is rejected with its line number, and the others are loaded. A sale is
+rejected like by the ingestion if its house has no listing on or before the sell date, or an
+UNAVAILABLE one.
+
+Each chunk of sales goes through the same steps as a chunk of the ingestion, in its own transaction:
+the listing sold by each sale is resolved and validated by insert_data._resolve_sale, from the
+listings held in memory, and the inserted sales are recorded by insert_data._record_sales, which
+flips their listings to SOLD, increments the rollups with one statement per rollup table and range
+of ids and the sale price summary by the total of the chunk, and appends the changes to the change
+feed. A load that stops halfway leaves the chunks it committed complete, and the commission job never
+sees a sale before its rollups.
+
+With defer_indexes, the secondary indexes of the three tables are dropped before the load and
+created again once at the end, instead of being updated row by row. The leaderboard is reconciled
+at the end.
+'''
+import csv
+import json
+import time
+from datetime import date, datetime
+from itertools import islice
+import sqlalchemy
+from sqlalchemy import Date, DateTime, Integer, func, insert, select
+from sqlalchemy.orm import Session
+from create import Agent, Customer, House, Listing, Office, Sale, create_indexes
+from db import engine
+import commissions
+import dimensions
+import insert_data
+import leaderboard
+import partitions
+import report_cache
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# the columns given by a natural key, by table: (column of the file, column of the table, dimension map)
+REFERENCES = {
+    'houses': [('office_name', 'office', 'offices')],
+    'listings': [('house_address', 'house_id', 'houses'), ('seller_email', 'seller_id', 'customers'),
+                 ('listing_agent_email', 'listing_agent_id', 'agents'), ('listing_office_name', 'listing_office_id', 'offices')],
+    'sales': [('house_address', 'house_id', 'houses'), ('buyer_email', 'buyer_id', 'customers'),
+              ('agent_email', 'agent_id', 'agents')],
+}
+MODELS = {'houses': House, 'listings': Listing, 'sales': Sale}
+# the columns of a table the files cannot set, resolved by the loader
+_COMPUTED = {'sales': {'listing_id', 'agent_commissions', 'days_on_market'}}
+
+
+def read_rows(path):
+    '''
+    Yields the (line number, record) of every row of a CSV or JSON lines file, by its extension. The
+    empty CSV fields are None.
+    '''
+    with open(path, newline='') as file:
+        if path.endswith('.jsonl'):
+            for number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield number, json.loads(line)
+        else:
+            for number, record in enumerate(csv.DictReader(file), start=2):
+                yield number, {key: value if value != '' else None for key, value in record.items()}
+
+
+def _converter(column):
+    if isinstance(column.type, DateTime):
+        return lambda value: value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return lambda value: value if isinstance(value, date) else date.fromisoformat(value[:10])
+    if isinstance(column.type, Integer):
+        return int
+    return str
+
+
+def _maps(session):
+    '''
+    Returns the maps from the natural keys of the dimensions to their ids.
+    '''
+    return {
+        'offices': dict(session.execute(select(Office.office_name, Office.id)).all()),
+        'agents': dict(session.execute(select(Agent.emailAddress, Agent.id)).all()),
+        'customers': dict(session.execute(select(Customer.emailAddress, Customer.id)).all()),
+        'houses': dict(session.execute(select(House.address, House.id)).all()),
+    }
+
+
+class _Loader:
+    '''
+    The state of one bulk load: the dimension maps, the listings by house, the commission tiers and the counters.
+    '''
+
+    def __init__(self, session, chunk_size, progress):
+        # the (name, converter, required) of the columns the files can set, by table
+        self.columns = {table: [(column.name, _converter(column), not column.nullable and column.default is None)
+                                for column in model.__table__.columns
+                                if not column.primary_key and column.name not in _COMPUTED.get(table, ())]
+                        for table, model in MODELS.items()}
+        self.session = session
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.maps = _maps(session)
+        self.listings = None  # the listings of every house, read when the sales start
+        self.tiers = commissions.load_tiers(session)
+        self.archived = set(partitions.archived_years(session))
+        self.loaded = {}
+        self.rejected = []
+
+    def _row(self, table, record):
+        row = {}
+        for field, column, dimension in REFERENCES[table]:
+            value = record.get(field)
+            if value is not None:
+                if value not in self.maps[dimension]:
+                    raise ValueError(f"Unknown {field} {value!r}.")
+                row[column] = self.maps[dimension][value]
+        if record.get('id') is not None and table != 'sales':  # the new sales are the ids above the existing ones
+            row['id'] = int(record['id'])
+        for name, convert, required in self.columns[table]:
+            value = row[name] if name in row else record.get(name)
+            if value is None:
+                if required:
+                    raise ValueError(f"The {name} is missing.")
+                continue
+            row[name] = convert(value)
+        if table == 'sales':
+            row, _ = insert_data._resolve_sale(row, self.listings, self.tiers, self.archived)
+        return row
+
+    def load(self, table, path):
+        model, started, count = MODELS[table], time.perf_counter(), 0
+        if table == 'sales' and self.listings is None:
+            self.listings = {}
+            for listing in self.session.execute(select(Listing.id, Listing.house_id, Listing.listing_date,
+                                                       Listing.listing_state).order_by(Listing.id)):
+                self.listings.setdefault(listing.house_id, []).append(listing)
+            self.session.commit()
+        records = read_rows(path)
+        while chunk := list(islice(records, self.chunk_size)):
+            rows = []
+            for number, record in chunk:
+                try:
+                    rows.append(self._row(table, record))
+                except (ValueError, TypeError, KeyError) as e:
+                    self.rejected.append((table, number, str(e)))
+            if rows:
+                if table == 'houses':
+                    last_id = self.session.execute(select(func.coalesce(func.max(House.id), 0))).scalar_one()
+                # Core executemany, one per set of columns, skips the bookkeeping of the ORM bulk insert
+                by_columns, sale_ids = {}, []
+                for row in rows:
+                    by_columns.setdefault(tuple(row), []).append(row)
+                for group in by_columns.values():
+                    if table == 'sales':
+                        sale_ids += self.session.execute(insert(Sale.__table__).returning(Sale.__table__.c.id),
+                                                         group).scalars().all()
+                    else:
+                        self.session.execute(insert(model.__table__), group)
+                if table == 'houses':
+                    self.maps['houses'].update(self.session.execute(
+                        select(House.address, House.id).where(House.id > last_id)).all())
+                if table == 'sales':
+                    insert_data._record_sales(self.session, sale_ids, [row for group in by_columns.values() for row in group])
+                self.session.commit()
+                if table == 'sales':
+                    report_cache.invalidate(self.session.get_bind(), {row['sell_date'] for row in rows})
+            count += len(rows)
+            self.loaded[table] = count
+            if self.progress is not None:
+                self.progress(table, count, count / (time.perf_counter() - started))
+
+
+def _secondary_indexes(bind):
+    indexes = []
+    with bind.connect() as connection:
+        for model in MODELS.values():
+            existing = {index['name'] for index in sqlalchemy.inspect(connection).get_indexes(model.__tablename__)}
+            indexes += [index for index in model.__table__.indexes if index.name in existing]
+    return indexes
+
+
+def load(bind=engine, houses=None, listings=None, sales=None, chunk_size=DEFAULT_CHUNK_SIZE, defer_indexes=False,
+         progress=None):
+    '''
+    Loads files of houses, listings and sales, in that order, into a database.
+
+    Args:
+        bind (Engine): The engine of the database.
+        houses (str): The path of the houses file, if any.
+        listings (str): The path of the listings file, if any.
+        sales (str): The path of the sales file, if any.
+        chunk_size (int): The number of rows inserted per executemany and per transaction.
+        defer_indexes (bool): Whether to drop the secondary indexes during the load and create them at the end.
+        progress (callable): Called after each chunk with the table name, the number of rows loaded and
+            the rows per second so far.
+
+    Returns:
+        dict: The number of rows loaded by table name, the overall 'rows_per_s', and the 'rejected'
+        (table name, line number, reason) tuples.
+    '''
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    started = time.perf_counter()
+    dropped = _secondary_indexes(bind) if defer_indexes else []
+    with bind.begin() as connection:
+        for index in dropped:
+            index.drop(bind=connection)
+    session, loader = Session(bind), None
+    try:
+        loader = _Loader(session, chunk_size, progress)
+        for table, path in [('houses', houses), ('listings', listings), ('sales', sales)]:
+            if path is not None:
+                loader.load(table, path)
+    finally:
+        session.rollback()
+        if dropped:
+            create_indexes(bind)
+        if loader is not None and loader.loaded.get('sales'):
+            leaderboard.reconcile(bind)
+        dimensions.clear(bind)
+        session.close()
+    rows = sum(loader.loaded.values())
+    return dict(loader.loaded, rows_per_s=rows / (time.perf_counter() - started), rejected=loader.rejected)
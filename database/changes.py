@@ -0,0 +1,91 @@
+'''
+Append-only change feed of the sales, for the downstream consumers (BI, payroll) that used to poll
+the sales and the sale price summary and diff them with their own copy.
+
+The sale ingestion of insert_data appends to sale_changes, in the transaction that writes the sales:
+
+    SALE_INSERTED   sale_id, listing_id, amount (the sale price)
+    LISTING_STATE   listing_id, listing_state (SOLD)
+    SUMMARY_DELTA   slot, amount (added to the SalePriceSummary row, whose id is slot)
+
+so a committed change is in the feed, and a rolled back one is not. Each change has a sequence
+number; a consumer keeps the last one it processed and asks for the changes after it, which reads a
+range of the primary key: the work is proportional to the number of new changes, not to the size of
+the tables. With SQLite the writers are serialized, so the sequence numbers increase in the order of
+the commits and a consumer never skips a change that commits late. The rows written without the
+ingestion (generate, a manual UPDATE) are not in the feed.
+'''
+from sqlalchemy import delete, func, insert, literal, select
+from create import Listing, Sale, SaleChange
+from summary import SUMMARY_ID
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def record_sales(session, sale_ids, amount):
+    '''
+    Appends the changes of a batch of ingested sales to the feed, in the transaction of the session:
+    the sales, their listings flipped to SOLD, and the increment of the sale price summary.
+
+    Args:
+        session (Session): The session that wrote the sales.
+        sale_ids (List[int]): The ids of the sales, or a Select of them.
+        amount (int): The amount added to the sale price summary, in cents.
+    '''
+    session.execute(insert(SaleChange).from_select(
+        ['kind', 'sale_id', 'listing_id', 'amount'],
+        select(literal('SALE_INSERTED'), Sale.id, Sale.listing_id, Sale.sale_price).where(
+            Sale.id.in_(sale_ids)).order_by(Sale.id)))
+    session.execute(insert(SaleChange).from_select(
+        ['kind', 'listing_id', 'listing_state'],
+        select(literal('LISTING_STATE'), Listing.id, Listing.listing_state).where(
+            Listing.id.in_(select(Sale.listing_id).where(Sale.id.in_(sale_ids)))).order_by(Listing.id)))
+    if amount:
+        session.execute(insert(SaleChange).values(kind='SUMMARY_DELTA', slot=SUMMARY_ID, amount=amount))
+
+
+def read_changes(session, after_seq=0, limit=DEFAULT_BATCH_SIZE):
+    '''
+    Returns the changes after a sequence number, oldest first.
+
+    Args:
+        session (Session): The session used to read the feed.
+        after_seq (int): The sequence number of the last change the consumer processed, 0 for all.
+        limit (int): The largest number of changes to return.
+
+    Returns:
+        List[Row]: The (seq, kind, sale_id, listing_id, listing_state, slot, amount) rows of the changes.
+    '''
+    return session.execute(
+        select(SaleChange.seq, SaleChange.kind, SaleChange.sale_id, SaleChange.listing_id, SaleChange.listing_state,
+               SaleChange.slot, SaleChange.amount).where(SaleChange.seq > after_seq).order_by(SaleChange.seq).limit(
+            limit)).all()
+
+
+def follow(session, after_seq=0, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Yields the batches of changes after a sequence number until the end of the feed, for a consumer
+    catching up. The consumer stores the seq of the last change of a batch once it is processed.
+    '''
+    while batch := read_changes(session, after_seq, batch_size):
+        yield batch
+        after_seq = batch[-1].seq
+        if len(batch) < batch_size:
+            return
+
+
+def last_seq(session):
+    '''
+    Returns the sequence number of the latest change, 0 if the feed is empty.
+    '''
+    return session.execute(select(func.coalesce(func.max(SaleChange.seq), 0))).scalar_one()
+
+
+def trim(session, up_to_seq):
+    '''
+    Deletes the changes up to a sequence number, once every consumer has processed them, and returns
+    the number of changes deleted.
+    '''
+    deleted = session.execute(delete(SaleChange).where(SaleChange.seq <= up_to_seq)).rowcount
+    session.commit()
+    return deleted
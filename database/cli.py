@@ -0,0 +1,203 @@
+'''
+Command line entry points of the database application, run from the database folder:
+
+    python3 cli.py init-schema [--reset]    create the missing tables, columns and indexes (--reset: drop everything first)
+    python3 cli.py seed                     insert the sample data into an empty database
+    python3 cli.py reports [--year Y] [--month M] [--explain]
+    python3 cli.py backfill-rollups         resolve the listings of the older sales, then rebuild the monthly
+                                            sales rollups from the sales
+    python3 cli.py recompute-commissions    recompute the stored commissions after the tiers changed
+    python3 cli.py commission-job           update AgentCommission with the sales recorded since the last run
+    python3 cli.py generate [--scale N] [--seed S] [--workers W]
+                                            fill an empty database with N synthetic sales and what they need
+    python3 cli.py run-reports --start YYYY-MM --end YYYY-MM [--granularity month|quarter|year] [--workers W]
+                               [--threads] --output FILE
+                                            run every report for every period, and office, in parallel, resuming
+                                            a failed run
+    python3 cli.py export TABLE [--format csv|jsonl] [--columns a,b] [--output FILE]
+                                            write a table to CSV or JSON lines, streamed in primary key order
+    python3 cli.py archive --year Y [--folder F] [--no-compact]
+                                            move the sales of a closed year into an archive file
+    python3 cli.py bulk-load [--houses FILE] [--listings FILE] [--sales FILE] [--defer-indexes]
+                                            load CSV or JSON lines files of houses, listings and sales
+    python3 cli.py all                      init-schema --reset, seed and reports, like the three scripts in a row
+
+The modules are only imported by the command that needs them.
+'''
+import argparse
+import os
+
+
+def init_schema(args):
+    from create import init_schema
+    for name in init_schema(reset=args.reset):
+        print('Created', name)
+
+
+def seed(args):
+    from insert_data import seed, session
+    for position, sale, reason in seed(session):
+        print(f'Sale {position} was rejected: {reason}')
+
+
+def reports(args):
+    from query_data import explain_reports, run_reports, session
+    if args.explain:
+        explain_reports(session, args.year, args.month)
+    else:
+        run_reports(session, args.year, args.month)
+
+
+def backfill_rollups(args):
+    from db import Session
+    from create import Sale
+    from insert_data import link_listings
+    import commissions
+    session = Session()
+    print(f'The listing of {link_listings(session)} sales was resolved.')
+    updated = commissions.recompute(session, Sale.agent_commissions.is_(None))
+    print(f'The commission of {updated} sales was computed.')
+    print('The monthly sales rollups and the agent commissions were rebuilt.')
+
+
+def recompute_commissions(args):
+    from db import Session
+    import commissions
+    commissions.recompute(Session())
+    print('The agent commissions were recomputed.')
+
+
+def commission_job(args):
+    from db import Session
+    import commissions
+    for year, month in commissions.run_commission_job(Session()):
+        print(f'The commissions of {year}-{month:02d} were updated.')
+
+
+def generate(args):
+    from generate import generate
+    for table, count in generate(scale=args.scale, seed=args.seed, workers=args.workers, chunk_size=args.chunk_size).items():
+        print(f'{table}: {count} rows')
+
+
+def run_reports(args):
+    from db import Session, load_config
+    from create import Office
+    import runner
+    month = lambda value: tuple(int(part) for part in value.split('-'))
+    with Session() as session:
+        offices = [office_id for office_id, in session.query(Office.id).order_by(Office.id)]
+    tasks = runner.report_tasks(runner.periods(month(args.start), month(args.end), args.granularity), offices=offices)
+    results = runner.run(load_config()['url'], tasks, args.output, args.workers, args.threads, args.limit)
+    print(f'{len(results)} reports were written to {args.output}.')
+
+
+def export(args):
+    import sys
+    from db import Session
+    import streaming
+    columns = args.columns.split(',') if args.columns else None
+    if args.output is None:
+        streaming.export(Session(), args.table, sys.stdout, args.format, columns, args.page_size)
+        return
+    with open(args.output, 'w', newline='') as file:
+        count = streaming.export(Session(), args.table, file, args.format, columns, args.page_size)
+    print(f'{count} rows were written to {args.output}.')
+
+
+def archive(args):
+    from db import Session
+    import partitions
+    partition = partitions.archive(Session(), args.year, args.folder, compact=args.compact)
+    print(f'{partition.sale_count} sales of {partition.year} were archived to {partition.path}.')
+
+
+def bulk_load(args):
+    import sys
+    import bulk_load
+    progress = lambda table, rows, rate: print(f'{table}: {rows} rows, {rate:,.0f} rows/s', file=sys.stderr)
+    result = bulk_load.load(houses=args.houses, listings=args.listings, sales=args.sales, chunk_size=args.chunk_size,
+                            defer_indexes=args.defer_indexes, progress=progress)
+    for table, number, reason in result['rejected']:
+        print(f'{table} line {number} was rejected: {reason}')
+    loaded = ', '.join(f'{result[table]} {table}' for table in ('houses', 'listings', 'sales') if table in result)
+    print(f"Loaded {loaded or 'nothing'} at {result['rows_per_s']:,.0f} rows/s.")
+
+
+def run_all(args):
+    args.reset = True
+    init_schema(args)
+    seed(args)
+    reports(args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Real Estate Head Office database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('init-schema', help='create the missing tables, columns and indexes')
+    command.add_argument('--reset', action='store_true', help='drop every table first')
+    command.set_defaults(run=init_schema)
+
+    commands.add_parser('seed', help='insert the sample data').set_defaults(run=seed)
+
+    for name, run in [('reports', reports), ('all', run_all)]:
+        command = commands.add_parser(name, help='run the monthly reports' if name == 'reports' else
+                                      'reset the schema, seed it and run the reports')
+        command.add_argument('--year', type=int, default=2023)
+        command.add_argument('--month', type=int, default=1)
+        command.add_argument('--explain', action='store_true', help='print the query plans instead')
+        command.set_defaults(run=run)
+
+    commands.add_parser('backfill-rollups', help='rebuild the monthly sales rollups').set_defaults(run=backfill_rollups)
+    commands.add_parser('recompute-commissions', help='recompute the stored commissions').set_defaults(
+        run=recompute_commissions)
+    commands.add_parser('commission-job', help='update the monthly agent commissions').set_defaults(run=commission_job)
+
+    command = commands.add_parser('generate', help='fill an empty database with synthetic data')
+    command.add_argument('--scale', type=int, default=1000, help='the number of sales')
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--workers', type=int, default=1, help='the number of processes, each writing a shard')
+    command.add_argument('--chunk-size', type=int, default=10000, help='the number of ids inserted at a time')
+    command.set_defaults(run=generate)
+
+    command = commands.add_parser('run-reports', help='run every report for every period of a range in parallel')
+    command.add_argument('--start', required=True, help='the first month, as YYYY-MM')
+    command.add_argument('--end', required=True, help='the last month, as YYYY-MM')
+    command.add_argument('--granularity', choices=['month', 'quarter', 'year'], default='month')
+    command.add_argument('--workers', type=int, default=os.cpu_count())
+    command.add_argument('--threads', action='store_true', help='run the reports in threads rather than processes')
+    command.add_argument('--limit', type=int, default=5, help='the number of rows of the top reports')
+    command.add_argument('--output', required=True, help='the JSON file of the results')
+    command.set_defaults(run=run_reports)
+
+    command = commands.add_parser('export', help='write a table to CSV or JSON lines')
+    command.add_argument('table', help='the name of the table, e.g. sales')
+    command.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    command.add_argument('--columns', help='the comma-separated columns to write, all by default')
+    command.add_argument('--page-size', type=int, default=1000, help='the number of rows read per query')
+    command.add_argument('--output', help='the file to write, the standard output by default')
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('archive', help='move the sales of a closed year into an archive file')
+    command.add_argument('--year', type=int, required=True)
+    command.add_argument('--folder', default='archive', help='the folder of the archive files')
+    command.add_argument('--no-compact', dest='compact', action='store_false',
+                         help='do not VACUUM the database afterwards')
+    command.set_defaults(run=archive)
+
+    command = commands.add_parser('bulk-load', help='load CSV or JSON lines files of houses, listings and sales')
+    command.add_argument('--houses', help='the file of the houses')
+    command.add_argument('--listings', help='the file of the listings')
+    command.add_argument('--sales', help='the file of the sales')
+    command.add_argument('--chunk-size', type=int, default=50000, help='the number of rows per transaction')
+    command.add_argument('--defer-indexes', action='store_true',
+                         help='drop the secondary indexes during the load and create them at the end')
+    command.set_defaults(run=bulk_load)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+'''
+Columnar export of the sales fact data, for the analytics that read every sale of a period.
+
+The sales joined to their house, their office and their listing are streamed from the database in
+chunks of rows (yield_per, with a server-side cursor where the driver has one), and every chunk is
+turned into one array per column, without ORM objects:
+
+    sale_id, sell_day, sale_price, agent_commissions, agent_id, office_id, zip_code, days_on_market
+
+All columns are 64-bit integers: sell_day is the number of days since 1970-01-01, the prices are in
+cents, a missing id or commission is 0, and unknown days on the market are -1. The arrays are NumPy
+arrays when NumPy is installed, as listed in requirements.txt, and array.array('q') otherwise, with
+the same results. The analytics module computes the reports of query_data on them.
+
+export() writes the chunks to a folder, one file per chunk holding the columns one after the other,
+and a manifest.json describing them, so that read_export() can read back any subset of the columns
+without loading the others.
+'''
+import array
+import json
+import os
+import sys
+from sqlalchemy import Integer, cast, func, select, true
+from create import House, Sale
+from db import engine
+import partitions
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, the columns are then array.array
+    numpy = None
+
+COLUMNS = ['sale_id', 'sell_day', 'sale_price', 'agent_commissions', 'agent_id', 'office_id', 'zip_code',
+           'days_on_market']
+DEFAULT_CHUNK_SIZE = 65536
+_ITEM_SIZE = 8  # bytes, little-endian signed integers in the exported files
+
+
+def sales_statement(condition=None):
+    '''
+    Returns the SELECT of the columns of COLUMNS, for the sales matching condition (all sales by default).
+    '''
+    return select(
+        Sale.id,
+        cast(func.julianday(Sale.sell_date) - 2440587.5, Integer),  # 2440587.5 is the julian day of 1970-01-01
+        Sale.sale_price,
+        func.coalesce(Sale.agent_commissions, 0),
+        func.coalesce(Sale.agent_id, 0),
+        House.office,
+        House.zip_code,
+        func.coalesce(Sale.days_on_market, -1),
+    ).join(House, House.id == Sale.house_id).where(true() if condition is None else condition).order_by(Sale.id)
+
+
+def array_of(values):
+    '''
+    Returns an array of 64-bit integers holding values, of the type of the columns.
+    '''
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.int64)
+    return array.array('q', values)
+
+
+def stream(bind=engine, condition=None, chunk_size=DEFAULT_CHUNK_SIZE, period=None):
+    '''
+    Yields the sales matching condition, and sold in period if one is given, as chunks of up to
+    chunk_size rows, each chunk being a dict of one array per column of COLUMNS. Only one chunk of rows
+    is held in memory at a time. The archived sales of the years overlapping the period are read too,
+    see partitions.route.
+    '''
+    if period is not None:
+        in_period = (Sale.sell_date >= period.start) & (Sale.sell_date < period.end)
+        condition = in_period if condition is None else condition & in_period
+    with bind.connect() as connection:
+        statement = partitions.route(connection, sales_statement(condition), period)
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(statement)
+        for rows in result.partitions():
+            yield dict(zip(COLUMNS, map(array_of, zip(*rows))))
+
+
+def concatenate(chunks):
+    '''
+    Returns the chunks joined into a single dict of one array per column.
+    '''
+    chunks = list(chunks)
+    names = list(chunks[0]) if chunks else COLUMNS
+    if numpy is not None:
+        return {name: numpy.concatenate([chunk[name] for chunk in chunks]) if chunks else numpy.empty(0, numpy.int64)
+                for name in names}
+    columns = {name: array.array('q') for name in names}
+    for chunk in chunks:
+        for name, values in chunk.items():
+            columns[name].extend(values)
+    return columns
+
+
+def load(bind=engine, condition=None, chunk_size=DEFAULT_CHUNK_SIZE, period=None):
+    '''
+    Returns the sales matching condition, and sold in period if one is given, as a dict of one array per
+    column of COLUMNS.
+    '''
+    return concatenate(stream(bind, condition, chunk_size, period))
+
+
+def export(folder, bind=engine, condition=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Writes the sales matching condition to a folder, one part-NNNNN.bin file per chunk, and returns
+    the number of sales written.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    parts = []
+    for number, chunk in enumerate(stream(bind, condition, chunk_size)):
+        name = f'part-{number:05d}.bin'
+        with open(os.path.join(folder, name), 'wb') as file:
+            for column in COLUMNS:
+                values = chunk[column]
+                if numpy is not None:
+                    file.write(values.astype('<i8').tobytes())
+                else:
+                    if sys.byteorder == 'big':
+                        values = array.array('q', values)
+                        values.byteswap()
+                    values.tofile(file)
+        parts.append({'file': name, 'rows': len(chunk['sale_id'])})
+    with open(os.path.join(folder, 'manifest.json'), 'w') as file:
+        json.dump({'columns': COLUMNS, 'type': 'int64 little-endian', 'parts': parts}, file, indent=2)
+    return sum(part['rows'] for part in parts)
+
+
+def _read(file, count):
+    if numpy is not None:
+        return numpy.fromfile(file, dtype='<i8', count=count).astype(numpy.int64)
+    values = array.array('q')
+    values.fromfile(file, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def read_export(folder, columns=None):
+    '''
+    Yields the chunks written by export(), each as a dict of one array per column, only reading the
+    columns asked for (all by default).
+    '''
+    with open(os.path.join(folder, 'manifest.json')) as file:
+        manifest = json.load(file)
+    columns = manifest['columns'] if columns is None else columns
+    for part in manifest['parts']:
+        with open(os.path.join(folder, part['file']), 'rb') as file:
+            chunk = {}
+            for name in columns:
+                file.seek(manifest['columns'].index(name) * part['rows'] * _ITEM_SIZE)
+                chunk[name] = _read(file, part['rows'])
+            yield chunk
@@ -0,0 +1,142 @@
+from bisect import bisect_right
+from datetime import date
+from sqlalchemy import case, func, select, true, tuple_, update
+from sqlalchemy.sql import extract
+from create import AgentCommission, AgentMonthlySales, CommissionTier, JobWatermark, Sale
+import leaderboard
+import report_cache
+from instrumentation import labelled
+import rollups
+from upsert import upsert
+
+COMMISSION_JOB = 'agent_commissions'
+
+# (min_price in cents, rate in basis points), the tiers used while commission_tiers is empty
+DEFAULT_TIERS = [(0, 1000), (100000, 750), (200000, 600), (500000, 500), (1000000, 400)]
+
+
+def load_tiers(session):
+    '''
+    Returns the commission tiers as a list of (min_price, rate) tuples sorted by min_price.
+    '''
+    tiers = session.execute(select(CommissionTier.min_price, CommissionTier.rate).order_by(CommissionTier.min_price)).all()
+    return [tuple(tier) for tier in tiers] or list(DEFAULT_TIERS)
+
+
+def commission_for(sale_price, tiers):
+    '''
+    Returns the commission of a sale, in cents rounded half up, for tiers as returned by load_tiers.
+    A price below the lowest tier earns no commission.
+    '''
+    position = bisect_right([min_price for min_price, _ in tiers], sale_price)
+    if position == 0:
+        return 0
+    return (sale_price * tiers[position - 1][1] + 5000) // 10000
+
+
+def commission_expression(tiers):
+    '''
+    Returns the SQL expression computing commission_for(Sale.sale_price, tiers) on the database side.
+    '''
+    return case(
+        *[(Sale.sale_price >= min_price, (Sale.sale_price * rate + 5000) // 10000) for min_price, rate in reversed(tiers)],
+        else_=0)
+
+
+def set_tiers(session, tiers):
+    '''
+    Replaces the commission tiers and recomputes the commission of every sale, in one transaction.
+
+    Args:
+        session (Session): The session used to write the tiers.
+        tiers (List[tuple]): The new tiers, as (min_price, rate) tuples.
+    '''
+    session.query(CommissionTier).delete(synchronize_session=False)
+    session.add_all(CommissionTier(min_price=min_price, rate=rate) for min_price, rate in sorted(tiers))
+    session.flush()
+    recompute(session)
+
+
+def recompute(session, condition=true()):
+    '''
+    Recomputes the stored commission of the sales from the current tiers with a single UPDATE, then
+    rebuilds the monthly rollups whose commission totals depend on them and the agent commissions, in
+    one transaction with the changes of the session. It has to run after the tiers change, and for the
+    sales left without a commission by the migration that added the column.
+    The sales of the archived years keep their commissions, see partitions.
+
+    Args:
+        session (Session): The session used to update the sales.
+        condition (ColumnElement): The filter selecting the sales to update, every sale by default.
+
+    Returns:
+        int: The number of sales updated.
+    '''
+    updated = session.execute(
+        update(Sale).where(condition).values(agent_commissions=commission_expression(load_tiers(session)))).rowcount
+    rollups.backfill(session, commit=False)
+    update_agent_commissions(session)
+    session.commit()
+    report_cache.clear(session.get_bind())
+    leaderboard.reconcile(session.get_bind())
+    return updated
+
+
+def update_agent_commissions(session, periods=None):
+    '''
+    Writes the commission of every agent for the given months into AgentCommission, reading the totals
+    of the monthly agent rollups. Existing rows are replaced, so writing the same months again is harmless.
+
+    Args:
+        session (Session): The session the rows are written in, as part of its transaction.
+        periods (List[tuple]): The (year, month) tuples to write, defaults to every month of the rollups.
+    '''
+    totals = select(
+        AgentMonthlySales.agent_id, AgentMonthlySales.year, AgentMonthlySales.month,
+        AgentMonthlySales.total_commission.label('monthly_commission'))
+    if periods is not None:
+        if not periods:
+            return
+        totals = totals.where(tuple_(AgentMonthlySales.year, AgentMonthlySales.month).in_(periods))
+    upsert(session, AgentCommission, ['year', 'month', 'agent_id'], totals, replace=['monthly_commission'])
+
+
+@labelled('commission_job')
+def run_commission_job(session, job=COMMISSION_JOB):
+    '''
+    Brings AgentCommission up to date with the sales recorded since the job last ran. Only the months
+    of those new sales are written again, so a run costs O(new sales) rather than O(all sales).
+    The rows are upserted and the watermark only moves forward, in one transaction, so running the job
+    again, or from two processes at once, gives the same result.
+
+    The watermark is the highest sale id seen, which assumes the sales commit in id order. SQLite
+    guarantees it, as it runs one write transaction at a time. On a server database with concurrent
+    writers, a sale whose transaction commits after a sale with a higher id would be skipped for good;
+    the sequence numbers of the change feed are assigned the same way and would not help. The job
+    would then have to read the months of the sales committed since its last run instead, e.g. from a
+    commit timestamp, which is not implemented.
+
+    Args:
+        session (Session): The session used to run the job.
+        job (str): The name of the job in JobWatermark.
+
+    Returns:
+        List[tuple]: The (year, month) tuples whose commissions were written, oldest first.
+    '''
+    last_sale_id = session.execute(
+        select(JobWatermark.last_sale_id).where(JobWatermark.name == job)).scalar_one_or_none() or 0
+    high_sale_id = session.execute(select(func.max(Sale.id))).scalar_one_or_none()
+    if high_sale_id is None or high_sale_id <= last_sale_id:
+        session.commit()
+        return []
+    periods = [tuple(period) for period in session.execute(
+        select(extract('year', Sale.sell_date).label('year'), extract('month', Sale.sell_date).label('month')).where(
+            Sale.id > last_sale_id, Sale.id <= high_sale_id).distinct().order_by('year', 'month'))]
+    update_agent_commissions(session, periods)
+    upsert(session, JobWatermark, ['name'], [{'name': job, 'last_sale_id': high_sale_id}])
+    session.execute(update(JobWatermark).where(JobWatermark.name == job, JobWatermark.last_sale_id < high_sale_id).values(
+        last_sale_id=high_sale_id))
+    session.commit()
+    report_cache.invalidate(session.get_bind(), [date(year, month, 1) for year, month in periods])
+    return periods
+
@@ -1,15 +1,17 @@
 #from datetime import datetime
-from sqlalchemy import Date, create_engine, Column, Text, Integer, ForeignKey, String, DateTime, VARCHAR, Enum, func, desc, case, select
+import sys
+from sqlalchemy import Date, Column, Text, Integer, ForeignKey, DateTime, VARCHAR, Enum, Index, PrimaryKeyConstraint, \
+    UniqueConstraint, text
 import sqlalchemy
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql import case
-from sqlalchemy.orm import relationship, sessionmaker, column_property
+from sqlalchemy.orm import declarative_base, relationship
 
-engine = create_engine('sqlite:///database.db')
-engine.connect()
+from db import engine
 
 Base = declarative_base()
 
+# the condition of the partial indexes of the listings for sale, which the queries must repeat as is
+AVAILABLE = "listing_state = 'AVAILABLE'"
+
 
 #creating the tables
 '''
@@ -48,6 +50,17 @@ class Listing(Base):
         It returns a formatted string that includes all the attributes of the object.
     '''
     __tablename__ = 'listings'
+    __table_args__ = (
+        Index('ix_listings_house_id', 'house_id'),
+        Index('ix_listings_seller_id', 'seller_id'),
+        Index('ix_listings_listing_agent_id', 'listing_agent_id'),
+        Index('ix_listings_listing_office_id', 'listing_office_id'),
+        # partial indexes of the listings for sale, for the pages of search.search_listings
+        Index('ix_listings_available_price', 'listing_price', 'id', sqlite_where=text(AVAILABLE),
+              postgresql_where=text(AVAILABLE)),
+        Index('ix_listings_available_date', 'listing_date', 'id', sqlite_where=text(AVAILABLE),
+              postgresql_where=text(AVAILABLE)),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     house_id = Column(Integer, ForeignKey('houses_in_estate.id'), nullable=False)
     seller_id = Column(Integer, ForeignKey('customers.id'), nullable=False)
@@ -90,6 +103,11 @@ class House(Base):
         It returns a formatted string that includes all the attributes of the object.
     '''
     __tablename__ = 'houses_in_estate'
+    __table_args__ = (
+        Index('ix_houses_office', 'office', 'id'),
+        # also serves the lookups by zip code alone
+        Index('ix_houses_zip_code_rooms', 'zip_code', 'no_of_bedrooms', 'no_of_bathrooms'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     no_of_bedrooms = Column(Integer, nullable=False)
     no_of_bathrooms = Column(Integer, nullable=False)
@@ -153,6 +171,10 @@ class AgentOffice(Base):
 
     '''
     __tablename__ = "agent's office"
+    __table_args__ = (
+        Index('ix_agent_office_agent_id', 'agent_id'),
+        Index('ix_agent_office_office_id', 'office_id'),
+    )
     id = Column(Integer, primary_key=True)
     agent_id = Column(Integer, ForeignKey('agents.id'))
     office_id = Column(Integer, ForeignKey('offices.id'))
@@ -195,10 +217,14 @@ class Sale(Base):
     Attributes:
         __tablename__ (str): The name of the database table that corresponds to this model.
         id (int): A unique identifier for each house sale. Primary key for the database table.
-        listing_id (int): Foreign key referencing the id of the house that was sold.
+        listing_id (int): Foreign key referencing the id of the listing that was sold, resolved when the sale is recorded.
+        house_id (int): Foreign key referencing the id of the house that was sold.
         buyer_id (int): Foreign key referencing the id of the customer who bought the house.
         sale_price (int): The price of the house that was sold, in cents.
         sell_date (datetime): The date when the house was sold.
+        agent_id (int): Foreign key referencing the id of the agent who sold the house.
+        agent_commissions (int): The commission of the agent for the sale, in cents.
+        days_on_market (int): The number of days between the listing date and the sell date, computed when the sale is recorded.
         listing (Listing): A relationship to the Listing object that corresponds to the house that was sold.
         
     Methods:
@@ -206,6 +232,14 @@ class Sale(Base):
         It returns a formatted string that includes all the attributes of the object.
     '''
     __tablename__ = 'sales'
+    __table_args__ = (
+        Index('ix_sales_listing_id', 'listing_id'),
+        Index('ix_sales_house_id', 'house_id'),
+        Index('ix_sales_buyer_id', 'buyer_id'),
+        Index('ix_sales_agent_id', 'agent_id'),
+        Index('ix_sales_sell_date_price', 'sell_date', 'sale_price'),
+        Index('ix_sales_sell_date_agent_commission', 'sell_date', 'agent_id', 'agent_commissions'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     listing_id = Column(Integer, ForeignKey('listings.id'))
     house_id = Column(Integer, ForeignKey('houses_in_estate.id'))
@@ -213,16 +247,8 @@ class Sale(Base):
     sale_price = Column(Integer, nullable=False) #in cents
     sell_date = Column(Date, nullable=False)
     agent_id = Column(Integer, ForeignKey('agents.id'))
-    agent_commissions = column_property(
-        sale_price * 
-        case(
-            (sale_price < 100000, 0.1),
-            (sale_price < 200000, 0.075),
-            (sale_price < 500000, 0.06),
-            (sale_price < 1000000, 0.05),
-            (sale_price >= 1000000, 0.04)
-        )
-    )
+    agent_commissions = Column(Integer)  # in cents, computed from the commission tiers when the sale is recorded
+    days_on_market = Column(Integer)  # from the date of the listing that was sold, computed when the sale is recorded
     listing = relationship("Listing", backref="sale", uselist=False)
 
     def __repr__(self):
@@ -273,12 +299,15 @@ class Customer(Base):
 class AgentCommission(Base):
     '''
     The AgentCommission class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
-    It represents the commission that an agent receives for each sale.
+    It represents the commission that an agent receives for the sales of one month. There is one row per
+    agent and month, written by the commission job (commissions.run_commission_job) from the monthly rollups.
 
     Attributes:
         __tablename__ (str): The name of the database table that corresponds to this model.
         id (int): A unique identifier for each commission. Primary key for the database table.
         agent_id (int): Foreign key referencing the id of the agent who receives the commission.
+        year (int): The year of the sales the commission is for.
+        month (int): The month of the sales the commission is for.
         monthly_commission (int): The commission that the agent receives, in cents.
 
     Methods:
@@ -286,20 +315,126 @@ class AgentCommission(Base):
         It returns a formatted string that includes all the attributes of the object.
     '''
     __tablename__ = 'agent_commissions'
+    # derived from the sales: create_columns rebuilds the table instead of altering it
+    __table_args__ = (
+        UniqueConstraint('year', 'month', 'agent_id', name='uq_agent_commissions_period_agent'),
+        {'info': {'derived': True}},
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)  # unique id
-    agent_id = Column(Integer, ForeignKey('agents.id'))  # id of the estate agent
+    agent_id = Column(Integer, ForeignKey('agents.id'), nullable=False)  # id of the estate agent
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
     monthly_commission = Column(Integer)  # commission that the estate agent must receive
 
     def __repr__(self):
-        return "<AgentCommission(id={0}, estate_agent_id={1}, monthly_commission={2}>".format(
+        return "<AgentCommission(id={0}, estate_agent_id={1}, year={2}, month={3}, monthly_commission={4}>".format(
             self.id,
             self.agent_id,
+            self.year,
+            self.month,
             self.monthly_commission)
 
+
+class JobWatermark(Base):
+    '''
+    The JobWatermark class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents how far an incremental job has processed the sales.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        name (str): The name of the job. Primary key for the database table.
+        last_sale_id (int): The id of the last sale the job has processed.
+
+    Methods:
+        __repr__(): A special method that returns a string representation of the JobWatermark object.
+        It returns a formatted string that includes all the attributes of the object.
+    '''
+    __tablename__ = 'job_watermarks'
+    name = Column(Text, primary_key=True)
+    last_sale_id = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<JobWatermark(name={0}, last_sale_id={1}>".format(
+            self.name,
+            self.last_sale_id)
+
+class SaleChange(Base):
+    '''
+    The SaleChange class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents one entry of the append-only change feed of the sales, written by the sale ingestion
+    in the transaction of the change and read by the downstream consumers with changes.read_changes.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        seq (int): The sequence number of the change, increasing in the order of the commits. Primary key for the database table.
+        kind (str): SALE_INSERTED, LISTING_STATE or SUMMARY_DELTA.
+        sale_id (int): The id of the inserted sale, for SALE_INSERTED.
+        listing_id (int): The id of the listing that was sold, for SALE_INSERTED, or that changed state, for LISTING_STATE.
+        listing_state (str): The new state of the listing, for LISTING_STATE.
+        slot (int): The id of the incremented SalePriceSummary row, for SUMMARY_DELTA.
+        amount (int): The sale price, for SALE_INSERTED, or the amount added to the summary, for SUMMARY_DELTA, in cents.
+
+    Methods:
+        __repr__(): A special method that returns a string representation of the SaleChange object.
+        It returns a formatted string that includes all the attributes of the object.
+    '''
+    __tablename__ = 'sale_changes'
+    # AUTOINCREMENT: the sequence numbers of trimmed changes are never reused
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(Enum("SALE_INSERTED", "LISTING_STATE", "SUMMARY_DELTA"), nullable=False)
+    sale_id = Column(Integer)
+    listing_id = Column(Integer)
+    listing_state = Column(Text)
+    slot = Column(Integer)
+    amount = Column(Integer)  # in cents
+
+    def __repr__(self):
+        return "<SaleChange(seq={0}, kind={1}, sale_id={2}, listing_id={3}, listing_state={4}, slot={5}, amount={6})>".format(
+            self.seq,
+            self.kind,
+            self.sale_id,
+            self.listing_id,
+            self.listing_state,
+            self.slot,
+            self.amount)
+
+
+class SalesPartition(Base):
+    '''
+    The SalesPartition class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents a closed year whose sales, and the listings they sold, were moved out of the main
+    database into an archive file by partitions.archive.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        year (int): The year of the sell dates of the archived sales. Primary key for the database table.
+        path (str): The path of the SQLite file holding the sales and listings of the year.
+        sale_count (int): The number of archived sales.
+        total_sale_price (int): The sum of the sale prices of the archived sales, in cents.
+
+    Methods:
+        __repr__(): A special method that returns a string representation of the SalesPartition object.
+        It returns a formatted string that includes all the attributes of the object.
+    '''
+    __tablename__ = 'sales_partitions'
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    path = Column(Text, nullable=False)
+    sale_count = Column(Integer, nullable=False)
+    total_sale_price = Column(Integer, nullable=False)  # in cents
+
+    def __repr__(self):
+        return "<SalesPartition(year={0}, path={1}, sale_count={2}, total_sale_price={3})>".format(
+            self.year,
+            self.path,
+            self.sale_count,
+            self.total_sale_price)
+
+
 class SalePriceSummary(Base):
     '''
     The SalePriceSummary class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
-    It represents the total sale price of all houses that have been sold.
+    It represents the total sale price of all houses that have been sold, see summary.
 
     Attributes:
         __tablename__ (str): The name of the database table that corresponds to this model.
@@ -321,21 +456,234 @@ class SalePriceSummary(Base):
             self.total_sale)
 
 
+class CommissionTier(Base):
+    '''
+    The CommissionTier class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents one tier of the commission rates: a sale whose price is at least min_price, and below
+    the min_price of the next tier, earns the agent rate basis points of the sale price.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        id (int): A unique identifier for each tier. Primary key for the database table.
+        min_price (int): The lowest sale price of the tier, in cents.
+        rate (int): The commission rate of the tier, in basis points (1/100 of a percent).
+
+    Methods:
+        __repr__(): A special method that returns a string representation of the CommissionTier object.
+        It returns a formatted string that includes all the attributes of the object.
+    '''
+    __tablename__ = 'commission_tiers'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    min_price = Column(Integer, nullable=False, unique=True)  # in cents
+    rate = Column(Integer, nullable=False)  # in basis points
+
+    def __repr__(self):
+        return "<CommissionTier(id={0}, min_price={1}, rate={2}>".format(
+            self.id,
+            self.min_price,
+            self.rate)
+
+
+class MonthlySales:
+    '''
+    The MonthlySales class holds the columns shared by the monthly sales rollup tables. Each rollup row
+    aggregates the sales of one month for one value of the rollup key (an office, an agent, a zip code).
+    The rows are kept up to date by the sale write path in insert_data, so the monthly reports read a few
+    rows per key instead of aggregating the whole sales table.
+
+    Attributes:
+        year (int): The year of the sales. First column of the primary key.
+        month (int): The month of the sales. Second column of the primary key.
+        sale_count (int): The number of sales.
+        total_sale_price (int): The sum of the sale prices, in cents.
+        total_commission (int): The sum of the agent commissions, in cents.
+        total_days_on_market (int): The sum of the number of days the houses were on the market.
+        days_on_market_count (int): The number of sales whose days on the market are known, which
+            total_days_on_market is averaged over.
+    '''
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    sale_count = Column(Integer, nullable=False, default=0)
+    total_sale_price = Column(Integer, nullable=False, default=0)  # in cents
+    total_commission = Column(Integer, nullable=False, default=0)  # in cents
+    total_days_on_market = Column(Integer, nullable=False, default=0)
+    days_on_market_count = Column(Integer, nullable=False, default=0, server_default='0')
+
 
-Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+class OfficeMonthlySales(MonthlySales, Base):
+    '''
+    The OfficeMonthlySales class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents the sales of the houses of one office for one month.
 
-Session = sessionmaker(bind=engine)
-session = Session()
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        office_id (int): Foreign key referencing the id of the office of the houses. Part of the primary key.
+    '''
+    __tablename__ = 'office_monthly_sales'
+    __table_args__ = (PrimaryKeyConstraint('year', 'month', 'office_id'),)
+    office_id = Column(Integer, ForeignKey('offices.id'), nullable=False)
 
-#schema for all tables created
-#print(Base.metadata.tables)
-print(repr(Customer))
-print(repr(Listing))
-print(repr(Sale))
-print(repr(Agent))
-print(repr(House))
-print(repr(Office))
-print(repr(AgentCommission))
-print(repr(SalePriceSummary))
-print(repr(AgentOffice))
\ No newline at end of file
+    def __repr__(self):
+        return "<OfficeMonthlySales(year={0}, month={1}, office_id={2}, sale_count={3}, total_sale_price={4}>".format(
+            self.year,
+            self.month,
+            self.office_id,
+            self.sale_count,
+            self.total_sale_price)
+
+
+class AgentMonthlySales(MonthlySales, Base):
+    '''
+    The AgentMonthlySales class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents the sales made by one agent for one month.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        agent_id (int): Foreign key referencing the id of the agent who made the sales. Part of the primary key.
+    '''
+    __tablename__ = 'agent_monthly_sales'
+    __table_args__ = (PrimaryKeyConstraint('year', 'month', 'agent_id'),)
+    agent_id = Column(Integer, ForeignKey('agents.id'), nullable=False)
+
+    def __repr__(self):
+        return "<AgentMonthlySales(year={0}, month={1}, agent_id={2}, sale_count={3}, total_sale_price={4}>".format(
+            self.year,
+            self.month,
+            self.agent_id,
+            self.sale_count,
+            self.total_sale_price)
+
+
+class ZipMonthlySales(MonthlySales, Base):
+    '''
+    The ZipMonthlySales class is an ORM (Object-Relational Mapping) model defined using SQLAlchemy.
+    It represents the sales of the houses of one zip code for one month.
+
+    Attributes:
+        __tablename__ (str): The name of the database table that corresponds to this model.
+        zip_code (int): The zip code of the houses. Part of the primary key.
+    '''
+    __tablename__ = 'zip_monthly_sales'
+    __table_args__ = (PrimaryKeyConstraint('year', 'month', 'zip_code'),)
+    zip_code = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<ZipMonthlySales(year={0}, month={1}, zip_code={2}, sale_count={3}, total_sale_price={4}>".format(
+            self.year,
+            self.month,
+            self.zip_code,
+            self.sale_count,
+            self.total_sale_price)
+
+
+
+def create_indexes(bind=engine):
+    '''
+    Creates the indexes declared on the models that are missing from the database. Unlike create_all
+    after a drop_all, this keeps the data, and it can be run any number of times on an existing database.
+
+    Args:
+        bind (Engine): The engine of the database to migrate.
+
+    Returns:
+        List[str]: The names of the indexes that were created.
+    '''
+    created = []
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not bind.dialect.has_table(connection, table.name):
+                continue
+            existing = {index['name'] for index in sqlalchemy.inspect(connection).get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing:
+                    index.create(bind=connection)
+                    created.append(index.name)
+    return created
+
+
+def create_columns(bind=engine):
+    '''
+    Adds the columns declared on the models that are missing from the tables of an existing database,
+    with ALTER TABLE ... ADD COLUMN. The rows that already exist get NULL, or the server default of the
+    column, in the new columns. The tables marked as derived in their info, whose rows are recomputed
+    from the sales, are dropped and created again instead.
+
+    Args:
+        bind (Engine): The engine of the database to migrate.
+
+    Returns:
+        List[str]: The names of the columns that were created, as table.column.
+    '''
+    created = []
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not bind.dialect.has_table(connection, table.name):
+                continue
+            existing = {column['name'] for column in sqlalchemy.inspect(connection).get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            if missing and table.info.get('derived'):
+                table.drop(bind=connection)
+                table.create(bind=connection)
+                created += [table.name + '.' + column.name for column in missing]
+                continue
+            for column in missing:
+                ddl = sqlalchemy.schema.CreateColumn(column).compile(dialect=bind.dialect)
+                connection.exec_driver_sql('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                    bind.dialect.identifier_preparer.format_table(table), ddl))
+                created.append(table.name + '.' + column.name)
+    return created
+
+
+def explain_query_plan(query, bind=engine):
+    '''
+    Returns the EXPLAIN QUERY PLAN of a query, to check which indexes SQLite uses to run it.
+
+    Args:
+        query (Query | Select): An ORM query or a select statement.
+        bind (Engine): The engine of the database the query runs against.
+
+    Returns:
+        List[str]: One line per step of the plan, indented by depth.
+    '''
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(bind=bind, compile_kwargs={"literal_binds": True}))
+    with bind.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql).all()
+    depths = {0: 0}
+    lines = []
+    for node_id, parent_id, _, detail in rows:
+        depths[node_id] = depths.get(parent_id, 0) + 1
+        lines.append('  ' * (depths[node_id] - 1) + detail)
+    return lines
+
+
+def init_schema(bind=engine, reset=False):
+    '''
+    Creates the schema of the database. By default the existing data is kept: only the missing tables,
+    columns and indexes are added, so it can run at every deployment. With reset, every table is dropped
+    and created again empty.
+
+    Args:
+        bind (Engine): The engine of the database.
+        reset (bool): Whether to drop the existing tables first.
+
+    Returns:
+        List[str]: The names of the columns and indexes added to existing tables.
+    '''
+    if reset:
+        Base.metadata.drop_all(bind=bind)
+    Base.metadata.create_all(bind=bind)
+    return create_columns(bind) + create_indexes(bind)
+
+
+if __name__ == '__main__':
+    # python create.py [--migrate]: without --migrate the database is reset
+    if '--migrate' in sys.argv[1:]:
+        for name in init_schema():
+            print('Created', name)
+    else:
+        init_schema(reset=True)
+
+        # every mapped class, so that the listing follows the models
+        for mapper in sorted(Base.registry.mappers, key=lambda mapper: mapper.local_table.name):
+            print(repr(mapper.class_))
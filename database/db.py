@@ -0,0 +1,142 @@
+'''
+Engine and session factory of the database application.
+
+The settings come from, in increasing order of priority, the defaults below, the [database] section
+of a config file (the DATABASE_CONFIG environment variable, or database.ini in the working folder)
+and DATABASE_<SETTING> environment variables, e.g. DATABASE_URL or DATABASE_POOL_SIZE.
+
+Creating an engine does not connect: the first connection is opened by the first query.
+'''
+import configparser
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+DEFAULTS = {
+    'url': 'sqlite:///database.db',
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'echo': False,
+    # SQLite only, applied with PRAGMA to every new connection
+    'sqlite_journal_mode': 'WAL',  # readers no longer wait for the writer
+    'sqlite_synchronous': 'NORMAL',  # safe with WAL, and much faster than FULL
+    'sqlite_cache_size': -64000,  # in KiB when negative, so 64 MB of page cache
+    'sqlite_mmap_size': 268435456,  # 256 MB of memory-mapped I/O
+    'sqlite_busy_timeout': 5000,  # in ms, how long a writer waits for the lock before failing
+    # see instrumentation, off by default
+    'instrument': False,
+    'slow_query_ms': 100,
+}
+
+
+def load_config(path=None, environ=None):
+    '''
+    Returns the database settings, merged from the defaults, the config file and the environment.
+
+    Args:
+        path (str): The config file, defaults to DATABASE_CONFIG or database.ini. A missing file is ignored.
+        environ (dict): The environment variables, defaults to os.environ.
+    '''
+    environ = os.environ if environ is None else environ
+    path = path or environ.get('DATABASE_CONFIG', 'database.ini')
+    config = dict(DEFAULTS)
+    parser = configparser.ConfigParser()
+    if parser.read(path) and parser.has_section('database'):
+        config.update(parser['database'])
+    config.update({key: environ['DATABASE_' + key.upper()] for key in DEFAULTS if 'DATABASE_' + key.upper() in environ})
+    for key, default in DEFAULTS.items():
+        value = config[key]
+        if isinstance(default, bool) and isinstance(value, str):
+            config[key] = value.strip().lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(default, int) and not isinstance(default, bool):
+            config[key] = int(value)
+    return config
+
+
+def make_engine(url=None, config=None):
+    '''
+    Creates an engine from the settings.
+
+    Args:
+        url (str): The database URL, overriding the url setting.
+        config (dict): The settings, defaults to load_config().
+    '''
+    config = dict(load_config() if config is None else config)
+    url = make_url(url or config['url'])
+    options = {'pool_pre_ping': config['pool_pre_ping'], 'echo': config['echo']}
+    in_memory = url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+    if not in_memory:
+        # an in-memory SQLite database lives in a single connection, it cannot be pooled
+        options.update(pool_size=config['pool_size'], max_overflow=config['max_overflow'])
+    engine = create_engine(url, **options)
+    if url.get_backend_name() == 'sqlite':
+        _tune_sqlite(engine, config, in_memory)
+    if config['instrument']:
+        import instrumentation
+        instrumentation.enable(engine, config['slow_query_ms'])
+    return engine
+
+
+def make_async_engine(url=None, config=None):
+    '''
+    Creates an AsyncEngine from the settings, for the async_api module. A sqlite:// URL is run with the
+    aiosqlite driver, other URLs must name an async driver, e.g. postgresql+asyncpg://.
+
+    Args:
+        url (str): The database URL, overriding the url setting.
+        config (dict): The settings, defaults to load_config().
+    '''
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+    config = dict(load_config() if config is None else config)
+    url = make_url(url or config['url'])
+    if url.drivername == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    options = {'pool_pre_ping': config['pool_pre_ping'], 'echo': config['echo']}
+    in_memory = url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+    if not in_memory:
+        # aiosqlite defaults to opening a connection per checkout, the pool keeps them open instead
+        options.update(poolclass=AsyncAdaptedQueuePool, pool_size=config['pool_size'], max_overflow=config['max_overflow'])
+    engine = create_async_engine(url, **options)
+    if url.get_backend_name() == 'sqlite':
+        _tune_sqlite(engine.sync_engine, config, in_memory)
+    return engine
+
+
+def _tune_sqlite(engine, config, in_memory):
+    pragmas = [
+        ('synchronous', config['sqlite_synchronous']),
+        ('cache_size', config['sqlite_cache_size']),
+        ('busy_timeout', config['sqlite_busy_timeout']),
+    ]
+    if not in_memory:
+        pragmas = [('journal_mode', config['sqlite_journal_mode']), ('mmap_size', config['sqlite_mmap_size'])] + pragmas
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+_engines = {}
+
+
+def get_engine(url=None):
+    '''
+    Returns the engine shared by the whole process for a URL, creating it on first use.
+
+    Args:
+        url (str): The database URL, defaults to the url setting.
+    '''
+    url = url or load_config()['url']
+    if url not in _engines:
+        _engines[url] = make_engine(url)
+    return _engines[url]
+
+
+engine = get_engine()
+Session = sessionmaker(bind=engine)
@@ -0,0 +1,193 @@
+'''
+In-process cache of the dimension rows, for turning the ids of the aggregates into names: the office
+names, the agent and customer names and emails, and the office and zip code of the houses.
+
+The reports aggregate the rollups on bare ids, without joining the dimension tables, and decorate
+the few rows they return from this cache. A lookup is read-through: the ids missing from the cache
+are loaded with one query, and the least recently used rows are evicted past max_entries per
+dimension.
+
+Every dimension has a version, bumped when a session flushes or commits a change to its table,
+including the bulk UPDATE and DELETE statements run through a session. Each cached row remembers the
+version it was loaded at, so a write makes the whole dimension stale in O(1), and the stale rows are
+reloaded on their next lookup. A commit changing the offices or the agents also clears the
+report_cache, whose results hold their names. The writes that bypass the ORM (Core statements on a
+connection, or another process) are not seen: they call clear(), and the time to live bounds how
+stale the rows written by another process can get.
+'''
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from create import Agent, Customer, House, Office
+import report_cache
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_TTL = 300  # in seconds
+
+# the model and the columns cached of every dimension, by dimension name
+DIMENSIONS = {
+    'offices': (Office, ['office_name']),
+    'agents': (Agent, ['firstName', 'lastName', 'emailAddress']),
+    'customers': (Customer, ['firstName', 'lastName', 'emailAddress']),
+    'houses': (House, ['office', 'zip_code']),
+}
+_TABLES = {model.__table__: name for name, (model, _) in DIMENSIONS.items()}
+# the dimensions whose columns appear in the results of the reports
+_DECORATED = {'offices', 'agents'}
+
+
+class DimensionCache:
+    '''
+    The DimensionCache class holds the cached dimension rows of one database.
+
+    Attributes:
+        max_entries (int): The number of rows kept per dimension, the least recently used are evicted first.
+        ttl (float): The number of seconds a row stays valid.
+        versions (dict): The version of every dimension, by dimension name.
+
+    Methods:
+        lookup(session, name, ids): Returns the cached columns of the rows of a dimension, by id.
+        bump(names): Makes the cached rows of the dimensions stale.
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.versions = dict.fromkeys(DIMENSIONS, 0)
+        self._entries = {name: OrderedDict() for name in DIMENSIONS}  # id -> (version, expires, columns)
+        self._lock = threading.Lock()
+
+    def lookup(self, session, name, ids):
+        '''
+        Returns the cached columns of the rows of a dimension, by id, loading the missing ones. The ids
+        without a row are left out.
+        '''
+        entries, found, missing = self._entries[name], {}, set()
+        with self._lock:
+            version, now = self.versions[name], time.monotonic()
+            for id in set(ids):
+                entry = entries.get(id)
+                if entry is not None and entry[0] == version and entry[1] > now:
+                    entries.move_to_end(id)
+                    found[id] = entry[2]
+                elif id is not None:
+                    missing.add(id)
+        if missing:
+            model, columns = DIMENSIONS[name]
+            loaded = {row[0]: tuple(row[1:]) for row in session.execute(
+                select(model.id, *[getattr(model, column) for column in columns]).where(model.id.in_(missing)))}
+            found.update(loaded)
+            with self._lock:
+                # rows loaded while a write bumped the version are stored as stale
+                expires = time.monotonic() + self.ttl
+                for id, row in loaded.items():
+                    entries[id] = (version, expires, row)
+                    entries.move_to_end(id)
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+        return found
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self.versions[name] += 1
+
+
+_settings = {'max_entries': DEFAULT_MAX_ENTRIES, 'ttl': DEFAULT_TTL}
+_caches = weakref.WeakKeyDictionary()
+
+
+def configure(max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+    '''
+    Sets the settings of the caches, and drops the caches created with the previous settings.
+    '''
+    _settings.update(max_entries=max_entries, ttl=ttl)
+    _caches.clear()
+
+
+def cache_for(bind):
+    '''
+    Returns the dimension cache of the database of an engine (or connection), creating it on first use.
+    '''
+    bind = bind.engine
+    cache = _caches.get(bind)
+    if cache is None:
+        cache = _caches[bind] = DimensionCache(_settings['max_entries'], _settings['ttl'])
+    return cache
+
+
+def clear(bind):
+    '''
+    Makes every cached dimension row of the database of an engine stale, after a write that bypassed the ORM.
+    '''
+    cache = _caches.get(bind.engine)
+    if cache is not None:
+        cache.bump(DIMENSIONS)
+
+
+def offices(session, ids):
+    '''
+    Returns the office_name of the offices, by id.
+    '''
+    return {id: row[0] for id, row in cache_for(session.get_bind()).lookup(session, 'offices', ids).items()}
+
+
+def agents(session, ids):
+    '''
+    Returns the (firstName, lastName, emailAddress) of the agents, by id.
+    '''
+    return cache_for(session.get_bind()).lookup(session, 'agents', ids)
+
+
+def customers(session, ids):
+    '''
+    Returns the (firstName, lastName, emailAddress) of the customers, by id.
+    '''
+    return cache_for(session.get_bind()).lookup(session, 'customers', ids)
+
+
+def houses(session, ids):
+    '''
+    Returns the (office, zip_code) of the houses, by id.
+    '''
+    return cache_for(session.get_bind()).lookup(session, 'houses', ids)
+
+
+def _bump(session, names):
+    cache = _caches.get(session.get_bind().engine) if names else None
+    if cache is not None:
+        cache.bump(names)
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    names = {_TABLES.get(type(instance).__table__) for instance in [*session.new, *session.dirty, *session.deleted]
+             if hasattr(type(instance), '__table__')} - {None}
+    # bumped again on commit, as the rows read by other sessions until then are the old ones
+    session.info.setdefault('dimensions_written', set()).update(names)
+    _bump(session, names)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _after_bulk_write(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        name = _TABLES.get(getattr(orm_execute_state.statement, 'table', None))
+        if name is not None:
+            orm_execute_state.session.info.setdefault('dimensions_written', set()).add(name)
+            _bump(orm_execute_state.session, {name})
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    names = session.info.pop('dimensions_written', set())
+    _bump(session, names)
+    if names & _DECORATED:
+        report_cache.clear(session.get_bind())  # the cached reports hold the old names
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    _bump(session, session.info.pop('dimensions_written', set()))
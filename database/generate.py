@@ -0,0 +1,313 @@
+'''
+Synthetic data generator, to load the database at a production-like scale:
+
+    python3 cli.py generate --scale 1000000 --seed 0 --workers 4
+
+The scale is the number of sales. The other tables are sized from it: one listing per house, four
+houses out of five sold, one customer for two sales, one agent for a hundred sales and one office for
+twenty agents. The listing dates follow the seasons of the housing market, the days on the market
+and the prices are log-normal, and every zip code has its own price level.
+
+The data only depends on the scale, the seed and the chunk size. The rows are generated by chunks of
+ids, each chunk from its own random generators seeded with (seed, table, first id), so a chunk is the
+same whichever process generates it and in whichever order. Only one chunk is held in memory at a time, and it is
+written with a single executemany INSERT. With several workers, each process writes its chunks into
+its own SQLite shard file, without indexes, and the shards are then merged into the database with
+ATTACH and INSERT ... SELECT.
+'''
+import functools
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+from datetime import date, datetime, timedelta
+from faker import Faker
+from sqlalchemy import create_engine, func, insert, select, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+from create import Agent, AgentOffice, Base, CommissionTier, Customer, House, Listing, Office, Sale, SalePriceSummary
+from db import engine
+import commissions
+import dimensions
+import leaderboard
+import rollups
+
+FIRST_DAY = date(2018, 1, 1)
+LAST_DAY = date(2023, 12, 31)  # of the listings, the sales can be later
+# how likely a house is listed in each month, from January to December
+MONTH_WEIGHTS = [5, 7, 10, 12, 12, 11, 10, 9, 8, 7, 5, 4]
+# how many houses have 1 to 6 bedrooms
+BEDROOM_WEIGHTS = [10, 25, 30, 20, 10, 5]
+MEDIAN_DAYS_ON_MARKET = 30
+MEDIAN_PRICE = 90000000  # in cents, so $900,000
+ZIP_CODES_PER_OFFICE = 4
+
+# the generated tables, in the order they are written and merged
+TABLES = [Office, Customer, Agent, AgentOffice, House, Listing, Sale]
+
+
+def sizes(scale):
+    '''
+    Returns the number of rows of each generated table for a number of sales, by table name.
+    '''
+    if scale < 1:
+        raise ValueError("The scale must be at least one sale.")
+    # house h is sold unless h is a multiple of 5, so there are exactly scale sold houses
+    houses = scale + (scale - 1) // 4
+    agents = max(10, scale // 100)
+    return {
+        'offices': max(8, agents // 20),
+        'customers': max(10, scale // 2),
+        'agents': agents,
+        "agent's office": agents,
+        'houses_in_estate': houses,
+        'listings': houses,
+        'sales': scale,
+    }
+
+
+def _random(seed, *key):
+    # a str seed is hashed with SHA-512 by random, so it does not depend on PYTHONHASHSEED
+    return random.Random(':'.join(map(str, (seed,) + key)))
+
+
+@functools.lru_cache(maxsize=None)
+def _fakers():
+    # creating a Faker loads its providers, which is much slower than seeding it again
+    return Faker('en_US')
+
+
+def _faker(seed, *key):
+    fake = _fakers()
+    fake.seed_instance(':'.join(map(str, (seed,) + key)))
+    return fake
+
+
+@functools.lru_cache(maxsize=4096)
+def _office(seed, office_id):
+    '''
+    Returns the (city, zip codes) of an office, the same in every process.
+    '''
+    first_zip = 90000 + (office_id - 1) * ZIP_CODES_PER_OFFICE % 9000
+    return _faker(seed, 'office', office_id).city(), tuple(range(first_zip, first_zip + ZIP_CODES_PER_OFFICE))
+
+
+@functools.lru_cache(maxsize=65536)
+def _price_level(seed, zip_code):
+    return math.exp(_random(seed, 'zip', zip_code).gauss(0, 0.35))
+
+
+def _offices(seed, first, last, size, tiers):
+    return {Office: [{'id': office_id, 'office_name': _office(seed, office_id)[0].lower()}
+                     for office_id in range(first, last)]}
+
+
+@functools.lru_cache(maxsize=None)
+def _names():
+    '''
+    Returns the (names, cumulative weights) of the first names and of the last names of Faker. Drawing
+    them with random.choices is much faster than calling Faker for every name, with the same frequencies.
+    '''
+    person = next(provider for provider in _fakers().get_providers() if hasattr(provider, 'last_names'))
+    return [(list(names), list(itertools.accumulate(names.values()))) for names in (person.first_names, person.last_names)]
+
+
+def _people(seed, first, last, domain, table):
+    rng = _random(seed, table, first)
+    (first_names, first_weights), (last_names, last_weights) = _names()
+    count = last - first
+    rows = []
+    for person_id, first_name, last_name in zip(range(first, last),
+                                                 rng.choices(first_names, cum_weights=first_weights, k=count),
+                                                 rng.choices(last_names, cum_weights=last_weights, k=count)):
+        # the id keeps the address unique, and short enough for VARCHAR(40)
+        rows.append({'id': person_id, 'firstName': first_name, 'lastName': last_name,
+                     'emailAddress': f'{first_name[:12]}.{last_name[:12]}{person_id}@{domain}'.lower()})
+    return rows
+
+
+def _customers(seed, first, last, size, tiers):
+    return {Customer: _people(seed, first, last, 'example.com', 'customers')}
+
+
+def _agents(seed, first, last, size, tiers):
+    agents = _people(seed, first, last, 'realtor.com', 'agents')
+    return {Agent: agents,
+            AgentOffice: [{'id': agent['id'], 'agent_id': agent['id'], 'office_id': (agent['id'] - 1) % size['offices'] + 1}
+                          for agent in agents]}
+
+
+_MONTHS, _MONTH_WEIGHTS = range(1, 13), list(itertools.accumulate(MONTH_WEIGHTS))
+_BEDROOMS, _BEDROOM_WEIGHTS = range(1, 7), list(itertools.accumulate(BEDROOM_WEIGHTS))
+
+
+def _listing_date(rng):
+    year = rng.randint(FIRST_DAY.year, LAST_DAY.year)
+    month = rng.choices(_MONTHS, cum_weights=_MONTH_WEIGHTS)[0]
+    day = rng.randint(1, 28)
+    return datetime(year, month, day, rng.randint(8, 19), rng.choice((0, 15, 30, 45)))
+
+
+def _houses(seed, first, last, size, tiers):
+    rng = _random(seed, 'houses', first)
+    fake = _faker(seed, 'houses', first)
+    streets = [fake.street_name() for _ in range(64)]
+    houses, listings, sales = [], [], []
+    for house_id in range(first, last):
+        office_id = rng.randint(1, size['offices'])
+        city, zip_codes = _office(seed, office_id)
+        zip_code = rng.choice(zip_codes)
+        bedrooms = rng.choices(_BEDROOMS, cum_weights=_BEDROOM_WEIGHTS)[0]
+        houses.append({'id': house_id, 'no_of_bedrooms': bedrooms,
+                       'no_of_bathrooms': max(1, bedrooms - rng.randint(0, 2)),
+                       'address': f'{rng.randint(1, 9999)} {rng.choice(streets)}, {city}, CA',
+                       'zip_code': zip_code, 'office': office_id})
+
+        # the agents of an office are the agents whose id is the office id modulo the number of offices
+        agents_of_office = range(office_id, size['agents'] + 1, size['offices'])
+        listing_date = _listing_date(rng)
+        price = MEDIAN_PRICE * _price_level(seed, zip_code) * (0.7 + 0.15 * bedrooms) * rng.lognormvariate(0, 0.3)
+        listing_price = int(round(price, -5))  # whole thousands of dollars
+        sold = house_id % 5 != 0
+        listings.append({'id': house_id, 'house_id': house_id, 'seller_id': rng.randint(1, size['customers']),
+                         'listing_date': listing_date, 'listing_agent_id': rng.choice(agents_of_office),
+                         'listing_office_id': office_id, 'listing_price': listing_price,
+                         'listing_state': 'SOLD' if sold else 'UNAVAILABLE' if rng.random() < 0.1 else 'AVAILABLE'})
+        if sold:
+            days_on_market = min(365 * 2, round(rng.lognormvariate(math.log(MEDIAN_DAYS_ON_MARKET), 0.8)))
+            sale_price = int(round(listing_price * rng.gauss(0.99, 0.04), -4))  # whole hundreds of dollars
+            sales.append({'id': house_id, 'listing_id': house_id, 'house_id': house_id,
+                          'buyer_id': rng.randint(1, size['customers']), 'sale_price': sale_price,
+                          'sell_date': listing_date.date() + timedelta(days=days_on_market),
+                          'agent_id': rng.randint(1, size['agents']),
+                          'agent_commissions': commissions.commission_for(sale_price, tiers),
+                          'days_on_market': days_on_market})
+    return {House: houses, Listing: listings, Sale: sales}
+
+
+# how each chunk is generated, by the table whose ids it covers
+_CHUNKS = [('offices', _offices), ('customers', _customers), ('agents', _agents), ('houses_in_estate', _houses)]
+
+
+def chunks(scale, chunk_size=10000):
+    '''
+    Returns the (table name, first id, end id) of every chunk to generate, the end id being excluded.
+    '''
+    size = sizes(scale)
+    return [(name, first, min(first + chunk_size, size[name] + 1))
+            for name, _ in _CHUNKS for first in range(1, size[name] + 1, chunk_size)]
+
+
+def write_chunks(bind, tasks, scale, seed=0, tiers=commissions.DEFAULT_TIERS):
+    '''
+    Generates chunks and inserts their rows, each chunk in its own transaction.
+
+    Args:
+        bind (Engine): The engine of the database to write to, whose tables must exist.
+        tasks (List[tuple]): The chunks to write, as returned by chunks().
+        scale (int): The number of sales.
+        seed (int): The seed of the data.
+        tiers (List[tuple]): The commission tiers of the sales, see commissions.load_tiers.
+
+    Returns:
+        int: The number of rows inserted.
+    '''
+    size = sizes(scale)
+    generators = dict(_CHUNKS)
+    inserted = 0
+    for name, first, last in tasks:
+        rows = generators[name](seed, first, last, size, tiers)
+        with bind.begin() as connection:
+            for model in TABLES:
+                if rows.get(model):
+                    connection.execute(insert(model.__table__), rows[model])
+                    inserted += len(rows[model])
+    return inserted
+
+
+def _write_shard(arguments):
+    path, tasks, scale, seed, tiers = arguments
+    shard = create_engine(f'sqlite:///{path}')
+    with shard.begin() as connection:
+        connection.exec_driver_sql('PRAGMA journal_mode=OFF')
+        connection.exec_driver_sql('PRAGMA synchronous=OFF')
+        for model in TABLES:
+            # the table only, without its indexes: the shard is read once by the merge
+            connection.execute(CreateTable(model.__table__))
+    try:
+        return write_chunks(shard, tasks, scale, seed, tiers)
+    finally:
+        shard.dispose()
+
+
+def merge_shard(bind, path):
+    '''
+    Copies the rows of a shard file into the database, in a single transaction.
+    '''
+    quote = bind.dialect.identifier_preparer.quote
+    with bind.connect() as connection:
+        connection.execute(text('ATTACH DATABASE :path AS shard'), {'path': path})
+        try:
+            for model in TABLES:
+                columns = ', '.join(quote(column.name) for column in model.__table__.columns)
+                table = quote(model.__tablename__)
+                connection.exec_driver_sql(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM shard.{table}')
+            connection.commit()
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql('DETACH DATABASE shard')
+
+
+def generate(bind=engine, scale=1000, seed=0, workers=1, chunk_size=10000):
+    '''
+    Fills an empty database with synthetic data, then builds the summaries the application maintains
+    on the write path: the sale price summary and the monthly sales rollups.
+
+    Args:
+        bind (Engine): The engine of the database. Its tables are created if needed.
+        scale (int): The number of sales.
+        seed (int): The seed of the data, the same scale, seed and chunk size always give the same data.
+        workers (int): The number of processes generating the data. With more than one, the database
+            must be a SQLite file, as the shards are merged with ATTACH.
+        chunk_size (int): The number of ids generated and inserted at a time.
+
+    Returns:
+        dict: The number of rows of each generated table, by table name.
+    '''
+    if workers > 1 and (bind.url.get_backend_name() != 'sqlite' or bind.url.database in (None, '', ':memory:')):
+        raise ValueError("Generating with several workers needs a SQLite database file.")
+    Base.metadata.create_all(bind=bind)
+    with bind.connect() as connection:
+        for model in TABLES:
+            if connection.execute(select(func.count()).select_from(model)).scalar_one():
+                raise ValueError(f"The {model.__tablename__} table is not empty, the generator needs an empty database.")
+
+    with Session(bind) as session:
+        if not session.execute(select(func.count()).select_from(CommissionTier)).scalar_one():
+            session.add_all(CommissionTier(min_price=min_price, rate=rate) for min_price, rate in commissions.DEFAULT_TIERS)
+            session.commit()
+        tiers = commissions.load_tiers(session)
+
+    tasks = chunks(scale, chunk_size)
+    if workers > 1:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(bind.url.database))) as folder:
+            paths = [os.path.join(folder, f'shard{worker}.db') for worker in range(workers)]
+            # every worker gets every workers-th chunk, so each has its share of every table
+            with multiprocessing.Pool(workers) as pool:
+                pool.map(_write_shard, [(path, tasks[worker::workers], scale, seed, tiers)
+                                        for worker, path in enumerate(paths)])
+            for path in paths:
+                merge_shard(bind, path)
+    else:
+        write_chunks(bind, tasks, scale, seed, tiers)
+
+    with Session(bind) as session:
+        session.query(SalePriceSummary).delete(synchronize_session=False)
+        session.add(SalePriceSummary(id=1, total_sale=session.execute(
+            select(func.coalesce(func.sum(Sale.sale_price), 0))).scalar_one()))
+        rollups.backfill(session)
+    dimensions.clear(bind)  # the rows were inserted without the ORM
+    leaderboard.reconcile(bind)
+    return sizes(scale)
@@ -1,96 +1,43 @@
-from sqlalchemy import create_engine, insert
-from sqlalchemy.sql import extract, select
-from sqlalchemy.orm import relationship, sessionmaker
-from create import House, Listing, Office, Agent, Customer, Sale, AgentCommission, AgentOffice, SalePriceSummary, Base, engine
-from faker import Faker
-from datetime import datetime
-from sqlalchemy import create_engine, func, desc, case, cast, Integer, and_
+from sqlalchemy import insert, update
+from sqlalchemy.sql import select
+from db import Session
+from create import House, Listing, Office, Agent, Customer, Sale, AgentOffice, SalePriceSummary, CommissionTier
+import changes
+import leaderboard
+import partitions
+import rollups
+import summary
+import commissions
+import report_cache
+import streaming
+from instrumentation import labelled
+from datetime import date, datetime
+from itertools import islice
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import func, cast, Integer
 
+# the largest number of listing ids in an IN list, under the bound parameter limit of SQLite
+MAX_IDS = 10000
 
-Session = sessionmaker(bind=engine)
 session = Session()
 
-session.add(Customer(firstName='Praise', lastName='Ogwuche', emailAddress='praiseogwuche@staple.com'))
-session.add(Customer(firstName='Jane', lastName='Doe', emailAddress='jane.doe@example.com'))
-session.add(Customer(firstName='Michael', lastName='Smith', emailAddress='michael.smith@example.com'))
-session.add(Customer(firstName='Emma', lastName='Johnson', emailAddress='emma.johnson@cred.edu'))
-session.add(Customer(firstName='Olivia', lastName='Williams', emailAddress='olivia1@greenshaw.com'))
-
-session.add(Office(office_name= 'south san francisco'))
-session.add(Office(office_name= 'san francisco'))
-session.add(Office(office_name= 'san jose'))
-session.add(Office(office_name= 'oakland'))
-session.add(Office(office_name= 'santa clara'))
-session.add(Office(office_name= 'sunnyvale'))
-session.add(Office(office_name= 'san mateo'))
-session.add(Office(office_name= 'berkeley'))
-
-session.add(Agent(firstName='Wagwan', lastName='Shaw', emailAddress='wawanshaw@realtor.com'))
-session.add(Agent(firstName='Stella', lastName='Knowles', emailAddress='stella@realtor.com'))
-session.add(Agent(firstName='Blessing', lastName='Stay', emailAddress='blessing@realtor.com'))
-session.add(Agent(firstName='Fie', lastName='Fie', emailAddress='fie@realtor.com'))
-session.add(Agent(firstName='Ben', lastName='Foe', emailAddress='foe@finestreally.co')) 
-session.add(Agent(firstName='Destiny', lastName='Freeman', emailAddress='freeman@finestreally.co'))
-
-session.add(AgentOffice(office_id=1, agent_id=1))
-session.add(AgentOffice(office_id=2, agent_id=2))
-session.add(AgentOffice(office_id=3, agent_id=3))
-session.add(AgentOffice(office_id=1, agent_id=4))
-session.add(AgentOffice(office_id=5, agent_id=1))
-session.add(AgentOffice(office_id=1, agent_id=1))
-session.add(AgentOffice(office_id=6, agent_id=1))
-session.add(AgentOffice(office_id=8, agent_id=4))
-session.add(AgentOffice(office_id=4, agent_id=3))
-    
-
-session.add(House(no_of_bedrooms=3, no_of_bathrooms=3, address='1233 Market Street, San Francisco, CA', zip_code=94111, office = 3))
-session.add(House(no_of_bedrooms=4, no_of_bathrooms=3, address='13 Fell Street, San Francisco, CA', zip_code=94110, office = 3))
-session.add(House(no_of_bedrooms=2, no_of_bathrooms=2, address='16 Turk Street, San Jose, CA', zip_code=94102, office = 4))
-session.add(House(no_of_bedrooms=3, no_of_bathrooms=2, address='1248 Market Street, Berkeley, CA', zip_code=12345, office = 2))
-session.add(House(no_of_bedrooms=4, no_of_bathrooms=1, address='18 Powell Street, San Francisco, CA', zip_code=94111, office = 3))
-session.add(House(no_of_bedrooms=3, no_of_bathrooms=1, address='1 Found Street, San Mateo, CA', zip_code=11010, office = 1))
-session.add(House(no_of_bedrooms=4, no_of_bathrooms=2, address='1 Market Street, San Francisco, CA', zip_code=94110, office = 3))
-session.add(House(no_of_bedrooms=6, no_of_bathrooms=6, address='34 Post Street, Santa Clara, CA', zip_code=76110, office = 5))
-
-session.add(Listing(house_id=1, seller_id=1, listing_date=datetime(2022, 1, 1), 
-                    listing_agent_id=1, listing_office_id=1, listing_price=513467,
-                    listing_state='AVAILABLE'))
-session.add(Listing(house_id=2, seller_id=2, listing_date=datetime(2022, 2, 5),
-                    listing_agent_id=2, listing_office_id=2, listing_price=1748361,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=3, seller_id=3, listing_date=datetime(2022, 3, 12),
-                    listing_agent_id=3, listing_office_id=3, listing_price=316942,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=4, seller_id=3, listing_date=datetime(2022, 4, 20),
-                    listing_agent_id=4, listing_office_id=4, listing_price=2216547,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=5, seller_id=1, listing_date=datetime(2022, 5, 25),
-                    listing_agent_id=2, listing_office_id=5, listing_price=4592805,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=6, seller_id=2, listing_date=datetime(2022, 6, 29),
-                    listing_agent_id=5, listing_office_id=6, listing_price=917103,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=7, seller_id=2, listing_date=datetime(2022, 7, 10),
-                    listing_agent_id=1, listing_office_id=7, listing_price=1289412,
-                    listing_state='AVAILABLE'))
-
-session.add(Listing(house_id=8, seller_id=1, listing_date=datetime(2022, 8, 18),
-                    listing_agent_id=3, listing_office_id=8, listing_price=674512,
-                    listing_state='AVAILABLE'))
-
-session.add(SalePriceSummary(total_sale=0))
-
-session.commit()
-
 
+@labelled('update_sales_info')
 def update_sales_info(sale):
+    '''
+    Records a single sale. The listing of the house is marked as SOLD and the sale price
+    is added to the sale price summary, all in one transaction.
+
+    Args:
+        sale (dict): The sale record, with the buyer_id, sale_price, sell_date, agent_id and house_id keys.
+
+    Raises:
+        ValueError: If the house has no listing or its listing is UNAVAILABLE.
+    '''
     try:
-        _extracted_from_update_sales_info_3(sale)
+        failures = _ingest_chunk(session, [sale])
+        if failures:
+            raise ValueError(failures[0][1])
     except Exception as e:
         session.rollback()
         raise e
@@ -98,24 +45,243 @@ def update_sales_info(sale):
         session.close()
 
 
-# TODO Rename this here and in `update_sales_info`
-def _extracted_from_update_sales_info_3(sale):
-    house_id = sale['house_id']
-    house = session.query(Listing).filter_by(house_id=house_id).first()
+@labelled('ingest_sales')
+def ingest_sales(sales, chunk_size=500, session=session):
+    '''
+    Records a batch of sales. The records are consumed lazily from any iterable (a list, a generator,
+    a file reader...) and written in chunks of chunk_size, each chunk in its own transaction.
+    Rejected rows are reported back instead of aborting the batch: if a chunk fails in the database,
+    it is rolled back and its rows are retried one by one so that only the faulty rows are rejected.
+
+    Args:
+        sales (Iterable[dict]): The sale records, with the same keys as for update_sales_info.
+        chunk_size (int): The number of sales written per transaction.
+        session (Session): The session used to write the sales.
+
+    Returns:
+        (int, List[tuple]): The number of sales inserted, and a (position, sale, reason) tuple for
+        every rejected sale, position being the index of the sale in the input.
+    '''
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    inserted = 0
+    failures = []
+    position = 0
+    records = iter(sales)
+    while chunk := list(islice(records, chunk_size)):
+        try:
+            rejected = _ingest_chunk(session, chunk)
+        except SQLAlchemyError:
+            session.rollback()
+            rejected = []
+            for index, sale in enumerate(chunk):
+                try:
+                    rejected += [(index, reason) for _, reason in _ingest_chunk(session, [sale])]
+                except SQLAlchemyError as e:
+                    session.rollback()
+                    rejected.append((index, str(getattr(e, 'orig', None) or e)))
+        inserted += len(chunk) - len(rejected)
+        failures += [(position + index, chunk[index], reason) for index, reason in rejected]
+        position += len(chunk)
+    session.close()
+    return inserted, failures
+
+
+def _ingest_chunk(session, chunk):
+    '''
+    Writes a chunk of sales in a single transaction: one query reads the listings of every house in the
+    chunk, from which the listing sold by each sale is resolved and validated (see _resolve_sale), the
+    accepted sales are inserted with executemany along with their listing, their commission and their
+    days on the market, and recorded by _record_sales: their listings are flipped to SOLD, the monthly
+    rollups and the sale price summary are incremented, and the changes are appended
+    to the change feed. Once committed, the sales are added to the leaderboard of the database, if one
+    was started.
+
+    Returns:
+        List[tuple]: An (index, reason) tuple for every sale of the chunk that was rejected.
+    '''
+    rejected = []
+    listings = {}
+    for listing in session.execute(
+            select(Listing.id, Listing.house_id, Listing.listing_date, Listing.listing_state, House.office).outerjoin(
+                House, House.id == Listing.house_id).where(
+                Listing.house_id.in_({sale.get('house_id') for sale in chunk})).order_by(Listing.id)):
+        listings.setdefault(listing.house_id, []).append(listing)
+
+    tiers = commissions.load_tiers(session)
+    archived = set(partitions.archived_years(session))
+    accepted = []
+    offices = []
+    for index, sale in enumerate(chunk):
+        try:
+            row, listing = _resolve_sale(sale, listings, tiers, archived)
+        except ValueError as e:
+            rejected.append((index, str(e)))
+            continue
+        accepted.append(row)
+        offices.append(listing.office)
+
+    if accepted:
+        sale_ids = session.execute(insert(Sale).returning(Sale.id), accepted).scalars().all()
+        _record_sales(session, sale_ids, accepted)
+    board = leaderboard.board_for(session.get_bind())
+    seq = changes.last_seq(session) if board is not None and accepted else None
+    session.commit()
+    report_cache.invalidate(session.get_bind(), {sale['sell_date'] for sale in accepted})
+    if board is not None:
+        board.add_sales([(sale['sell_date'], sale.get('agent_id'), office, sale['sale_price'])
+                         for sale, office in zip(accepted, offices)], seq)
+    return rejected
+
+
+def _malformed(sale):
+    '''
+    Returns why a sale record cannot be resolved, None if its values have the expected types. The missing
+    values are left to the constraints of the sales table.
+    '''
+    sell_date = sale.get('sell_date')
+    if sell_date is not None and not isinstance(sell_date, date):
+        return f"The sell_date must be a date or a datetime, not {type(sell_date).__name__}."
+    sale_price = sale.get('sale_price')
+    if sale_price is not None and (isinstance(sale_price, bool) or not isinstance(sale_price, int)):
+        return f"The sale_price must be an integer number of cents, not {type(sale_price).__name__}."
+    return None
+
 
-    if house.listing_state == 'UNAVAILABLE':
+def _resolve_sale(sale, listings, tiers, archived):
+    '''
+    Resolves the listing sold by a sale and validates it, the same way for the ingestion and the bulk
+    loader.
+
+    Args:
+        sale (dict): The sale record.
+        listings (dict): The listings of the houses of the sales by house id, in id order.
+        tiers (List[tuple]): The commission tiers, as returned by commissions.load_tiers.
+        archived (set): The archived years, whose sales cannot be changed.
+
+    Returns:
+        (dict, Row): The row to insert, the sale with its listing_id, days_on_market and
+        agent_commissions, and the listing it sold.
+
+    Raises:
+        ValueError: If the sale is malformed, archived, or its house has no listing it could sell or
+        an UNAVAILABLE one.
+    '''
+    malformed = _malformed(sale)
+    if malformed:
+        raise ValueError(malformed)
+    house_id, sell_date = sale.get('house_id'), sale.get('sell_date')
+    if sell_date is not None and sell_date.year in archived:
+        raise ValueError(f"The sales of {sell_date.year} are archived and cannot be changed.")
+    listing = _listing_sold(listings.get(house_id, []), sell_date)
+    if listing is None:
+        raise ValueError(_unlisted(house_id, listings.get(house_id), sell_date))
+    if listing.listing_state == 'UNAVAILABLE':
         raise ValueError(f"House {house_id} is unavailable and cannot be sold.")
+    row = dict(sale, listing_id=listing.id, days_on_market=_days_between(listing.listing_date, sell_date),
+               agent_commissions=commissions.commission_for(sale.get('sale_price') or 0, tiers))
+    return row, listing
+
+
+def _record_sales(session, sale_ids, rows):
+    '''
+    Records the sales just inserted, in the transaction of the session, the same way for the ingestion
+    and the bulk loader: their listings are flipped to SOLD, the monthly rollups are incremented with one
+    statement per rollup table and range of ids, the sale price summary is incremented once by
+    their total, and the changes are appended to the change feed.
+
+    Args:
+        session (Session): The session that inserted the sales.
+        sale_ids (List[int]): The ids of the sales.
+        rows (List[dict]): The rows inserted, as returned by _resolve_sale.
+    '''
+    listing_ids = sorted({row['listing_id'] for row in rows})
+    for start in range(0, len(listing_ids), MAX_IDS):
+        session.execute(update(Listing).where(Listing.id.in_(listing_ids[start:start + MAX_IDS])).values(
+            listing_state='SOLD'))
+    amount = sum(row['sale_price'] for row in rows)
+    summary.add_sales(session, amount)
+    ranges = _id_ranges(sale_ids)
+    for index, (first, last) in enumerate(ranges):
+        new_sales = Sale.id.between(first, last)
+        rollups.add_sales(session, new_sales)
+        # the summary increment is appended once, after the last range of sales
+        changes.record_sales(session, select(Sale.id).where(new_sales), amount if index == len(ranges) - 1 else 0)
+
+
+def _id_ranges(ids):
+    '''
+    Returns the (first, last) ids of the runs of consecutive ids, a single run when the database
+    numbered the rows of a chunk one after the other.
+    '''
+    ranges = []
+    for id in sorted(ids):
+        if ranges and ranges[-1][1] == id - 1:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return [tuple(run) for run in ranges]
+
+
+def _listing_sold(listings, sell_date):
+    '''
+    Returns the listing a sale sold among the listings of its house, in id order: the latest one listed
+    on or before the sell date. None if the house has no listing, or was only listed after the sell date,
+    as the days on the market would be negative.
+    '''
+    sell_day = _day(sell_date)
+    listed = [listing for listing in listings if sell_day is None or _day(listing.listing_date) <= sell_day]
+    return max(listed, key=lambda listing: (listing.listing_date, listing.id)) if listed else None
+
+
+def _unlisted(house_id, listings, sell_date):
+    '''
+    Returns why a sale has no listing, see _listing_sold.
+    '''
+    if not listings:
+        return f"House {house_id} has no listing and cannot be sold."
+    return f"House {house_id} was not listed on or before {_day(sell_date)} and cannot be sold."
+
 
-    session.execute(insert(Sale), [sale])
-    session.query(Listing).filter(Listing.house_id == house_id).update(
-        {Listing.listing_state: 'SOLD'}, synchronize_session=False)
-    session.query(SalePriceSummary).filter(SalePriceSummary.id == 1).update(
-        {SalePriceSummary.total_sale: SalePriceSummary.total_sale + sale['sale_price']}, 
-        synchronize_session=False)
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _days_between(listing_date, sell_date):
+    if listing_date is None or sell_date is None:
+        return None
+    return (_day(sell_date) - _day(listing_date)).days
+
+
+def link_listings(session, condition=Sale.days_on_market.is_(None)):
+    '''
+    Resolves the listing and the days on the market of the sales recorded before they were stored with
+    the sale, with one UPDATE: the listing is chosen as for the new sales, see _listing_sold. The sales
+    of a house only listed after them are left without a listing. It is run once after the columns were
+    added to an existing database, before the rollups are rebuilt.
+
+    Args:
+        session (Session): The session used to update the sales.
+        condition (ColumnElement): The filter selecting the sales to update, those without days on the market by default.
+
+    Returns:
+        int: The number of sales updated.
+    '''
+    def listing_sold(column):
+        return select(column).where(
+            Listing.house_id == Sale.house_id, func.date(Listing.listing_date) <= func.date(Sale.sell_date)).order_by(
+            Listing.listing_date.desc(), Listing.id.desc()).limit(1).scalar_subquery()
+
+    updated = session.query(Sale).filter(condition).update({
+        Sale.listing_id: listing_sold(Listing.id),
+        Sale.days_on_market: cast(func.julianday(func.date(Sale.sell_date)) -
+                                  func.julianday(func.date(listing_sold(Listing.listing_date))), Integer),
+    }, synchronize_session=False)
     session.commit()
+    return updated
 
 
-sale = [
+SAMPLE_SALES = [
     {'buyer_id': 1,
     'sale_price': 597022, 
     'sell_date': datetime(2023, 8, 7), 
@@ -152,19 +318,107 @@ sale = [
     'agent_id': 2,'house_id': 6}
     ]
 
-for i in sale:
-    update_sales_info(i)
 
-session.commit()
+def seed(session=session):
+    '''
+    Fills an empty database with the sample customers, offices, agents, houses and listings,
+    then records the sample sales.
+
+    Args:
+        session (Session): The session used to write the data.
+
+    Returns:
+        List[tuple]: The (position, sale, reason) tuples of the sample sales that were rejected.
+    '''
+    session.add(Customer(firstName='Praise', lastName='Ogwuche', emailAddress='praiseogwuche@staple.com'))
+    session.add(Customer(firstName='Jane', lastName='Doe', emailAddress='jane.doe@example.com'))
+    session.add(Customer(firstName='Michael', lastName='Smith', emailAddress='michael.smith@example.com'))
+    session.add(Customer(firstName='Emma', lastName='Johnson', emailAddress='emma.johnson@cred.edu'))
+    session.add(Customer(firstName='Olivia', lastName='Williams', emailAddress='olivia1@greenshaw.com'))
+
+    session.add(Office(office_name= 'south san francisco'))
+    session.add(Office(office_name= 'san francisco'))
+    session.add(Office(office_name= 'san jose'))
+    session.add(Office(office_name= 'oakland'))
+    session.add(Office(office_name= 'santa clara'))
+    session.add(Office(office_name= 'sunnyvale'))
+    session.add(Office(office_name= 'san mateo'))
+    session.add(Office(office_name= 'berkeley'))
+
+    session.add(Agent(firstName='Wagwan', lastName='Shaw', emailAddress='wawanshaw@realtor.com'))
+    session.add(Agent(firstName='Stella', lastName='Knowles', emailAddress='stella@realtor.com'))
+    session.add(Agent(firstName='Blessing', lastName='Stay', emailAddress='blessing@realtor.com'))
+    session.add(Agent(firstName='Fie', lastName='Fie', emailAddress='fie@realtor.com'))
+    session.add(Agent(firstName='Ben', lastName='Foe', emailAddress='foe@finestreally.co')) 
+    session.add(Agent(firstName='Destiny', lastName='Freeman', emailAddress='freeman@finestreally.co'))
+
+    session.add(AgentOffice(office_id=1, agent_id=1))
+    session.add(AgentOffice(office_id=2, agent_id=2))
+    session.add(AgentOffice(office_id=3, agent_id=3))
+    session.add(AgentOffice(office_id=1, agent_id=4))
+    session.add(AgentOffice(office_id=5, agent_id=1))
+    session.add(AgentOffice(office_id=1, agent_id=1))
+    session.add(AgentOffice(office_id=6, agent_id=1))
+    session.add(AgentOffice(office_id=8, agent_id=4))
+    session.add(AgentOffice(office_id=4, agent_id=3))
+
+
+    session.add(House(no_of_bedrooms=3, no_of_bathrooms=3, address='1233 Market Street, San Francisco, CA', zip_code=94111, office = 3))
+    session.add(House(no_of_bedrooms=4, no_of_bathrooms=3, address='13 Fell Street, San Francisco, CA', zip_code=94110, office = 3))
+    session.add(House(no_of_bedrooms=2, no_of_bathrooms=2, address='16 Turk Street, San Jose, CA', zip_code=94102, office = 4))
+    session.add(House(no_of_bedrooms=3, no_of_bathrooms=2, address='1248 Market Street, Berkeley, CA', zip_code=12345, office = 2))
+    session.add(House(no_of_bedrooms=4, no_of_bathrooms=1, address='18 Powell Street, San Francisco, CA', zip_code=94111, office = 3))
+    session.add(House(no_of_bedrooms=3, no_of_bathrooms=1, address='1 Found Street, San Mateo, CA', zip_code=11010, office = 1))
+    session.add(House(no_of_bedrooms=4, no_of_bathrooms=2, address='1 Market Street, San Francisco, CA', zip_code=94110, office = 3))
+    session.add(House(no_of_bedrooms=6, no_of_bathrooms=6, address='34 Post Street, Santa Clara, CA', zip_code=76110, office = 5))
+
+    session.add(Listing(house_id=1, seller_id=1, listing_date=datetime(2022, 1, 1), 
+                        listing_agent_id=1, listing_office_id=1, listing_price=513467,
+                        listing_state='AVAILABLE'))
+    session.add(Listing(house_id=2, seller_id=2, listing_date=datetime(2022, 2, 5),
+                        listing_agent_id=2, listing_office_id=2, listing_price=1748361,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=3, seller_id=3, listing_date=datetime(2022, 3, 12),
+                        listing_agent_id=3, listing_office_id=3, listing_price=316942,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=4, seller_id=3, listing_date=datetime(2022, 4, 20),
+                        listing_agent_id=4, listing_office_id=4, listing_price=2216547,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=5, seller_id=1, listing_date=datetime(2022, 5, 25),
+                        listing_agent_id=2, listing_office_id=5, listing_price=4592805,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=6, seller_id=2, listing_date=datetime(2022, 6, 29),
+                        listing_agent_id=5, listing_office_id=6, listing_price=917103,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=7, seller_id=2, listing_date=datetime(2022, 7, 10),
+                        listing_agent_id=1, listing_office_id=7, listing_price=1289412,
+                        listing_state='AVAILABLE'))
+
+    session.add(Listing(house_id=8, seller_id=1, listing_date=datetime(2022, 8, 18),
+                        listing_agent_id=3, listing_office_id=8, listing_price=674512,
+                        listing_state='AVAILABLE'))
+
+    session.add(SalePriceSummary(total_sale=0))
+
+    for min_price, rate in commissions.DEFAULT_TIERS:
+        session.add(CommissionTier(min_price=min_price, rate=rate))
+
+    session.commit()
+
+    inserted, failures = ingest_sales(SAMPLE_SALES, session=session)
+    return failures
 
 
-print(session.query(Customer).all())
-print(session.query(Agent).all())
-print(session.query(Office).all())
-print(session.query(AgentOffice).all())
-print(session.query(House).all())
-print(session.query(Listing).all())
-print(session.query(Sale).all())
-print(session.query(SalePriceSummary).all())
+if __name__ == '__main__':
+    for position, rejected_sale, reason in seed(session):
+        print(f'Sale {position} was rejected: {reason}')
 
-#session.close()
\ No newline at end of file
+    # the tables are printed a row at a time, as they can be too large to be loaded at once
+    for model in [Customer, Agent, Office, AgentOffice, House, Listing, Sale, SalePriceSummary]:
+        for row in streaming.rows(session, model):
+            print(row)
@@ -0,0 +1,245 @@
+'''
+Opt-in instrumentation of the database statements, enabled per engine:
+
+    instrumentation.enable(engine, slow_ms=100)
+
+or for the engines of db with the instrument and slow_query_ms settings (DATABASE_INSTRUMENT=true).
+
+Every statement run on an instrumented engine is timed by the before_cursor_execute and
+after_cursor_execute events, and counted in a latency histogram keyed by the statement, with the
+parameters replaced by ?, and by the label of the code that ran it. The reports and the sale
+ingestion functions are labelled, other code can use the label() context manager. The statements
+slower than slow_ms are logged on the database.slow_queries logger, with their query plan. While
+enabled, the ORM flushes and commits are also counted per label, along with the calls of the labelled
+functions, so e.g. the commits per update_sales_info call are the commits over the calls.
+
+snapshot() returns the metrics as a dict, and exposition() in the Prometheus text format, which
+serve() publishes over HTTP for a local scraper.
+'''
+import contextlib
+import contextvars
+import functools
+import http.server
+import logging
+import re
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# the upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf')]
+DEFAULT_SLOW_MS = 100
+
+logger = logging.getLogger('database.slow_queries')
+
+_label = contextvars.ContextVar('label', default='')
+_lock = threading.Lock()
+_statements = {}  # (label, statement) -> [count, seconds, rows, bucket counts]
+_labels = {}  # label -> {'calls': ..., 'seconds': ..., 'flushes': ..., 'commits': ...}
+_slow_ms = {}  # engine -> threshold
+_EXPANDED = re.compile(r'\(\s*\?(\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+@contextlib.contextmanager
+def label(name):
+    '''
+    Labels the statements, flushes and commits run in the block, and counts the block as a call.
+    '''
+    token = _label.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _label.reset(token)
+        if _slow_ms:
+            with _lock:
+                counts = _counts(name)
+                counts['calls'] += 1
+                counts['seconds'] += time.perf_counter() - start
+
+
+def labelled(name):
+    '''
+    Decorates a function so that every call runs in label(name).
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with label(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _counts(name):
+    return _labels.setdefault(name, {'calls': 0, 'seconds': 0.0, 'flushes': 0, 'commits': 0})
+
+
+def _normalize(statement):
+    # the IN lists expanded by SQLAlchemy have one ? per value, they are folded so that the statement
+    # is counted once whatever the number of values
+    return _EXPANDED.sub('(?, ...)', _SPACES.sub(' ', statement).strip())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['instrumentation_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['instrumentation_start']
+    # the rows written, the rows read by a SELECT are not known until they are fetched
+    rows = len(parameters) if executemany else max(cursor.rowcount, 0)
+    key = (_label.get(), _normalize(statement))
+    with _lock:
+        entry = _statements.get(key)
+        if entry is None:
+            entry = _statements[key] = [0, 0.0, 0, [0] * len(BUCKETS)]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += rows
+        entry[3][next(index for index, bound in enumerate(BUCKETS) if elapsed <= bound)] += 1
+    slow_ms = _slow_ms.get(conn.engine)
+    if slow_ms is not None and elapsed * 1000 >= slow_ms:
+        logger.warning('Slow query (%.1f ms, label %r): %s\nParameters: %r\nQuery plan:\n%s', elapsed * 1000, key[0],
+                       statement, parameters, '\n'.join(_explain(conn, cursor, statement, parameters, executemany)))
+
+
+def _explain(conn, cursor, statement, parameters, executemany):
+    prefix = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN '}.get(conn.dialect.name)
+    if prefix is None or executemany or not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE')):
+        return ['  (not available)']
+    # on a cursor of its own, the rows of the statement are not fetched yet
+    explain = cursor.connection.cursor()
+    try:
+        explain.execute(prefix + statement, parameters)
+        return ['  ' + ' '.join(str(value) for value in row) for row in explain.fetchall()]
+    except Exception as e:
+        return [f'  (failed: {e})']
+    finally:
+        explain.close()
+
+
+def _after_flush(session, flush_context):
+    with _lock:
+        _counts(_label.get())['flushes'] += 1
+
+
+def _after_commit(session):
+    with _lock:
+        _counts(_label.get())['commits'] += 1
+
+
+def enable(bind, slow_ms=DEFAULT_SLOW_MS):
+    '''
+    Starts instrumenting the statements of an engine, and the ORM flushes and commits of every session.
+
+    Args:
+        bind (Engine): The engine to instrument.
+        slow_ms (float): The duration from which a statement is logged as slow, in milliseconds, or None
+            to log none.
+    '''
+    if bind not in _slow_ms:
+        event.listen(bind, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(bind, 'after_cursor_execute', _after_cursor_execute)
+    if not _slow_ms:
+        event.listen(Session, 'after_flush', _after_flush)
+        event.listen(Session, 'after_commit', _after_commit)
+    _slow_ms[bind] = slow_ms
+
+
+def disable(bind):
+    '''
+    Stops instrumenting an engine. The metrics recorded so far are kept.
+    '''
+    if bind not in _slow_ms:
+        return
+    del _slow_ms[bind]
+    event.remove(bind, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(bind, 'after_cursor_execute', _after_cursor_execute)
+    if not _slow_ms:
+        event.remove(Session, 'after_flush', _after_flush)
+        event.remove(Session, 'after_commit', _after_commit)
+
+
+def reset():
+    '''
+    Drops the metrics recorded so far.
+    '''
+    with _lock:
+        _statements.clear()
+        _labels.clear()
+
+
+def snapshot():
+    '''
+    Returns the metrics recorded so far.
+
+    Returns:
+        dict: Under 'statements', a list of dicts with the label, the statement, the count, the total
+        seconds, the rows written and the count of each latency bucket by upper bound. Under 'labels',
+        the calls, seconds, flushes and commits by label.
+    '''
+    with _lock:
+        statements = [{'label': key[0], 'statement': key[1], 'count': count, 'seconds': seconds, 'rows': rows,
+                       'buckets': dict(zip(BUCKETS, buckets))}
+                      for key, (count, seconds, rows, buckets) in sorted(_statements.items())]
+        return {'statements': statements, 'labels': {name: dict(counts) for name, counts in sorted(_labels.items())}}
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def exposition():
+    '''
+    Returns the metrics recorded so far in the Prometheus text exposition format.
+    '''
+    metrics = snapshot()
+    lines = ['# HELP db_statement_duration_seconds The latency of the database statements.',
+             '# TYPE db_statement_duration_seconds histogram']
+    for entry in metrics['statements']:
+        labels = f'label="{_escape(entry["label"])}",statement="{_escape(entry["statement"])}"'
+        cumulative = 0
+        for bound, count in entry['buckets'].items():
+            cumulative += count
+            lines.append(f'db_statement_duration_seconds_bucket{{{labels},le="{"+Inf" if bound == float("inf") else bound}"}} '
+                         f'{cumulative}')
+        lines.append(f'db_statement_duration_seconds_sum{{{labels}}} {entry["seconds"]}')
+        lines.append(f'db_statement_duration_seconds_count{{{labels}}} {entry["count"]}')
+    lines += ['# HELP db_statement_rows_total The rows written by the database statements.',
+              '# TYPE db_statement_rows_total counter']
+    lines += [f'db_statement_rows_total{{label="{_escape(entry["label"])}",statement="{_escape(entry["statement"])}"}} '
+              f'{entry["rows"]}' for entry in metrics['statements']]
+    for name, help in [('calls', 'The calls of the labelled functions.'), ('seconds', 'The time spent in the labelled functions.'),
+                       ('flushes', 'The ORM flushes, by label.'), ('commits', 'The ORM commits, by label.')]:
+        lines += [f'# HELP db_label_{name}_total {help}', f'# TYPE db_label_{name}_total counter']
+        lines += [f'db_label_{name}_total{{label="{_escape(label_name)}"}} {counts[name]}'
+                  for label_name, counts in metrics['labels'].items()]
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9464, host='127.0.0.1'):
+    '''
+    Publishes exposition() over HTTP, from a daemon thread, for a local scraper.
+
+    Returns:
+        ThreadingHTTPServer: The server, whose shutdown() method stops it.
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,250 @@
+'''
+Live leaderboards of the agents and offices who sold the most, for the sales floor screens, which
+poll the top agents and offices of the current month and year far more often than the reports run.
+
+A Leaderboard loads the total sold by every agent and office in its periods once from the monthly
+rollups, then keeps them up to date from the ingestion: insert_data adds the sales of every chunk it
+commits to the leaderboard of its database, if one was started. Each ranking keeps its capacity
+best entries in order next to the totals, so top_agents(period, k) and top_offices(period, k) return
+the first k without touching the database. The ingestion only increases the totals, and an entry
+outside the ranking only enters it when its own total increases, so the ranking stays exact; a
+larger k is answered from the totals.
+
+    board = leaderboard.start(engine)
+    board.top_agents(Period.month(2023, 1), 5)
+
+The sales written by another process, by the bulk loader, or removed from the database are only
+seen when the leaderboard is reconciled: its totals are reloaded from the rollups every interval
+seconds by a background thread, and right away by reconcile(bind). The reload reads the sequence
+number of the change feed in the same transaction, and the chunks committed before it are not
+added twice. Without fixed periods, the leaderboard follows the current month and year, which
+change on the first reconciliation after the month does.
+'''
+import heapq
+import logging
+import threading
+import time
+import weakref
+from bisect import insort
+from collections import namedtuple
+from datetime import date
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from create import AgentMonthlySales, OfficeMonthlySales, SaleChange
+from period import Period
+
+DEFAULT_CAPACITY = 20
+DEFAULT_INTERVAL = 60  # in seconds
+
+logger = logging.getLogger('database.leaderboard')
+
+AgentTotal = namedtuple('AgentTotal', ['agent_id', 'amount_sold'])
+OfficeTotal = namedtuple('OfficeTotal', ['office_id', 'office_sale'])
+
+
+def live_periods(today=None):
+    '''
+    Returns the periods of the current month and of the current year.
+    '''
+    today = today or date.today()
+    return [Period.month(today.year, today.month), Period.year(today.year)]
+
+
+class _Ranking:
+    '''
+    The totals of one measure by id, and the capacity best of them ordered by decreasing total, then id.
+    '''
+
+    def __init__(self, totals, capacity):
+        self.totals = totals
+        self.capacity = capacity
+        self.best = sorted((-total, id) for id, total in totals.items())[:capacity]
+        self._ranked = {id for _, id in self.best}
+
+    def add(self, id, amount):
+        old = self.totals.get(id, 0)
+        new = self.totals[id] = old + amount
+        if id in self._ranked:
+            self.best.remove((-old, id))
+            insort(self.best, (-new, id))
+        elif len(self.best) < self.capacity or (-new, id) < self.best[-1]:
+            insort(self.best, (-new, id))
+            self._ranked.add(id)
+            if len(self.best) > self.capacity:
+                self._ranked.discard(self.best.pop()[1])
+
+    def top(self, k):
+        best = self.best[:k] if k <= self.capacity else heapq.nsmallest(
+            k, ((-total, id) for id, total in self.totals.items()))
+        return [(id, -total) for total, id in best]
+
+
+class Leaderboard:
+    '''
+    The Leaderboard class holds the running totals of the agents and offices of a database, per period.
+
+    Attributes:
+        periods (List[Period]): The fixed periods ranked, None to follow the current month and year.
+        capacity (int): The number of entries kept in order per ranking.
+        seq (int): The sequence number of the change feed the totals were last reloaded at.
+        reconciled (float): The time.monotonic() of the last reload.
+
+    Methods:
+        reconcile(session): Reloads the totals from the rollups.
+        add_sales(sales, seq): Adds committed sales to the totals.
+        top_agents(period, k): Returns the k agents who sold the most in a period.
+        top_offices(period, k): Returns the k offices with the most sales in a period.
+    '''
+
+    def __init__(self, periods=None, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1.")
+        self.periods = periods
+        self.capacity = capacity
+        self.seq = 0
+        self.reconciled = None
+        self._rankings = {}  # period -> (agents ranking, offices ranking)
+        self._replayed = None  # the (sales, seq) added while a reload runs
+        self._lock = threading.Lock()
+        self._reloading = threading.Lock()
+        self._stopped = threading.Event()
+
+    def reconcile(self, session):
+        '''
+        Reloads the totals of the periods from the monthly rollups, in the transaction of the session, which
+        must not hold uncommitted sales.
+        '''
+        with self._reloading:  # the background thread and reconcile(bind) may reload at once
+            periods = self.periods or live_periods()
+            with self._lock:
+                self._replayed = []
+            try:
+                seq = session.execute(select(func.coalesce(func.max(SaleChange.seq), 0))).scalar_one()
+                rankings = {}
+                for period in periods:
+                    totals = [dict(session.execute(
+                        select(model.__table__.c[key], func.sum(model.total_sale_price)).where(
+                            period.filter_months(model.year, model.month)).group_by(model.__table__.c[key])).all())
+                        for model, key in [(AgentMonthlySales, 'agent_id'), (OfficeMonthlySales, 'office_id')]]
+                    rankings[period] = tuple(_Ranking(measure, self.capacity) for measure in totals)
+            except BaseException:
+                with self._lock:
+                    self._replayed = None
+                raise
+            with self._lock:
+                # the chunks committed after the reload read the feed were added to the old totals only
+                replayed, self._replayed = self._replayed, None
+                self._rankings, self.seq, self.reconciled = rankings, seq, time.monotonic()
+                for sales, sales_seq in replayed:
+                    if sales_seq is None or sales_seq > seq:
+                        self._add(sales)
+
+    def add_sales(self, sales, seq=None):
+        '''
+        Adds committed sales to the totals of the periods they fall in.
+
+        Args:
+            sales (Iterable[tuple]): The (sell_date, agent_id, office_id, sale_price) of the sales.
+            seq (int): The sequence number of the last change the sales appended to the feed; the sales
+                are skipped if the totals were reloaded after it.
+        '''
+        sales = list(sales)
+        with self._lock:
+            if seq is not None and seq <= self.seq:
+                return
+            if self._replayed is not None:
+                self._replayed.append((sales, seq))
+            self._add(sales)
+
+    def _add(self, sales):
+        for period, (agents, offices) in self._rankings.items():
+            for sell_date, agent_id, office_id, sale_price in sales:
+                if sell_date in period:
+                    if agent_id is not None:
+                        agents.add(agent_id, sale_price)
+                    if office_id is not None:
+                        offices.add(office_id, sale_price)
+
+    def _rankings_of(self, period):
+        rankings = self._rankings.get(period)
+        if rankings is None:
+            raise ValueError(f"{period!r} is not ranked by the leaderboard.")
+        return rankings
+
+    def top_agents(self, period, k=5):
+        '''
+        Returns the (agent_id, amount_sold) rows of the k agents who sold the most in a period, best first.
+        '''
+        with self._lock:
+            return [AgentTotal(*row) for row in self._rankings_of(period)[0].top(k)]
+
+    def top_offices(self, period, k=5):
+        '''
+        Returns the (office_id, office_sale) rows of the k offices with the most sales in a period, best first.
+        '''
+        with self._lock:
+            return [OfficeTotal(*row) for row in self._rankings_of(period)[1].top(k)]
+
+    def _run(self, bind, interval):
+        while not self._stopped.wait(interval):
+            try:
+                with Session(bind) as session:
+                    self.reconcile(session)
+            except SQLAlchemyError as e:
+                logger.warning('leaderboard reconciliation failed: %s', e)
+
+
+_boards = weakref.WeakKeyDictionary()
+
+
+def start(bind, periods=None, capacity=DEFAULT_CAPACITY, interval=DEFAULT_INTERVAL):
+    '''
+    Loads the leaderboard of the database of an engine and registers it, so that the ingestion adds
+    to it, replacing the one started before.
+
+    Args:
+        bind (Engine): The engine of the database.
+        periods (List[Period]): The periods to rank, made of whole months, by default the current month and year.
+        capacity (int): The number of entries kept in order per ranking, the largest k answered in O(k).
+        interval (float): The number of seconds between reconciliations, None to only reconcile on demand.
+
+    Returns:
+        Leaderboard: The loaded leaderboard.
+    '''
+    bind = bind.engine
+    board = Leaderboard(periods, capacity)
+    with Session(bind) as session:
+        board.reconcile(session)
+    stop(bind)
+    _boards[bind] = board
+    if interval:
+        threading.Thread(target=board._run, args=(bind, interval), name='leaderboard', daemon=True).start()
+    return board
+
+
+def board_for(bind):
+    '''
+    Returns the leaderboard of the database of an engine (or connection), None if none was started.
+    '''
+    return _boards.get(bind.engine)
+
+
+def stop(bind):
+    '''
+    Stops the leaderboard of the database of an engine: the ingestion no longer adds to it.
+    '''
+    board = _boards.pop(bind.engine, None)
+    if board is not None:
+        board._stopped.set()
+
+
+def reconcile(bind):
+    '''
+    Reloads the leaderboard of the database of an engine, if one was started, after a write that did
+    not go through the ingestion.
+    '''
+    board = board_for(bind)
+    if board is not None:
+        with Session(bind.engine) as session:
+            board.reconcile(session)
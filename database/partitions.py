@@ -0,0 +1,149 @@
+'''
+Yearly partitions of the sales on SQLite: the sales of a closed year, and the SOLD listings they
+sold, are moved out of the main database into a file of their own, sales_<year>.db, so that the
+tables, their indexes and the page cache of the main database only hold the current years.
+
+    python3 cli.py archive --year 2019 --folder archive
+
+The archived years are registered in sales_partitions. route() is the query router of the statements
+reading the sales rows: given the period they read, it ATTACHes the archive files of the years
+overlapping the period to the connection, and rewrites the statement to read the UNION ALL of the
+main sales table and of theirs. A statement on the current period is returned unchanged, and only
+reads the main database. The reports are not routed: they read the monthly rollups, which stay in
+the main database, including the rows of the archived years.
+
+An archived year is closed: the ingestion rejects its sales, and the rollups and the commissions of
+its months are no longer recomputed from the sales (rollups.backfill and commissions.recompute leave
+them as they are). SQLite attaches at most 10 databases to a connection by default, so a statement
+can read at most 9 archived years.
+
+Other databases would use native partitioning of the sales table by sell_date instead, which is not
+implemented: archive() needs a SQLite file database.
+'''
+import os
+from datetime import date
+from sqlalchemy import Column, Index, MetaData, Table, delete, func, insert, select, union_all
+from sqlalchemy.sql.util import ClauseAdapter
+from create import Listing, Sale, SalesPartition
+
+
+def _schema(year):
+    return f'sales_{year}'
+
+
+def _archive_tables(year):
+    '''
+    Returns the (sales, listings) tables of the archive of a year, in the schema it is attached as.
+    The foreign keys are left out, as the tables they reference are in the main database.
+    '''
+    metadata = MetaData(schema=_schema(year))
+    sales = Table('sales', metadata, *[Column(column.name, column.type, primary_key=column.primary_key)
+                                       for column in Sale.__table__.columns])
+    Index('ix_sales_sell_date_price', sales.c.sell_date, sales.c.sale_price)
+    listings = Table('listings', metadata, *[Column(column.name, column.type, primary_key=column.primary_key)
+                                             for column in Listing.__table__.columns])
+    return sales, listings
+
+
+def _overlaps(year, period):
+    return period is None or (period.start < date(year + 1, 1, 1) and period.end > date(year, 1, 1))
+
+
+def _attach(connection, year, path):
+    # ATTACH is per connection: the archives are attached lazily, the first time a connection reads them
+    attached = connection.info.setdefault('sales_partitions', set())
+    if year not in attached:
+        connection.exec_driver_sql(f'ATTACH DATABASE ? AS {_schema(year)}', (path,))
+        attached.add(year)
+
+
+def archived_years(session):
+    '''
+    Returns the archived years, oldest first.
+    '''
+    return session.execute(select(SalesPartition.year).order_by(SalesPartition.year)).scalars().all()
+
+
+def route(connection, statement, period=None):
+    '''
+    Returns a statement reading the sales table rewritten to read the archived sales of the period too.
+
+    Args:
+        connection (Connection): The connection the statement will run on, to which the archives are
+            attached (session.connection() for a Session).
+        statement (Select): A statement reading Sale.
+        period (Period): The period of the sales the statement reads, None for every year.
+
+    Returns:
+        Select: The statement reading the UNION ALL of the sales of the main database and of the archives
+        overlapping the period, or the statement itself if there are none.
+    '''
+    partitions = [(year, path) for year, path in connection.execute(
+        select(SalesPartition.year, SalesPartition.path).order_by(SalesPartition.year)) if _overlaps(year, period)]
+    if not partitions:
+        return statement
+    for year, path in partitions:
+        _attach(connection, year, path)
+    parts = [Sale.__table__] + [_archive_tables(year)[0] for year, _ in partitions]
+    sales = union_all(*[select(*[part.c[column.name] for column in Sale.__table__.columns]) for part in parts]).subquery(
+        'sales')
+    return ClauseAdapter(sales).traverse(statement)
+
+
+def archive(session, year, folder, compact=True):
+    '''
+    Moves the sales sold in a closed year, and the SOLD listings only they reference, from the main
+    database into the file sales_<year>.db of a folder, and registers the partition.
+
+    The rows are first copied to the archive file and committed there, then deleted from the main
+    database with the registration, in a second transaction: if the archiving stops in between, the
+    sales are still in the main database, and archiving the year again starts over.
+
+    Args:
+        session (Session): A session on a SQLite file database.
+        year (int): The year to archive, which must be over.
+        folder (str): The folder of the archive files.
+        compact (bool): Whether to VACUUM the main database afterwards, to give the freed pages back.
+
+    Returns:
+        SalesPartition: The registered partition.
+    '''
+    bind = session.get_bind()
+    if bind.dialect.name != 'sqlite' or bind.url.database in (None, '', ':memory:'):
+        raise ValueError("Archiving needs a SQLite file database.")
+    if date(year + 1, 1, 1) > date.today():
+        raise ValueError(f"{year} is not over and cannot be archived.")
+    if session.get(SalesPartition, year) is not None:
+        raise ValueError(f"{year} is already archived.")
+    session.commit()
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.abspath(os.path.join(folder, _schema(year) + '.db'))
+    if os.path.exists(path):
+        os.remove(path)  # left by an archiving that stopped before the registration
+    in_year = (Sale.sell_date >= date(year, 1, 1)) & (Sale.sell_date < date(year + 1, 1, 1))
+    # the listings sold by the sales of the year that no sale of another year references
+    listing_ids = select(Sale.listing_id).where(in_year, Sale.listing_id.is_not(None)).except_(
+        select(Sale.listing_id).where(~in_year, Sale.listing_id.is_not(None)))
+    sold_listings = (Listing.id.in_(listing_ids)) & (Listing.listing_state == 'SOLD')
+    sales, listings = _archive_tables(year)
+
+    with bind.connect() as connection:
+        _attach(connection, year, path)
+        sales.metadata.create_all(connection)
+        connection.commit()
+        with connection.begin():
+            connection.execute(insert(sales).from_select(
+                [column.name for column in Sale.__table__.columns], select(Sale.__table__).where(in_year)))
+            connection.execute(insert(listings).from_select(
+                [column.name for column in Listing.__table__.columns], select(Listing.__table__).where(sold_listings)))
+        with connection.begin():
+            connection.execute(delete(Listing).where(sold_listings))
+            connection.execute(delete(Sale).where(in_year))
+            sale_count, total = connection.execute(
+                select(func.count(), func.coalesce(func.sum(sales.c.sale_price), 0))).one()
+            connection.execute(insert(SalesPartition).values(year=year, path=path, sale_count=sale_count,
+                                                             total_sale_price=total))
+        if compact:
+            connection.exec_driver_sql('VACUUM')
+    return session.get(SalesPartition, year)
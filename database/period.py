@@ -0,0 +1,81 @@
+from datetime import date, datetime
+from sqlalchemy import and_, tuple_
+
+
+class Period:
+    '''
+    The Period class represents the time span a report is run for, as a half-open range of dates:
+    start is included and end is excluded. Filtering on such a range, rather than on the year and
+    month extracted from each date, lets the database use an index on the date column.
+
+    Attributes:
+        start (date): The first day of the period.
+        end (date): The first day after the period.
+
+    Methods:
+        month(year, month): The period of one calendar month.
+        quarter(year, quarter): The period of one calendar quarter, quarter going from 1 to 4.
+        year(year): The period of one calendar year.
+        between(start, end): The period from start (included) to end (excluded).
+        filter(column): The predicates that keep the rows whose column falls in the period.
+        filter_months(year_column, month_column): The same predicates for rows keyed by year and month,
+            like the monthly rollup tables. The period must be made of whole months.
+    '''
+
+    def __init__(self, start, end):
+        start, end = _as_date(start), _as_date(end)
+        if start >= end:
+            raise ValueError(f"A period must end after it starts, got {start} to {end}.")
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def month(cls, year, month):
+        if not 1 <= month <= 12:
+            raise ValueError(f"month must be between 1 and 12, got {month}.")
+        return cls(date(year, month, 1), _add_months(year, month, 1))
+
+    @classmethod
+    def quarter(cls, year, quarter):
+        if not 1 <= quarter <= 4:
+            raise ValueError(f"quarter must be between 1 and 4, got {quarter}.")
+        first_month = 3 * (quarter - 1) + 1
+        return cls(date(year, first_month, 1), _add_months(year, first_month, 3))
+
+    @classmethod
+    def year(cls, year):
+        return cls(date(year, 1, 1), date(year + 1, 1, 1))
+
+    @classmethod
+    def between(cls, start, end):
+        return cls(start, end)
+
+    def filter(self, column):
+        return and_(column >= self.start, column < self.end)
+
+    def filter_months(self, year_column, month_column):
+        if self.start.day != 1 or self.end.day != 1:
+            raise ValueError(f"{self!r} is not made of whole months.")
+        key = tuple_(year_column, month_column)
+        return and_(key >= tuple_(self.start.year, self.start.month), key < tuple_(self.end.year, self.end.month))
+
+    def __contains__(self, day):
+        return self.start <= _as_date(day) < self.end
+
+    def __eq__(self, other):
+        return isinstance(other, Period) and (self.start, self.end) == (other.start, other.end)
+
+    def __hash__(self):
+        return hash((self.start, self.end))
+
+    def __repr__(self):
+        return "<Period(start={0}, end={1})>".format(self.start, self.end)
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _add_months(year, month, months):
+    year, month = divmod(12 * year + month - 1 + months, 12)
+    return date(year, month + 1, 1)
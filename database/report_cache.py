@@ -0,0 +1,256 @@
+'''
+Result cache of the period reports.
+
+The results are cached per database, keyed by (report, period, limit), in an in-process LRU with a
+time to live, optionally backed by a SQLite file shared by every process (REPORT_CACHE_PATH, or the
+path argument of configure). The sale write path in insert_data invalidates the entries whose period
+contains a date it wrote, so the reports of closed months stay cached while the current month is
+recomputed after each write.
+
+Every invalidation bumps the generation of the cache, and of the on-disk tier. A report computed while
+an invalidation ran is not stored, as it may have read the rows from before the write. A process
+notices the invalidations of the others when the generation of the on-disk tier changed, which it
+checks at most every sync_interval seconds, and then drops its in-memory entries; the ones still valid
+are read back from the on-disk tier. The time to live bounds how stale an entry can get when the
+database is written by another process that does not share the on-disk tier.
+'''
+import functools
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import date
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 3600  # in seconds
+DEFAULT_SYNC_INTERVAL = 1  # in seconds
+
+
+class ReportCache:
+    '''
+    The ReportCache class holds the cached report results of one database.
+
+    Attributes:
+        max_entries (int): The number of entries kept in memory, the least recently used are evicted first.
+        ttl (float): The number of seconds an entry stays valid.
+        path (str): The SQLite file of the on-disk tier, or None to keep the entries in memory only.
+        namespace (str): What identifies the database in the on-disk tier, shared by several databases.
+        sync_interval (float): The number of seconds between two checks of the invalidations of the
+            other processes in the on-disk tier.
+        generation (int): The number of invalidations of the cache.
+
+    Methods:
+        get(key): Returns a (hit, value) tuple.
+        token(): Returns the generations to give put for a value computed from now on.
+        put(key, period, value, token): Caches the value of a report for a period.
+        invalidate(days): Drops the entries whose period contains one of the days.
+        clear(): Drops every entry.
+    '''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, path=None, namespace='',
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.namespace = namespace
+        self.sync_interval = sync_interval
+        self.generation = 0
+        self._entries = OrderedDict()  # key -> (expires, start, end, value), in memory
+        self._lock = threading.Lock()
+        self._disk_generation = None  # the generation of the on-disk tier the entries in memory are at
+        self._synced = None
+        if path:
+            with self._disk() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS report_cache (namespace TEXT, key TEXT, start TEXT, '
+                                   'end TEXT, expires REAL, value BLOB, PRIMARY KEY (namespace, key))')
+                connection.execute('CREATE TABLE IF NOT EXISTS report_cache_generations (namespace TEXT PRIMARY KEY, '
+                                   'generation INTEGER)')
+                self._disk_generation = self._read_generation(connection)
+            self._synced = time.monotonic()
+
+    def _disk(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _read_generation(self, connection):
+        row = connection.execute('SELECT generation FROM report_cache_generations WHERE namespace = ?',
+                                 (self.namespace,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def _sync(self):
+        # drops the entries in memory once another process invalidated the on-disk tier
+        if time.monotonic() < self._synced + self.sync_interval:
+            return
+        with self._disk() as connection:
+            generation = self._read_generation(connection)
+        with self._lock:
+            self._synced = time.monotonic()
+            if generation != self._disk_generation:
+                self._entries.clear()
+                self._disk_generation = generation
+
+    def get(self, key):
+        if self.path:
+            self._sync()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return True, entry[3]
+                del self._entries[key]
+        if self.path:
+            with self._disk() as connection:
+                row = connection.execute('SELECT expires, start, end, value FROM report_cache WHERE namespace = ? AND key = ?',
+                                         (self.namespace, repr(key))).fetchone()
+            if row is not None and row[0] > time.time():
+                value = pickle.loads(row[3])
+                self._remember(key, time.monotonic() + row[0] - time.time(), date.fromisoformat(row[1]),
+                               date.fromisoformat(row[2]), value)
+                return True, value
+        return False, None
+
+    def token(self):
+        '''
+        Returns the generations of the cache and of the on-disk tier, read before computing a value: put
+        does not store the value if either changed since.
+        '''
+        if not self.path:
+            return self.generation, None
+        with self._disk() as connection:
+            return self.generation, self._read_generation(connection)
+
+    def put(self, key, period, value, token=None):
+        if token is not None and token[0] != self.generation:
+            return
+        if self.path:
+            with self._disk() as connection:
+                stored = connection.execute(
+                    'INSERT OR REPLACE INTO report_cache SELECT ?, ?, ?, ?, ?, ? WHERE ? IS NULL OR ? = '
+                    'coalesce((SELECT generation FROM report_cache_generations WHERE namespace = ?), 0)',
+                    (self.namespace, repr(key), period.start.isoformat(), period.end.isoformat(),
+                     time.time() + self.ttl, pickle.dumps(value), token and token[1], token and token[1],
+                     self.namespace)).rowcount
+            if not stored:
+                return
+        self._remember(key, time.monotonic() + self.ttl, period.start, period.end, value, token)
+
+    def _remember(self, key, expires, start, end, value, token=None):
+        with self._lock:
+            if token is not None and token[0] != self.generation:
+                return  # invalidated while the value was stored on disk
+            self._entries[key] = (expires, start, end, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _bump(self, connection):
+        # bumps the generation of the on-disk tier, in the transaction dropping the entries
+        connection.execute('INSERT INTO report_cache_generations VALUES (?, 1) ON CONFLICT (namespace) '
+                           'DO UPDATE SET generation = generation + 1', (self.namespace,))
+        generation = self._read_generation(connection)
+        with self._lock:
+            if generation - 1 != self._disk_generation:
+                self._entries.clear()  # another process invalidated the tier since the last check
+            self._disk_generation = generation
+
+    def invalidate(self, days):
+        days = {day.date() if hasattr(day, 'date') else day for day in days}
+        if not days:
+            return
+        with self._lock:
+            self.generation += 1
+            for key, (_, start, end, _) in list(self._entries.items()):
+                if any(start <= day < end for day in days):
+                    del self._entries[key]
+        if self.path:
+            with self._disk() as connection:
+                connection.executemany('DELETE FROM report_cache WHERE namespace = ? AND start <= ? AND end > ?',
+                                       [(self.namespace, day.isoformat(), day.isoformat()) for day in days])
+                self._bump(connection)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+        if self.path:
+            with self._disk() as connection:
+                connection.execute('DELETE FROM report_cache WHERE namespace = ?', (self.namespace,))
+                self._bump(connection)
+
+
+_settings = {'max_entries': DEFAULT_MAX_ENTRIES, 'ttl': DEFAULT_TTL, 'path': os.environ.get('REPORT_CACHE_PATH'),
+             'sync_interval': DEFAULT_SYNC_INTERVAL}
+_caches = weakref.WeakKeyDictionary()
+
+
+def configure(max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, path=None, sync_interval=DEFAULT_SYNC_INTERVAL):
+    '''
+    Sets the settings of the caches, and drops the caches created with the previous settings.
+    '''
+    _settings.update(max_entries=max_entries, ttl=ttl, path=path, sync_interval=sync_interval)
+    _caches.clear()
+
+
+def cache_for(bind):
+    '''
+    Returns the cache of the database of an engine (or connection), creating it on first use.
+    '''
+    bind = bind.engine
+    cache = _caches.get(bind)
+    if cache is None:
+        # an in-memory database is private to its engine, so it must not share the on-disk tier
+        path = _settings['path'] if bind.url.database not in (None, '', ':memory:') else None
+        cache = _caches[bind] = ReportCache(_settings['max_entries'], _settings['ttl'], path,
+                                            bind.url.render_as_string(hide_password=True), _settings['sync_interval'])
+    return cache
+
+
+def invalidate(bind, days):
+    '''
+    Drops the cached results of the periods containing one of the days, for the database of an engine.
+    '''
+    bind = bind.engine
+    cache = _caches.get(bind)
+    if cache is not None or _settings['path']:
+        cache_for(bind).invalidate(days)
+
+
+def clear(bind):
+    '''
+    Drops every cached result of the database of an engine.
+    '''
+    bind = bind.engine
+    cache = _caches.get(bind)
+    if cache is not None or _settings['path']:
+        cache_for(bind).clear()
+
+
+def cached(report):
+    '''
+    Decorates a report function taking (session, period, ...) so that its results are cached, keyed by
+    the name of the report, the period and the other arguments.
+    '''
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(session, period, *args, **kwargs):
+            arguments = signature.bind(session, period, *args, **kwargs)
+            arguments.apply_defaults()
+            key = (report, period.start, period.end) + tuple(arguments.arguments.values())[2:]
+            cache = cache_for(session.get_bind())
+            hit, value = cache.get(key)
+            if not hit:
+                # the generations are read first: a write committed while the report runs skips the put
+                token = cache.token()
+                value = function(session, period, *args, **kwargs)
+                cache.put(key, period, value, token)
+            return value
+        return wrapper
+    return decorate
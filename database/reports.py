@@ -0,0 +1,222 @@
+'''
+The monthly reports as functions of a Period, for the dashboard and the report scripts.
+
+Each report is a lambda statement: SQLAlchemy builds and compiles it once, caches it under the code of
+the lambda, and later calls only bind the new period and limit as parameters, skipping the Python-side
+construction and the compilation. The rows are returned as plain tuples, without ORM entities.
+The rollups are aggregated on bare ids, and the few rows returned are decorated with the names of the
+offices and agents from the dimensions cache, rather than joining their tables. The results
+themselves are cached by report_cache until a write touches their period.
+
+The reports of a period made of whole months read the monthly rollups. Any other period, e.g. from the
+10th to the 25th, falls back to a plain statement aggregating the sales of the period filtered on
+their sell date, with the same results as the rollups would give; it reads the archived sales of the
+years it overlaps too, see partitions.route.
+'''
+from collections import namedtuple
+from sqlalchemy import func, lambda_stmt, select, tuple_
+from instrumentation import labelled
+from report_cache import cached
+import dimensions
+import partitions
+from create import AgentCommission, House, OfficeMonthlySales, AgentMonthlySales, Sale, ZipMonthlySales
+
+# the rows of the reports decorated from the dimensions cache
+OfficeSale = namedtuple('OfficeSale', ['office_name', 'office_sale'])
+AgentSale = namedtuple('AgentSale', ['firstName', 'lastName', 'emailAddress', 'amount_sold'])
+OfficeSummary = namedtuple('OfficeSummary', ['sale_count', 'total_sale_price', 'total_commission', 'avg_days_on_market'])
+
+
+def _report(name):
+    # the result is cached, and the statements run on a cache miss are labelled with the report name
+    def decorate(function):
+        return cached(name)(labelled(name)(function))
+    return decorate
+
+
+def _whole_months(period):
+    return period.start.day == 1 and period.end.day == 1
+
+
+def _months(period):
+    '''
+    Returns the (first year, first month, end year, end month) of a period made of whole months,
+    the end month being excluded.
+    '''
+    if not _whole_months(period):
+        raise ValueError(f"{period!r} is not made of whole months.")
+    return period.start.year, period.start.month, period.end.year, period.end.month
+
+
+def _sales_of(period, *columns):
+    '''
+    Returns the SELECT of columns over the sales of a period that is not made of whole months, outer
+    joined to their house like in rollups.add_sales, for the reports that cannot read the monthly rollups.
+    '''
+    return select(*columns).select_from(Sale).outerjoin(House, House.id == Sale.house_id).where(
+        period.filter(Sale.sell_date))
+
+
+def _execute(session, statement, period):
+    '''
+    Runs the statement of a report, with the archived sales of the period when it reads the sales.
+    '''
+    if not _whole_months(period):
+        statement = partitions.route(session.connection(), statement, period)
+    return session.execute(statement)
+
+
+def top_offices_statement(period, limit=5):
+    if not _whole_months(period):
+        return _sales_of(period, House.office.label('office_id'), func.sum(Sale.sale_price).label('office_sale')).where(
+            House.office.is_not(None)).group_by(House.office).order_by(func.sum(Sale.sale_price).desc()).limit(limit)
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        OfficeMonthlySales.office_id, func.sum(OfficeMonthlySales.total_sale_price).label('office_sale')).where(
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) < tuple_(end_year, end_month)).group_by(
+        OfficeMonthlySales.office_id).order_by(func.sum(OfficeMonthlySales.total_sale_price).desc()).limit(limit))
+
+
+def top_agents_statement(period, limit=5):
+    if not _whole_months(period):
+        return _sales_of(period, Sale.agent_id, func.sum(Sale.sale_price).label('amount_sold')).where(
+            Sale.agent_id.is_not(None)).group_by(Sale.agent_id).order_by(func.sum(Sale.sale_price).desc()).limit(limit)
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        AgentMonthlySales.agent_id, func.sum(AgentMonthlySales.total_sale_price).label('amount_sold')).where(
+        tuple_(AgentMonthlySales.year, AgentMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(AgentMonthlySales.year, AgentMonthlySales.month) < tuple_(end_year, end_month)).group_by(
+        AgentMonthlySales.agent_id).order_by(func.sum(AgentMonthlySales.total_sale_price).desc()).limit(limit))
+
+
+def agent_commissions_statement(period):
+    if not _whole_months(period):
+        # the commission job writes whole months: the commissions of the other periods are summed from the sales
+        return _sales_of(period, Sale.agent_id, func.coalesce(func.sum(Sale.agent_commissions), 0).label(
+            'monthly_commission')).where(Sale.agent_id.is_not(None)).group_by(Sale.agent_id).order_by(Sale.agent_id)
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        AgentCommission.agent_id, func.sum(AgentCommission.monthly_commission).label('monthly_commission')).where(
+        tuple_(AgentCommission.year, AgentCommission.month) >= tuple_(start_year, start_month),
+        tuple_(AgentCommission.year, AgentCommission.month) < tuple_(end_year, end_month)).group_by(
+        AgentCommission.agent_id).order_by(AgentCommission.agent_id))
+
+
+def avg_days_on_market_statement(period):
+    if not _whole_months(period):
+        return _sales_of(period, 1.0 * func.sum(Sale.days_on_market) / func.count(Sale.days_on_market)).where(
+            House.office.is_not(None))
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        1.0 * func.sum(OfficeMonthlySales.total_days_on_market) / func.sum(OfficeMonthlySales.days_on_market_count)).where(
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) < tuple_(end_year, end_month)))
+
+
+def avg_sale_price_statement(period):
+    if not _whole_months(period):
+        return _sales_of(period, 1.0 * func.sum(Sale.sale_price) / func.count(Sale.id)).where(House.office.is_not(None))
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        1.0 * func.sum(OfficeMonthlySales.total_sale_price) / func.sum(OfficeMonthlySales.sale_count)).where(
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) < tuple_(end_year, end_month)))
+
+
+def top_zip_codes_statement(period, limit=5):
+    if not _whole_months(period):
+        return _sales_of(period, House.zip_code, (1.0 * func.sum(Sale.sale_price) / func.count(Sale.id)).label(
+            'avg_price')).where(House.zip_code.is_not(None)).group_by(House.zip_code).order_by(
+            (1.0 * func.sum(Sale.sale_price) / func.count(Sale.id)).desc()).limit(limit)
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        ZipMonthlySales.zip_code,
+        (1.0 * func.sum(ZipMonthlySales.total_sale_price) / func.sum(ZipMonthlySales.sale_count)).label('avg_price')).where(
+        tuple_(ZipMonthlySales.year, ZipMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(ZipMonthlySales.year, ZipMonthlySales.month) < tuple_(end_year, end_month)).group_by(
+        ZipMonthlySales.zip_code).order_by(
+        (1.0 * func.sum(ZipMonthlySales.total_sale_price) / func.sum(ZipMonthlySales.sale_count)).desc()).limit(limit))
+
+
+def office_sales_statement(period, office_id):
+    if not _whole_months(period):
+        return _sales_of(
+            period, func.count(Sale.id), func.coalesce(func.sum(Sale.sale_price), 0),
+            func.coalesce(func.sum(Sale.agent_commissions), 0),
+            1.0 * func.sum(Sale.days_on_market) / func.count(Sale.days_on_market)).where(House.office == office_id)
+    start_year, start_month, end_year, end_month = _months(period)
+    return lambda_stmt(lambda: select(
+        func.coalesce(func.sum(OfficeMonthlySales.sale_count), 0),
+        func.coalesce(func.sum(OfficeMonthlySales.total_sale_price), 0),
+        func.coalesce(func.sum(OfficeMonthlySales.total_commission), 0),
+        1.0 * func.sum(OfficeMonthlySales.total_days_on_market) / func.sum(OfficeMonthlySales.days_on_market_count)).where(
+        OfficeMonthlySales.office_id == office_id,
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) >= tuple_(start_year, start_month),
+        tuple_(OfficeMonthlySales.year, OfficeMonthlySales.month) < tuple_(end_year, end_month)))
+
+
+@_report('top_offices')
+def top_offices(session, period, limit=5):
+    '''
+    Returns the (office_name, office_sale) rows of the offices with the most sales in the period, best first.
+    '''
+    rows = _execute(session, top_offices_statement(period, limit), period).all()
+    names = dimensions.offices(session, [office_id for office_id, _ in rows])
+    return [OfficeSale(names.get(office_id), office_sale) for office_id, office_sale in rows]
+
+
+@_report('top_agents')
+def top_agents(session, period, limit=5):
+    '''
+    Returns the (firstName, lastName, emailAddress, amount_sold) rows of the agents who sold the most
+    in the period, best first.
+    '''
+    rows = _execute(session, top_agents_statement(period, limit), period).all()
+    agents = dimensions.agents(session, [agent_id for agent_id, _ in rows])
+    return [AgentSale(*agents.get(agent_id, (None, None, None)), amount_sold) for agent_id, amount_sold in rows]
+
+
+@_report('agent_commissions')
+def agent_commissions(session, period):
+    '''
+    Returns the (agent_id, monthly_commission) rows of the commissions of the period, as written by the
+    commission job, by agent id. The commissions of a period not made of whole months are summed from
+    the commissions stored with its sales.
+    '''
+    return _execute(session, agent_commissions_statement(period), period).all()
+
+
+@_report('avg_days_on_market')
+def avg_days_on_market(session, period):
+    '''
+    Returns the average number of days the houses sold in the period were on the market, or None. The
+    sales without a known listing date are left out of the average.
+    '''
+    return _execute(session, avg_days_on_market_statement(period), period).scalar_one()
+
+
+@_report('avg_sale_price')
+def avg_sale_price(session, period):
+    '''
+    Returns the average selling price of the houses sold in the period, in cents, or None.
+    '''
+    return _execute(session, avg_sale_price_statement(period), period).scalar_one()
+
+
+@_report('top_zip_codes')
+def top_zip_codes(session, period, limit=5):
+    '''
+    Returns the (zip_code, avg_price) rows of the zip codes with the highest average selling price in the
+    period, best first.
+    '''
+    return _execute(session, top_zip_codes_statement(period, limit), period).all()
+
+
+@_report('office_sales')
+def office_sales(session, period, office_id):
+    '''
+    Returns the (sale_count, total_sale_price, total_commission, avg_days_on_market) of the sales of an
+    office in the period, the average being None without sales.
+    '''
+    return OfficeSummary(*_execute(session, office_sales_statement(period, office_id), period).one())
@@ -0,0 +1,72 @@
+from sqlalchemy import func, select, true
+from sqlalchemy.sql import extract
+from create import House, Sale, SalesPartition, OfficeMonthlySales, AgentMonthlySales, ZipMonthlySales
+from upsert import upsert
+import leaderboard
+import report_cache
+
+MEASURES = ['sale_count', 'total_sale_price', 'total_commission', 'total_days_on_market', 'days_on_market_count']
+
+
+def _rollup_sources():
+    '''
+    Returns a (model, key column, key expression) tuple per rollup table, the key expression being
+    evaluated on the sales outer joined to their house: a sale without a house row still counts for
+    its agent, only the rollups keyed by the house skip it.
+    '''
+    return [
+        (OfficeMonthlySales, 'office_id', House.office),
+        (AgentMonthlySales, 'agent_id', Sale.agent_id),
+        (ZipMonthlySales, 'zip_code', House.zip_code),
+    ]
+
+
+def add_sales(session, condition):
+    '''
+    Adds the sales matching condition to the monthly rollups, in the transaction of the session.
+    The sales are aggregated per month and key with one INSERT ... SELECT per rollup table, and the
+    totals are added to the existing rollup rows.
+
+    Args:
+        session (Session): The session that wrote the sales.
+        condition (ColumnElement): The filter selecting the sales to add, e.g. Sale.id.in_(new_ids).
+    '''
+    for model, key, expression in _rollup_sources():
+        aggregate = select(
+            extract('year', Sale.sell_date).label('year'),
+            extract('month', Sale.sell_date).label('month'),
+            expression.label(key),
+            func.count(Sale.id).label('sale_count'),
+            func.sum(Sale.sale_price).label('total_sale_price'),
+            func.coalesce(func.sum(Sale.agent_commissions), 0).label('total_commission'),
+            func.coalesce(func.sum(Sale.days_on_market), 0).label('total_days_on_market'),
+            func.count(Sale.days_on_market).label('days_on_market_count'),
+        ).outerjoin(House, House.id == Sale.house_id).where(condition, expression.is_not(None)).group_by(
+            'year', 'month', key)
+        upsert(session, model, ['year', 'month', key], aggregate, increment=MEASURES)
+
+
+def backfill(session, commit=True):
+    '''
+    Rebuilds the monthly rollups from the whole sales table, in one transaction. It is needed once
+    for a database whose sales were written before the rollups existed. The rollups of the archived
+    years are kept, as their sales are no longer in the sales table; those rolled up before the days on
+    the market were counted are assumed to have known the days of all their sales.
+
+    Args:
+        session (Session): The session used to rebuild the rollups.
+        commit (bool): Whether to commit, and then clear the cached reports and reconcile the
+            leaderboard. Without it, the rollups are rebuilt in the transaction of the caller, which
+            does both after its own commit.
+    '''
+    archived = session.execute(select(SalesPartition.year)).scalars().all()
+    for model, _, _ in _rollup_sources():
+        session.query(model).filter(model.year.not_in(archived)).delete(synchronize_session=False)
+        session.query(model).filter(model.days_on_market_count == 0, model.total_days_on_market > 0).update(
+            {model.days_on_market_count: model.sale_count}, synchronize_session=False)
+    add_sales(session, true())
+    if commit:
+        session.commit()
+        report_cache.clear(session.get_bind())
+        leaderboard.reconcile(session.get_bind())
+
@@ -0,0 +1,175 @@
+'''
+Parallel report runner, for the month-end close: every report for every month (or quarter, or year)
+of a range, and the sales of every office for every period, fanned out over a pool of processes or
+threads.
+
+    python3 cli.py run-reports --start 2019-01 --end 2023-12 --workers 8 --output close.json
+
+Each worker opens its own engine on the database with a single pooled connection, made read-only
+with PRAGMA query_only, so the workers only read, and with WAL they never wait for each other or for
+a writer. A task is one report for one period; the tasks are independent, so the run scales with the
+number of workers until the disk or the cores are saturated. The commission job must have run
+before, as the runner does not write.
+
+Every finished task is appended to a checkpoint file (the output with .partial appended) as one JSON
+line, after a first line holding the parameters of the run (the database and the limit of the top
+reports). Starting the same run again skips the tasks found in the checkpoint, so a run that failed or
+was interrupted resumes where it stopped; a checkpoint written with other parameters is started over.
+When every task is done, the results are merged into the output, ordered by report, period and office,
+and the checkpoint is removed.
+'''
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from db import load_config, make_engine
+from period import Period
+import reports
+
+REPORTS = ['top_offices', 'top_agents', 'agent_commissions', 'avg_days_on_market', 'avg_sale_price', 'top_zip_codes']
+# the reports taking the number of rows to return
+LIMITED = {'top_offices', 'top_agents', 'top_zip_codes'}
+# the reports run once per office, taking the office id
+OFFICE_REPORTS = ['office_sales']
+
+_worker = threading.local()
+
+
+def periods(start, end, granularity='month'):
+    '''
+    Returns the periods of a granularity ('month', 'quarter' or 'year') from the one containing start
+    to the one containing end, both included.
+
+    Args:
+        start (tuple): The (year, month) of the first period.
+        end (tuple): The (year, month) of the last period.
+        granularity (str): The length of the periods.
+    '''
+    months = {'month': 1, 'quarter': 3, 'year': 12}[granularity]
+    first = (12 * start[0] + start[1] - 1) // months * months
+    last = 12 * end[0] + end[1] - 1
+    return [_period(index, months) for index in range(first, last + 1, months)]
+
+
+def _period(index, months):
+    year, month = divmod(index, 12)
+    end_year, end_month = divmod(index + months, 12)
+    return Period(date(year, month + 1, 1), date(end_year, end_month + 1, 1))
+
+
+def report_tasks(periods, names=REPORTS, offices=(), office_names=OFFICE_REPORTS):
+    '''
+    Returns the (report name, Period, office id) task of every report for every period, the office id
+    being None, and of every office report for every period and office.
+    '''
+    return [(name, period, None) for name in names for period in periods] + [
+        (name, period, office_id) for name in office_names for period in periods for office_id in offices]
+
+
+def task_key(report, period, office_id=None):
+    key = f'{report} {period.start.isoformat()}/{period.end.isoformat()}'
+    return key if office_id is None else f'{key} office {office_id}'
+
+
+def _init_worker(url, config):
+    engine = make_engine(url, dict(config, pool_size=1, max_overflow=0))
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def read_only(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA query_only=ON')
+    _worker.session = Session(engine)
+
+
+def _run_task(report, start, end, limit, office_id):
+    period = Period(date.fromisoformat(start), date.fromisoformat(end))
+    arguments = (office_id,) if office_id is not None else (limit,) if report in LIMITED else ()
+    result = getattr(reports, report)(_worker.session, period, *arguments)
+    _worker.session.rollback()  # ends the read transaction, so that WAL checkpoints are not held back
+    if isinstance(result, tuple):
+        return list(result)
+    return [list(row) for row in result] if isinstance(result, list) else result
+
+
+def _read_checkpoint(path, parameters):
+    '''
+    Returns the results of the checkpoint of a run with the same parameters, by task key, and leaves
+    the file ready for appending the next ones.
+    '''
+    results = {}
+    if os.path.exists(path):
+        with open(path, 'r+') as file:
+            valid = 0
+            try:
+                same = json.loads(file.readline()).get('parameters') == parameters
+            except ValueError:
+                same = False
+            if same:
+                valid = file.tell()
+                for line in iter(file.readline, ''):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # the line being written when the run stopped
+                    results[entry['task']] = entry['result']
+                    valid = file.tell()
+            file.truncate(valid)
+            if not valid:
+                file.seek(0)
+                file.write(json.dumps({'parameters': parameters}) + '\n')
+    else:
+        with open(path, 'w') as file:
+            file.write(json.dumps({'parameters': parameters}) + '\n')
+    return results
+
+
+def run(url, tasks, output, workers=os.cpu_count(), threads=False, limit=5):
+    '''
+    Runs report tasks in parallel and merges their results into one JSON file, resuming from the
+    checkpoint of an earlier run of the same output if there is one.
+
+    Args:
+        url (str): The URL of the database, which must be a file for SQLite.
+        tasks (List[tuple]): The (report name, Period, office id) tasks to run, see report_tasks.
+        output (str): The JSON file the results are written to, by task key.
+        workers (int): The number of processes, or threads, running the tasks.
+        threads (bool): Whether to run the tasks in threads of this process rather than in processes.
+        limit (int): The number of rows of the top reports.
+
+    Returns:
+        dict: The result of every task, by task key (see task_key).
+    '''
+    if url.startswith('sqlite') and url.rstrip('/').endswith((':memory:', 'sqlite:')):
+        raise ValueError("The workers cannot share an in-memory database.")
+    checkpoint = output + '.partial'
+    results = _read_checkpoint(checkpoint, {'url': url, 'limit': limit})
+    pending = [task for task in tasks if task_key(*task) not in results]
+    if pending:
+        config = load_config()
+        pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+        with pool(workers, initializer=_init_worker, initargs=(url, config)) as executor, \
+                open(checkpoint, 'a') as file:
+            futures = {executor.submit(_run_task, report, period.start.isoformat(), period.end.isoformat(), limit,
+                                       office_id): task_key(report, period, office_id)
+                       for report, period, office_id in pending}
+            try:
+                for future in as_completed(futures):
+                    key = futures[future]
+                    results[key] = future.result()
+                    file.write(json.dumps({'task': key, 'result': results[key]}) + '\n')
+                    file.flush()
+            except BaseException:
+                # the finished tasks are in the checkpoint, the others are not worth waiting for
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    merged = {task_key(*task): results[task_key(*task)] for task in sorted(
+        tasks, key=lambda task: (task[0], task[1].start, task[2] or 0))}
+    with open(output + '.tmp', 'w') as file:
+        json.dump(merged, file, indent=1)
+    os.replace(output + '.tmp', output)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return merged
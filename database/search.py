@@ -0,0 +1,89 @@
+'''
+Search of the listings for sale, for the browse pages: the AVAILABLE listings filtered by price,
+bedrooms, bathrooms and zip codes, one page at a time.
+
+The pages are keyset-paginated: a page ends with a cursor, the (sort value, listing id) of its last
+row, and the next page starts strictly after it with a row-value comparison, instead of an OFFSET
+that reads and skips every row before the page. With the partial indexes of create.Listing, which
+only hold the AVAILABLE listings ordered by price or by listing date, the database walks the index
+from the cursor in the order of the page, checks the house of each listing by its primary key, and
+stops as soon as the page is full, so the time of a page depends on its size and on how selective
+the house filters are, not on the number of listings. When zip codes are given, the database can
+start from ix_houses_zip_code_rooms instead, whichever it estimates is cheaper.
+
+The partial indexes are only used if the query repeats their condition as is, so the state is
+compared with the literal create.AVAILABLE rather than with a bound parameter. They are kept up to
+date by the database itself when a listing changes state.
+'''
+from sqlalchemy import select, text, tuple_
+from create import AVAILABLE, House, Listing
+
+# the sort orders of the pages: the sorted column, and whether it is descending
+SORTS = {
+    'price': (Listing.listing_price, False),
+    'price_desc': (Listing.listing_price, True),
+    'newest': (Listing.listing_date, True),
+    'oldest': (Listing.listing_date, False),
+}
+MAX_PAGE_SIZE = 100
+
+
+def search_statement(min_price=None, max_price=None, min_bedrooms=None, max_bedrooms=None, min_bathrooms=None,
+                     zip_codes=None, sort='price', after=None, limit=20):
+    '''
+    Returns the SELECT of a page of search_listings, for the same arguments.
+    '''
+    if sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}, got {sort!r}.")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}, got {limit}.")
+    column, descending = SORTS[sort]
+    conditions = [text(AVAILABLE)]
+    if min_price is not None:
+        conditions.append(Listing.listing_price >= min_price)
+    if max_price is not None:
+        conditions.append(Listing.listing_price <= max_price)
+    if min_bedrooms is not None:
+        conditions.append(House.no_of_bedrooms >= min_bedrooms)
+    if max_bedrooms is not None:
+        conditions.append(House.no_of_bedrooms <= max_bedrooms)
+    if min_bathrooms is not None:
+        conditions.append(House.no_of_bathrooms >= min_bathrooms)
+    if zip_codes is not None:
+        conditions.append(House.zip_code.in_(zip_codes))
+    if after is not None:
+        key = tuple_(column, Listing.id)
+        conditions.append(key < tuple_(*after) if descending else key > tuple_(*after))
+    order = [column.desc(), Listing.id.desc()] if descending else [column, Listing.id]
+    return select(
+        Listing.id, Listing.house_id, Listing.listing_price, Listing.listing_date, House.address, House.zip_code,
+        House.no_of_bedrooms, House.no_of_bathrooms,
+    ).join(House, House.id == Listing.house_id).where(*conditions).order_by(*order).limit(limit)
+
+
+def search_listings(session, min_price=None, max_price=None, min_bedrooms=None, max_bedrooms=None, min_bathrooms=None,
+                    zip_codes=None, sort='price', after=None, limit=20):
+    '''
+    Returns a page of the AVAILABLE listings matching the filters.
+
+    Args:
+        session (Session): The session used to run the search.
+        min_price (int): The lowest listing price, in cents.
+        max_price (int): The highest listing price, in cents.
+        min_bedrooms (int): The fewest bedrooms.
+        max_bedrooms (int): The most bedrooms.
+        min_bathrooms (int): The fewest bathrooms.
+        zip_codes (List[int]): The zip codes the houses must be in.
+        sort (str): The order of the listings, one of SORTS.
+        after (tuple): The cursor returned with the previous page, None for the first page.
+        limit (int): The number of listings of a page, at most MAX_PAGE_SIZE.
+
+    Returns:
+        (List[Row], tuple): The (id, house_id, listing_price, listing_date, address, zip_code, no_of_bedrooms,
+        no_of_bathrooms) rows of the page, and the cursor of the next page, None after the last page.
+    '''
+    rows = session.execute(search_statement(min_price, max_price, min_bedrooms, max_bedrooms, min_bathrooms, zip_codes,
+                                            sort, after, limit)).all()
+    column, _ = SORTS[sort]
+    cursor = (getattr(rows[-1], column.key), rows[-1].id) if len(rows) == limit else None
+    return rows, cursor
@@ -0,0 +1,98 @@
+'''
+Streaming reads of whole tables, for the dumps and exports that used to load a table with
+session.query(Model).all(): every row became an ORM object held in one list, and the list one repr
+string, so the memory grew with the table.
+
+rows() yields the rows of a table in primary key order, one page at a time. Each page is a query
+starting strictly after the primary key of the last row of the previous page (keyset pagination, a
+row-value comparison for the composite keys of the rollups), so every page is a range scan of the
+primary key, however far into the table it is. Within a page the rows are fetched in batches with
+yield_per. Only one page is held in memory at a time: the ORM objects that were yielded are released
+by the session once the caller drops them, unless they were modified.
+
+With columns, the rows are plain tuples of those columns instead of ORM objects, which is several
+times faster and is what export() writes to CSV or JSON lines:
+
+    python3 cli.py export sales --format jsonl --output sales.jsonl
+'''
+import csv
+import json
+from datetime import date
+from sqlalchemy import inspect, select, tuple_
+from create import Base
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def models():
+    '''
+    Returns the mapped classes, by table name.
+    '''
+    return {mapper.local_table.name: mapper.class_ for mapper in Base.registry.mappers}
+
+
+def rows(session, model, columns=None, page_size=DEFAULT_PAGE_SIZE, condition=None):
+    '''
+    Yields the rows of a model in primary key order, one page of page_size rows in memory at a time.
+
+    Args:
+        session (Session): The session used to read the rows.
+        model (Base): The mapped class of the table.
+        columns (List[str]): The names of the columns to yield as tuples, None to yield ORM objects.
+        page_size (int): The number of rows read per query.
+        condition (ColumnElement): A filter on the rows, all rows by default.
+    '''
+    key = inspect(model).primary_key
+    selected = [getattr(model, name) for name in columns] if columns is not None else [model]
+    # the key is fetched after the columns, to start the next page from the last row
+    statement = select(*selected, *key).order_by(*key).limit(page_size).execution_options(yield_per=page_size)
+    if condition is not None:
+        statement = statement.where(condition)
+    width, last = len(selected), None
+    while True:
+        page = statement if last is None else statement.where(
+            tuple_(*key) > tuple_(*last) if len(key) > 1 else key[0] > last[0])
+        count = 0
+        for row in session.execute(page):
+            count += 1
+            last = row[width:]
+            yield row[0] if columns is None else tuple(row[:width])
+        if count < page_size:
+            return
+
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def export(session, table, file, format='csv', columns=None, page_size=DEFAULT_PAGE_SIZE):
+    '''
+    Writes the rows of a table to a file as CSV, with a header line, or as JSON lines, one object per
+    row, and returns the number of rows written.
+
+    Args:
+        session (Session): The session used to read the rows.
+        table (str): The name of the table, one of models().
+        file (TextIO): The open file the rows are written to.
+        format (str): 'csv' or 'jsonl'.
+        columns (List[str]): The columns to write, all the columns of the table by default.
+        page_size (int): The number of rows read per query.
+    '''
+    if format not in ('csv', 'jsonl'):
+        raise ValueError(f"format must be 'csv' or 'jsonl', got {format!r}.")
+    model = models()[table]
+    if columns is None:
+        columns = [attribute.key for attribute in inspect(model).column_attrs]
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for count, row in enumerate(rows(session, model, columns, page_size), start=1):
+            writer.writerow(row)
+    else:
+        for count, row in enumerate(rows(session, model, columns, page_size), start=1):
+            file.write(json.dumps(dict(zip(columns, row)), default=_json_value) + '\n')
+    return count
+
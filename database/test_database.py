@@ -1,15 +1,43 @@
+import array
+import asyncio
+import json
+import os
+import tempfile
 import unittest
-from create import House, Listing, Office, Agent, Customer, Sale, AgentCommission, AgentOffice, SalePriceSummary, Base, engine 
-from sqlalchemy import create_engine
+from unittest import mock
+from create import House, Listing, Office, Agent, Customer, Sale, AgentCommission, AgentOffice, SalePriceSummary, Base, \
+    OfficeMonthlySales, AgentMonthlySales, ZipMonthlySales, JobWatermark, explain_query_plan, \
+    create_indexes
+from sqlalchemy import func, select
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+import db
+from datetime import date, datetime
+from period import Period
+import rollups
+import summary
+import commissions
+import reports
+import report_cache
 import insert_data
 import query_data
+import generate
+import bench
+import instrumentation
+import columnar
+import analytics
+import runner
+import async_api
+import search
+import streaming
+import dimensions
+import changes
+import partitions
+import bulk_load
+import leaderboard
 
 class TestDatabase(unittest.TestCase):
     def setUp(self):
-        self.engine = create_engine('sqlite:///:memory:')
-        self.engine.connect()
+        self.engine = db.make_engine('sqlite:///:memory:')
         Base.metadata.create_all(self.engine)
         self.session = sessionmaker(bind=self.engine)()
 
@@ -67,11 +95,12 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(customer.lastName, 'Ogwuche')
         self.assertEqual(customer.emailAddress, 'praiseogwuche@staple.com')
 
-        agent_commission = AgentCommission(agent_id=1, monthly_commission=10000)
+        agent_commission = AgentCommission(agent_id=1, year=2023, month=2, monthly_commission=10000)
         self.session.add(agent_commission)
         self.session.commit()
         self.assertEqual(agent_commission.id, 1)
         self.assertEqual(agent_commission.agent_id, 1)
+        self.assertEqual((agent_commission.year, agent_commission.month), (2023, 2))
         self.assertEqual(agent_commission.monthly_commission, 10000)
 
         agent_office = AgentOffice(agent_id=1, office_id=1)
@@ -89,6 +118,725 @@ class TestDatabase(unittest.TestCase):
 
 
 
+    def test_ingest_sales(self):
+        for house_id, state in [(1, 'AVAILABLE'), (2, 'UNAVAILABLE'), (3, 'AVAILABLE')]:
+            self.session.add(Listing(house_id=house_id, seller_id=1, listing_date=datetime(2022, 6, 29), listing_agent_id=1,
+                                     listing_office_id=1, listing_price=100000, listing_state=state))
+        self.session.add(SalePriceSummary(total_sale=0))
+        self.session.commit()
+
+        sales = [
+            {'buyer_id': 1, 'sale_price': 150000, 'sell_date': datetime(2023, 1, 5), 'agent_id': 1, 'house_id': 1},
+            {'buyer_id': 1, 'sale_price': 250000, 'sell_date': datetime(2023, 1, 6), 'agent_id': 1, 'house_id': 2},
+            {'buyer_id': 1, 'sale_price': 350000, 'sell_date': datetime(2023, 1, 7), 'agent_id': 1, 'house_id': 9},
+            {'buyer_id': 1, 'sell_date': datetime(2023, 1, 8), 'agent_id': 1, 'house_id': 3},
+            {'buyer_id': 1, 'sale_price': 450000, 'sell_date': datetime(2023, 1, 9), 'agent_id': 1, 'house_id': 3},
+        ]
+        inserted, failures = insert_data.ingest_sales(iter(sales), chunk_size=4, session=self.session)
+        self.assertEqual(inserted, 2)
+        self.assertEqual([position for position, _, _ in failures], [1, 2, 3])
+        self.assertIn('unavailable', failures[0][2])
+        self.assertEqual(self.session.query(Sale).count(), 2)
+        self.assertEqual(summary.total_sale(self.session), 600000)
+        self.assertEqual(self.session.get(Listing, 1).listing_state, 'SOLD')
+        self.assertEqual(self.session.get(Listing, 2).listing_state, 'UNAVAILABLE')
+        self.assertEqual(self.session.get(Listing, 3).listing_state, 'SOLD')
+
+        self.assertEqual(self.session.get(SalePriceSummary, summary.SUMMARY_ID).total_sale, 600000)
+
+    def test_ingest_sales_malformed(self):
+        for house_id in [1, 2]:
+            self.session.add(Listing(house_id=house_id, seller_id=1, listing_date=datetime(2022, 6, 29), listing_agent_id=1,
+                                     listing_office_id=1, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.add(SalePriceSummary(total_sale=0))
+        self.session.commit()
+
+        sales = [
+            {'buyer_id': 1, 'sale_price': 150000, 'sell_date': '2023-01-05', 'agent_id': 1, 'house_id': 1},
+            {'buyer_id': 1, 'sale_price': 'abc', 'sell_date': datetime(2023, 1, 6), 'agent_id': 1, 'house_id': 2},
+            {'buyer_id': 1, 'sale_price': 250000, 'sell_date': datetime(2023, 1, 6), 'agent_id': 1, 'house_id': 2},
+        ]
+        inserted, failures = insert_data.ingest_sales(sales, session=self.session)
+        self.assertEqual(inserted, 1)
+        self.assertEqual([position for position, _, _ in failures], [0, 1])
+        self.assertIn('sell_date', failures[0][2])
+        self.assertIn('sale_price', failures[1][2])
+        self.assertEqual(self.session.get(Listing, 1).listing_state, 'AVAILABLE')
+        self.assertEqual(summary.total_sale(self.session), 250000)
+
+    def test_days_on_market(self):
+        # house 1 was listed, withdrawn and listed again: the sale sold the second listing
+        for listing_date, state in [(datetime(2021, 3, 1, 9, 30), 'UNAVAILABLE'), (datetime(2022, 6, 29, 17, 15), 'AVAILABLE'),
+                                    (datetime(2023, 6, 1), 'AVAILABLE')]:
+            self.session.add(Listing(house_id=1, seller_id=1, listing_date=listing_date, listing_agent_id=1,
+                                     listing_office_id=1, listing_price=100000, listing_state=state))
+        self.session.add(House(id=1, no_of_bedrooms=2, no_of_bathrooms=1, address='1 Main St', zip_code=94111, office=1))
+        self.session.add(SalePriceSummary(total_sale=0))
+        self.session.commit()
+        sale = {'buyer_id': 1, 'sale_price': 150000, 'sell_date': datetime(2023, 1, 5), 'agent_id': 1, 'house_id': 1}
+        self.assertEqual(insert_data.ingest_sales([sale], session=self.session), (1, []))
+        recorded = self.session.query(Sale).one()
+        self.assertEqual((recorded.listing_id, recorded.days_on_market), (2, 190))
+        self.assertEqual([self.session.get(Listing, id).listing_state for id in (1, 2, 3)],
+                         ['UNAVAILABLE', 'SOLD', 'AVAILABLE'])
+        self.assertEqual(reports.avg_days_on_market(self.session, Period.month(2023, 1)), 190)
+
+        # the sales recorded before the columns existed are resolved the same way
+        self.session.query(Sale).update({Sale.listing_id: None, Sale.days_on_market: None})
+        self.assertEqual(insert_data.link_listings(self.session), 1)
+        recorded = self.session.query(Sale).one()
+        self.assertEqual((recorded.listing_id, recorded.days_on_market), (2, 190))
+
+        # a house only listed after the sell date has no listing sold, rather than negative days on the market
+        self.session.add(Listing(house_id=2, seller_id=1, listing_date=datetime(2023, 6, 1), listing_agent_id=1,
+                                 listing_office_id=1, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.commit()
+        inserted, failures = insert_data.ingest_sales([dict(sale, house_id=2)], session=self.session)
+        self.assertEqual(inserted, 0)
+        self.assertIn('was not listed on or before 2023-01-05', failures[0][2])
+        self.session.add(Sale(buyer_id=1, sale_price=150000, sell_date=datetime(2023, 1, 5), agent_id=1, house_id=2))
+        self.session.commit()
+        self.assertEqual(insert_data.link_listings(self.session), 1)
+        self.assertEqual(self.session.query(Sale.listing_id, Sale.days_on_market).filter(Sale.house_id == 2).one(),
+                         (None, None))
+
+    def test_dimensions(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        self.assertEqual(dimensions.offices(self.session, [3, 99]), {3: 'san jose'})
+        self.assertEqual(reports.top_offices(self.session, Period.month(2023, 1), 1), [('san jose', 8327962)])
+
+        # a commit changing an office makes the cached names stale, and the cached reports with them
+        self.session.get(Office, 3).office_name = 'San Jose'
+        self.session.commit()
+        self.assertEqual(reports.top_offices(self.session, Period.month(2023, 1), 1)[0].office_name, 'San Jose')
+        self.session.query(Agent).filter(Agent.id == 1).update({Agent.firstName: 'Ann'})
+        self.assertEqual(dimensions.agents(self.session, [1])[1][0], 'Ann')
+        self.session.commit()
+
+        dimensions.configure(max_entries=2)
+        self.addCleanup(dimensions.configure)
+        self.assertEqual(len(dimensions.houses(self.session, [1, 2, 3])), 3)
+        self.assertEqual(len(dimensions.cache_for(self.engine)._entries['houses']), 2)
+
+    def test_changes(self):
+        for house_id in (1, 2):
+            self.session.add(Listing(house_id=house_id, seller_id=1, listing_date=datetime(2022, 6, 29), listing_agent_id=1,
+                                     listing_office_id=1, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.commit()
+        sales = [
+            {'buyer_id': 1, 'sale_price': 150000, 'sell_date': datetime(2023, 1, 5), 'agent_id': 1, 'house_id': 1},
+            {'buyer_id': 1, 'sell_date': datetime(2023, 1, 6), 'agent_id': 1, 'house_id': 2},  # no price: rolled back
+        ]
+        insert_data.ingest_sales(sales, chunk_size=2, session=self.session)
+        feed = changes.read_changes(self.session)
+        self.assertEqual([tuple(change)[1:] for change in feed], [
+            ('SALE_INSERTED', 1, 1, None, None, 150000),
+            ('LISTING_STATE', None, 1, 'SOLD', None, None),
+            ('SUMMARY_DELTA', None, None, None, 1, 150000),
+        ])
+        self.assertEqual(changes.last_seq(self.session), feed[-1].seq)
+
+        # a consumer reads the changes after the last one it processed, in batches
+        insert_data.ingest_sales([dict(sales[1], sale_price=250000)], session=self.session)
+        batches = list(changes.follow(self.session, after_seq=feed[-1].seq, batch_size=2))
+        self.assertEqual([[change.kind for change in batch] for batch in batches],
+                         [['SALE_INSERTED', 'LISTING_STATE'], ['SUMMARY_DELTA']])
+        self.assertEqual(changes.trim(self.session, feed[-1].seq), 3)
+        self.assertEqual(changes.read_changes(self.session)[0].seq, feed[-1].seq + 1)
+
+    def test_partitions(self):
+        self.assertRaises(ValueError, partitions.archive, self.session, 2019, 'archive')  # in memory
+        with tempfile.TemporaryDirectory() as folder:
+            engine = db.make_engine('sqlite:///' + os.path.join(folder, 'partitioned.db'))
+            self.addCleanup(engine.dispose)
+            generate.generate(engine, scale=200, seed=1, chunk_size=100)
+            session = sessionmaker(bind=engine)()
+            before = columnar.load(engine)
+            report = reports.top_offices(session, Period.year(2019))
+
+            partition = partitions.archive(session, 2019, os.path.join(folder, 'archive'))
+            self.assertEqual(partition.sale_count, len(analytics.select_period(before, Period.year(2019))['sale_id']))
+            self.assertEqual(session.query(Sale).filter(func.strftime('%Y', Sale.sell_date) == '2019').count(), 0)
+            self.assertRaises(ValueError, partitions.archive, session, 2019, os.path.join(folder, 'archive'))
+            self.assertRaises(ValueError, partitions.archive, session, date.today().year, os.path.join(folder, 'archive'))
+
+            # the router reads the archives overlapping the period, and only the main database otherwise
+            self.assertEqual(columnar.load(engine)['sale_id'].tolist(), before['sale_id'].tolist())
+            self.assertEqual(columnar.load(engine, period=Period.year(2019))['sale_id'].tolist(),
+                             analytics.select_period(before, Period.year(2019))['sale_id'].tolist())
+            statement = columnar.sales_statement()
+            with engine.connect() as connection:
+                self.assertIs(partitions.route(connection, statement, Period.year(2023)), statement)
+
+            # the rollups of the archived year are kept, and its sales are closed
+            rollups.backfill(session)
+            self.assertEqual(reports.top_offices(session, Period.year(2019)), report)
+            house_id = session.query(Listing.house_id).filter(Listing.listing_state == 'AVAILABLE').first()[0]
+            _, failures = insert_data.ingest_sales([{'buyer_id': 1, 'sale_price': 100000, 'sell_date': datetime(2019, 5, 1),
+                                                     'agent_id': 1, 'house_id': house_id}], session=session)
+            self.assertIn('archived', failures[0][2])
+            session.close()
+
+    def test_bulk_load(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        total, sales = summary.total_sale(self.session), self.session.query(Sale).count()
+        seq = changes.last_seq(self.session)
+        agent = self.session.get(Agent, 2).emailAddress
+        buyer = self.session.get(Customer, 1).emailAddress
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'houses.csv'), 'w') as file:
+                file.write('no_of_bedrooms,no_of_bathrooms,address,zip_code,office_name\n'
+                           '3,2,1 Bulk Road,94111,san jose\n4,3,2 Bulk Road,94111,nowhere\n3,1,3 Bulk Road,94111,san jose\n')
+            with open(os.path.join(folder, 'listings.jsonl'), 'w') as file:
+                file.write(json.dumps({'house_address': '1 Bulk Road', 'seller_email': buyer, 'listing_agent_email': agent,
+                                       'listing_office_name': 'san jose', 'listing_date': '2022-12-01T10:00:00',
+                                       'listing_price': 900000}) + '\n')
+            with open(os.path.join(folder, 'sales.csv'), 'w') as file:
+                file.write('house_address,buyer_email,agent_email,sale_price,sell_date\n'
+                           f'1 Bulk Road,{buyer},{agent},880000,2023-01-20\n1 Bulk Road,{buyer},nobody,1,2023-01-21\n'
+                           f'3 Bulk Road,{buyer},{agent},700000,2023-01-22\n')
+            progress = []
+            result = bulk_load.load(self.engine, os.path.join(folder, 'houses.csv'), os.path.join(folder, 'listings.jsonl'),
+                                    os.path.join(folder, 'sales.csv'), chunk_size=1, defer_indexes=True,
+                                    progress=lambda *arguments: progress.append(arguments))
+        self.assertEqual((result['houses'], result['listings'], result['sales']), (2, 1, 1))
+        self.assertEqual([(table, number) for table, number, _ in result['rejected']],
+                         [('houses', 3), ('sales', 3), ('sales', 4)])
+        self.assertIn("Unknown office_name 'nowhere'", result['rejected'][0][2])
+        self.assertIn("has no listing", result['rejected'][2][2])
+        self.assertEqual([table for table, _, _ in progress], ['houses'] * 3 + ['listings'] + ['sales'] * 3)
+
+        # the indexes are back, and the new sale went through the summaries like an ingested one
+        self.assertEqual(create_indexes(self.engine), [])
+        sale = self.session.query(Sale).filter(Sale.id > sales).one()
+        self.assertEqual((sale.days_on_market, sale.agent_commissions), (50, commissions.commission_for(880000, commissions.DEFAULT_TIERS)))
+        self.assertEqual(self.session.get(Listing, sale.listing_id).listing_state, 'SOLD')
+        self.assertEqual(summary.total_sale(self.session), total + 880000)
+        self.assertEqual([(change.kind, change.sale_id) for change in changes.read_changes(self.session, seq)],
+                         [('SALE_INSERTED', sale.id), ('LISTING_STATE', None), ('SUMMARY_DELTA', None)])
+        self.assertEqual(reports.top_offices(self.session, Period.month(2023, 1), 1), [('san jose', 8327962 + 880000)])
+
+    def test_bulk_load_matches_ingestion(self):
+        sales = [
+            {'buyer_id': 1, 'sale_price': 3000000, 'sell_date': datetime(2023, 1, 20), 'agent_id': 3, 'house_id': 2},
+            {'buyer_id': 2, 'sale_price': 2000000, 'sell_date': datetime(2023, 3, 2), 'agent_id': 1, 'house_id': 4},
+            {'buyer_id': 1, 'sale_price': 500000, 'sell_date': datetime(2023, 3, 3), 'agent_id': 2, 'house_id': 99},
+            {'buyer_id': 3, 'sale_price': 90000, 'sell_date': datetime(2023, 2, 14), 'agent_id': 5, 'house_id': 6},
+        ]
+        other = db.make_engine('sqlite:///:memory:')
+        Base.metadata.create_all(other)
+        self.addCleanup(other.dispose)
+        ingested, loaded = self.session, sessionmaker(bind=other)()
+        self.addCleanup(loaded.close)
+        for session in (ingested, loaded):
+            self.assertEqual(insert_data.seed(session), [])
+        seq = changes.last_seq(ingested)
+        self.assertEqual(changes.last_seq(loaded), seq)
+
+        _, failures = insert_data.ingest_sales(sales, chunk_size=2, session=ingested)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'sales.csv')
+            with open(path, 'w') as file:
+                file.write('house_id,buyer_id,agent_id,sale_price,sell_date\n')
+                for sale in sales:
+                    file.write('{house_id},{buyer_id},{agent_id},{sale_price},{sell_date:%Y-%m-%d}\n'.format(**sale))
+            result = bulk_load.load(other, sales=path, chunk_size=2)
+        self.assertEqual([reason for _, _, reason in result['rejected']], [reason for _, _, reason in failures])
+        self.assertEqual((result['sales'], len(failures)), (3, 1))
+
+        def snapshot(session):
+            tables = [Sale, Listing, OfficeMonthlySales, AgentMonthlySales, ZipMonthlySales]
+            return ([[tuple(row) for row in session.query(model.__table__).order_by(*model.__table__.primary_key.columns)]
+                     for model in tables] + [summary.total_sale(session)] +
+                    [[(change.kind, change.sale_id, change.listing_id, change.listing_state, change.amount)
+                      for change in changes.read_changes(session, seq)]])
+        self.assertEqual(snapshot(loaded), snapshot(ingested))
+
+    def test_leaderboard(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        periods = [Period.month(2023, 1), Period.year(2023)]
+        board = leaderboard.start(self.engine, periods, capacity=2, interval=None)
+        self.addCleanup(leaderboard.stop, self.engine)
+        self.assertRaises(ValueError, board.top_agents, Period.month(2023, 2))
+
+        # agent 3 overtakes the ranked agents, and the 2022 sale is in no period
+        sales = [
+            {'buyer_id': 1, 'sale_price': 3000000, 'sell_date': datetime(2023, 1, 20), 'agent_id': 3, 'house_id': 2},
+            {'buyer_id': 1, 'sale_price': 2000000, 'sell_date': datetime(2023, 3, 2), 'agent_id': 3, 'house_id': 4},
+            {'buyer_id': 1, 'sale_price': 9000000, 'sell_date': datetime(2022, 12, 30), 'agent_id': 5, 'house_id': 4},
+        ]
+        self.assertEqual(insert_data.ingest_sales(sales, chunk_size=2, session=self.session), (3, []))
+        self.assertEqual(board.top_agents(Period.year(2023), 1), [(3, 7424971)])
+        for period in periods:
+            for k in (1, 2, 5):
+                self.assertEqual(board.top_agents(period, k),
+                                 self.session.execute(reports.top_agents_statement(period, k)).all())
+                self.assertEqual(board.top_offices(period, k),
+                                 self.session.execute(reports.top_offices_statement(period, k)).all())
+
+        # the sales already in the totals when they were reloaded are not added twice
+        leaderboard.reconcile(self.engine)
+        self.assertEqual(board.seq, changes.last_seq(self.session))
+        board.add_sales([(datetime(2023, 1, 20), 3, 3, 3000000)], changes.last_seq(self.session))
+        self.assertEqual(board.top_agents(Period.month(2023, 1), 1)[0].amount_sold, 4827949)
+
+        # a write that bypassed the ingestion is seen once reconciled
+        self.session.query(AgentMonthlySales).filter(AgentMonthlySales.agent_id == 3).delete()
+        self.session.commit()
+        leaderboard.reconcile(self.engine)
+        self.assertEqual(board.top_agents(Period.year(2023), 1), [(4, 4582273)])
+
+    def test_period(self):
+        self.assertEqual((Period.month(2023, 12).start, Period.month(2023, 12).end), (date(2023, 12, 1), date(2024, 1, 1)))
+        self.assertEqual(Period.quarter(2023, 2), Period.between(date(2023, 4, 1), datetime(2023, 7, 1)))
+        self.assertEqual(Period.year(2023).end, date(2024, 1, 1))
+        self.assertIn(datetime(2023, 1, 31, 23, 59), Period.month(2023, 1))
+        self.assertNotIn(date(2023, 2, 1), Period.month(2023, 1))
+        self.assertRaises(ValueError, Period.month, 2023, 13)
+        self.assertRaises(ValueError, Period.between, date(2023, 2, 1), date(2023, 1, 1))
+
+        for day in [date(2022, 12, 31), date(2023, 1, 1), date(2023, 1, 31), date(2023, 2, 1)]:
+            self.session.add(Sale(sale_price=100000, sell_date=day))
+        self.session.commit()
+        sold = self.session.query(Sale.sell_date).filter(Period.month(2023, 1).filter(Sale.sell_date)).all()
+        self.assertEqual(sorted(day for day, in sold), [date(2023, 1, 1), date(2023, 1, 31)])
+
+    def test_rollups(self):
+        for house_id, office, zip_code in [(1, 1, 94111), (2, 1, 94110), (3, 2, 94111)]:
+            self.session.add(House(id=house_id, no_of_bedrooms=3, no_of_bathrooms=2, address="123 Main St",
+                                   zip_code=zip_code, office=office))
+            self.session.add(Listing(house_id=house_id, seller_id=1, listing_date=datetime(2022, 12, 1), listing_agent_id=1,
+                                     listing_office_id=office, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.add(SalePriceSummary(total_sale=0))
+        self.session.commit()
+
+        insert_data.ingest_sales([
+            {'buyer_id': 1, 'sale_price': 150000, 'sell_date': datetime(2023, 1, 5), 'agent_id': 1, 'house_id': 1},
+            {'buyer_id': 1, 'sale_price': 250000, 'sell_date': datetime(2023, 1, 31), 'agent_id': 2, 'house_id': 2},
+        ], session=self.session)
+        insert_data.ingest_sales([
+            {'buyer_id': 1, 'sale_price': 350000, 'sell_date': datetime(2023, 2, 1), 'agent_id': 1, 'house_id': 3},
+            {'buyer_id': 1, 'sale_price': 50000, 'sell_date': datetime(2023, 1, 10), 'agent_id': 1, 'house_id': 3},
+        ], session=self.session)
+
+        office = self.session.get(OfficeMonthlySales, (2023, 1, 1))
+        self.assertEqual((office.sale_count, office.total_sale_price, office.total_days_on_market), (2, 400000, 35 + 61))
+        self.assertEqual(office.total_commission, 150000 * 0.075 + 250000 * 0.06)
+        self.assertEqual(self.session.get(AgentMonthlySales, (2023, 1, 1)).total_sale_price, 200000)
+        self.assertEqual(self.session.get(ZipMonthlySales, (2023, 1, 94111)).sale_count, 2)
+        self.assertEqual(self.session.get(ZipMonthlySales, (2023, 2, 94111)).total_sale_price, 350000)
+
+        def snapshot():
+            return [sorted(tuple(row) for row in self.session.query(
+                model.__table__).order_by(*model.__table__.primary_key.columns)) for model in
+                    (OfficeMonthlySales, AgentMonthlySales, ZipMonthlySales)]
+        incremental = snapshot()
+        rollups.backfill(self.session)
+        self.assertEqual(snapshot(), incremental)
+
+        # the sales whose days on the market are unknown are left out of the averages
+        self.session.query(Sale).filter(Sale.house_id == 1).update({Sale.days_on_market: None})
+        rollups.backfill(self.session)
+        january = Period.month(2023, 1)
+        self.assertEqual(reports.office_sales(self.session, january, 1).avg_days_on_market, 61)
+        self.assertEqual(reports.avg_days_on_market(self.session, january), (61 + 40) / 2)
+        self.assertEqual(analytics.avg_days_on_market(columnar.load(self.engine), january), (61 + 40) / 2)
+
+    def test_commissions(self):
+        tiers = commissions.DEFAULT_TIERS
+        self.assertEqual(commissions.commission_for(99999, tiers), 10000)
+        self.assertEqual(commissions.commission_for(100000, tiers), 7500)
+        self.assertEqual(commissions.commission_for(597022, tiers), 29851)
+        self.assertEqual(commissions.commission_for(1000000, tiers), 40000)
+
+        self.session.add(Listing(house_id=1, seller_id=1, listing_date=datetime(2022, 6, 29), listing_agent_id=1,
+                                 listing_office_id=1, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.commit()
+        prices = [50000, 150000, 450000, 2500000]
+        insert_data.ingest_sales([{'buyer_id': 1, 'sale_price': price, 'sell_date': datetime(2023, 1, 5), 'agent_id': 1,
+                                   'house_id': 1} for price in prices], session=self.session)
+        stored = [commission for commission, in self.session.query(Sale.agent_commissions).order_by(Sale.id)]
+        self.assertEqual(stored, [5000, 11250, 27000, 100000])
+
+        new_tiers = [(0, 500), (1000000, 300)]
+        commissions.set_tiers(self.session, new_tiers)
+        self.assertEqual(commissions.load_tiers(self.session), new_tiers)
+        stored = [commission for commission, in self.session.query(Sale.agent_commissions).order_by(Sale.id)]
+        self.assertEqual(stored, [commissions.commission_for(price, new_tiers) for price in prices])
+
+        # the sales migrated without a commission get one, the others keep theirs
+        self.session.query(Sale).filter(Sale.id == 2).update({Sale.agent_commissions: None})
+        self.session.commit()
+        self.assertEqual(commissions.recompute(self.session, Sale.agent_commissions.is_(None)), 1)
+        stored = [commission for commission, in self.session.query(Sale.agent_commissions).order_by(Sale.id)]
+        self.assertEqual(stored, [commissions.commission_for(price, new_tiers) for price in prices])
+        # the house of the sales has no row: they still count for their agent
+        self.assertEqual(self.session.query(AgentCommission.monthly_commission).scalar(), sum(stored))
+        self.assertEqual(self.session.query(OfficeMonthlySales).count(), 0)
+
+    def test_commission_job(self):
+        self.session.add(House(id=1, no_of_bedrooms=3, no_of_bathrooms=2, address="123 Main St", zip_code=12345, office=1))
+        self.session.add(Listing(house_id=1, seller_id=1, listing_date=datetime(2022, 6, 29), listing_agent_id=1,
+                                 listing_office_id=1, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.commit()
+
+        def sell(price, sell_date, agent_id):
+            insert_data.ingest_sales([{'buyer_id': 1, 'sale_price': price, 'sell_date': sell_date, 'agent_id': agent_id,
+                                       'house_id': 1}], session=self.session)
+
+        def stored():
+            return sorted((row.agent_id, row.year, row.month, row.monthly_commission)
+                          for row in self.session.query(AgentCommission))
+
+        sell(150000, datetime(2023, 1, 5), 1)
+        sell(50000, datetime(2023, 2, 5), 2)
+        self.assertEqual(commissions.run_commission_job(self.session), [(2023, 1), (2023, 2)])
+        self.assertEqual(stored(), [(1, 2023, 1, 11250), (2, 2023, 2, 5000)])
+        self.assertEqual(commissions.run_commission_job(self.session), [])
+
+        sell(150000, datetime(2023, 1, 20), 1)
+        self.assertEqual(commissions.run_commission_job(self.session), [(2023, 1)])
+        self.assertEqual(commissions.run_commission_job(self.session), [])
+        self.assertEqual(stored(), [(1, 2023, 1, 22500), (2, 2023, 2, 5000)])
+        self.assertEqual(self.session.get(JobWatermark, commissions.COMMISSION_JOB).last_sale_id, 3)
+
+    def test_reports(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        results = query_data.run_reports(self.session, 2023, 1)
+        self.assertEqual(results['top offices'][0], ('san jose', 8327962))
+        self.assertEqual(results['top offices'][3], ('santa clara', 1827949))
+        self.assertEqual(results['top agents of the year'][4], ('Blessing', 'Stay', 'blessing@realtor.com', 2424971))
+        self.assertEqual(results['agent commissions'], [(1, 115897), (2, 149194), (3, 73118), (4, 183291), (6, 149828)])
+        self.assertEqual(results['average days on the market'], 250)
+        self.assertEqual(results['average selling price'], 3356637.6)
+        self.assertEqual(results['top zip codes'][0], (94111, 4582273.0))
+
+        # the statements are cached: other periods and limits only change the bound parameters
+        self.assertEqual(reports.top_offices(self.session, Period.month(2023, 2), 1), [('san jose', 856739)])
+        self.assertEqual(reports.top_offices(self.session, Period.year(2023), 2),
+                         [('san jose', 9781723), ('south san francisco', 3729845)])
+        self.assertIsNone(reports.avg_sale_price(self.session, Period.month(2022, 1)))
+
+        # the other periods are aggregated from the sales themselves
+        commissions.run_commission_job(self.session)
+        period = Period.between(date(2023, 1, 10), date(2023, 1, 25))
+        sales = [sale for sale in self.session.query(Sale.agent_id, Sale.sale_price, Sale.agent_commissions,
+                                                     Sale.days_on_market, Sale.sell_date, House.office, House.zip_code).join(
+            House, House.id == Sale.house_id) if sale.sell_date in period]
+        self.assertEqual(len(sales), 4)
+        office_names = dict(self.session.query(Office.id, Office.office_name).all())
+        by_office = {}
+        for sale in sales:
+            by_office[sale.office] = by_office.get(sale.office, 0) + sale.sale_price
+        self.assertEqual(reports.top_offices(self.session, period, 5), sorted(
+            [(office_names[office], total) for office, total in by_office.items()], key=lambda row: -row[1]))
+        self.assertEqual(reports.agent_commissions(self.session, period),
+                         sorted((sale.agent_id, sale.agent_commissions) for sale in sales))
+        self.assertEqual(reports.avg_days_on_market(self.session, period), sum(sale.days_on_market for sale in sales) / len(sales))
+        self.assertEqual(reports.avg_sale_price(self.session, period), sum(sale.sale_price for sale in sales) / len(sales))
+        office = sales[0].office
+        self.assertEqual(reports.office_sales(self.session, period, office)[:3], tuple(
+            map(sum, zip(*[(1, sale.sale_price, sale.agent_commissions) for sale in sales if sale.office == office]))))
+
+        # over the same sales, the statements of the other periods give the results of the rollups
+        month, days = Period.month(2023, 1), Period.between(date(2022, 12, 31), date(2023, 2, 1))
+        for name, arguments in [('top_offices', (5,)), ('top_agents', (5,)), ('agent_commissions', ()),
+                                ('avg_days_on_market', ()), ('avg_sale_price', ()), ('top_zip_codes', (5,)),
+                                ('office_sales', (office,))]:
+            self.assertEqual(getattr(reports, name)(self.session, days, *arguments),
+                             getattr(reports, name)(self.session, month, *arguments), name)
+
+    def test_report_cache(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        january, february = Period.month(2023, 1), Period.month(2023, 2)
+        self.assertEqual(reports.top_offices(self.session, january, 1), [('san jose', 8327962)])
+        self.assertEqual(reports.top_offices(self.session, february, 1), [('san jose', 856739)])
+        cache = report_cache.cache_for(self.engine)
+        self.assertEqual(cache.get(('top_offices', january.start, january.end, 1)), (True, [('san jose', 8327962)]))
+
+        # a sale in January only drops the reports of the periods containing its date
+        self.session.add(House(no_of_bedrooms=2, no_of_bathrooms=1, address='1 Main Street, San Jose, CA',
+                               zip_code=94102, office=3))
+        self.session.flush()
+        house_id = self.session.query(House.id).order_by(House.id.desc()).first()[0]
+        self.session.add(Listing(house_id=house_id, seller_id=1, listing_date=datetime(2022, 12, 1), listing_agent_id=1,
+                                 listing_office_id=3, listing_price=100000, listing_state='AVAILABLE'))
+        self.session.commit()
+        insert_data.ingest_sales([{'buyer_id': 1, 'sale_price': 100000, 'sell_date': datetime(2023, 1, 20),
+                                   'agent_id': 1, 'house_id': house_id}], session=self.session)
+        self.assertEqual(cache.get(('top_offices', january.start, january.end, 1)), (False, None))
+        self.assertEqual(cache.get(('top_offices', february.start, february.end, 1)), (True, [('san jose', 856739)]))
+        self.assertEqual(reports.top_offices(self.session, january, 1), [('san jose', 8427962)])
+
+        # the on-disk tier is shared by the caches of the same database, and expires with the time to live
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'cache.db')
+            report_cache.ReportCache(path=path, namespace='test').put(('report',), january, [(1, 2)])
+            self.assertEqual(report_cache.ReportCache(path=path, namespace='test').get(('report',)), (True, [(1, 2)]))
+            self.assertEqual(report_cache.ReportCache(path=path, namespace='other').get(('report',)), (False, None))
+            report_cache.ReportCache(path=path, namespace='test').invalidate([date(2023, 1, 31)])
+            self.assertEqual(report_cache.ReportCache(path=path, namespace='test').get(('report',)), (False, None))
+            report_cache.ReportCache(ttl=-1, path=path, namespace='test').put(('report',), january, [(1, 2)])
+            self.assertEqual(report_cache.ReportCache(path=path, namespace='test').get(('report',)), (False, None))
+
+            # an invalidation by another process is seen from memory too, and the other periods stay cached
+            first, other = [report_cache.ReportCache(path=path, namespace='test', sync_interval=0) for _ in range(2)]
+            first.put(('report',), january, [(1, 2)])
+            first.put(('other report',), february, [(3, 4)])
+            self.assertEqual(first.get(('report',)), (True, [(1, 2)]))
+            other.invalidate([date(2023, 1, 31)])
+            self.assertEqual(first.get(('report',)), (False, None))
+            self.assertEqual(first.get(('other report',)), (True, [(3, 4)]))
+
+            # a report computed while its period was invalidated is not stored
+            token = first.token()
+            other.invalidate([date(2023, 1, 31)])
+            first.put(('report',), january, [(1, 2)], token)
+            self.assertEqual(first.get(('report',)), (False, None))
+        token = cache.token()
+        cache.invalidate([date(2023, 1, 31)])
+        cache.put(('report',), january, [(1, 2)], token)
+        self.assertEqual(cache.get(('report',)), (False, None))
+
+    def test_generate(self):
+        sizes = generate.generate(self.engine, scale=60, seed=3, chunk_size=25)
+        self.assertEqual(sizes['sales'], 60)
+        self.assertEqual(self.session.query(Sale).count(), 60)
+        self.assertEqual(self.session.query(House).count(), sizes['houses_in_estate'])
+        self.assertEqual(self.session.query(Listing).filter(Listing.listing_state == 'SOLD').count(), 60)
+        self.assertEqual(summary.total_sale(self.session), self.session.query(func.sum(Sale.sale_price)).scalar())
+        year, month = self.session.query(func.strftime('%Y', Sale.sell_date), func.strftime('%m', Sale.sell_date)).first()
+        self.assertTrue(reports.top_offices(self.session, Period.month(int(year), int(month))))
+        self.assertRaises(ValueError, generate.generate, self.engine, 60)
+
+        # the same scale, seed and chunk size give the same data, whatever the number of workers
+        with tempfile.TemporaryDirectory() as folder:
+            other = db.make_engine('sqlite:///' + os.path.join(folder, 'generated.db'))
+            generate.generate(other, scale=60, seed=3, workers=2, chunk_size=25)
+            query = select(Sale.id, Sale.house_id, Sale.buyer_id, Sale.sale_price, Sale.sell_date, Sale.agent_id).order_by(Sale.id)
+            with other.connect() as connection:
+                self.assertEqual(connection.execute(query).all(), self.session.execute(query).all())
+                self.assertEqual(connection.execute(select(Customer.emailAddress).order_by(Customer.id)).all(),
+                                 self.session.execute(select(Customer.emailAddress).order_by(Customer.id)).all())
+            other.dispose()
+
+    def test_bench(self):
+        result = bench.suite(scales=[100], runs=2, startup_runs=0)
+        measures = result['scales']['100']
+        self.assertEqual(sorted(measures['reports']), sorted(bench.REPORTS))
+        self.assertLessEqual(measures['reports']['top_offices']['query']['p50_ms'],
+                             measures['reports']['top_offices']['query']['p99_ms'])
+        self.assertGreater(measures['ingestion']['chunked_rows_per_s'], 0)
+        self.assertEqual(bench.compare(result, result), [])
+
+        slower = {'scales': {'100': {'reports': {'top_offices': {'query': {'p50_ms': 10.0, 'p99_ms': 10.01}}},
+                                     'ingestion': {'chunked_rows_per_s': 500.0}}}}
+        baseline = {'scales': {'100': {'reports': {'top_offices': {'query': {'p50_ms': 5.0, 'p99_ms': 10.0}}},
+                                       'ingestion': {'chunked_rows_per_s': 1000.0}}}}
+        regressions = bench.compare(slower, baseline, threshold=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('scales.100.reports.top_offices.query.p50_ms'))
+        self.assertEqual(bench.compare(baseline, slower), [])
+
+    def test_instrumentation(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        instrumentation.reset()
+        instrumentation.enable(self.engine, slow_ms=0)
+        self.addCleanup(instrumentation.disable, self.engine)
+        with self.assertLogs('database.slow_queries', 'WARNING') as logs:
+            reports.top_offices(self.session, Period.month(2023, 1))
+        self.assertIn('Query plan', logs.output[0])
+        self.assertIn('USING', logs.output[0])
+
+        instrumentation.enable(self.engine, slow_ms=None)
+        insert_data.ingest_sales([{'buyer_id': 1, 'sale_price': 100000, 'sell_date': datetime(2023, 3, 1),
+                                   'agent_id': 1, 'house_id': 1}], session=self.session)
+        metrics = instrumentation.snapshot()
+        self.assertEqual(metrics['labels']['top_offices']['calls'], 1)
+        self.assertEqual(metrics['labels']['ingest_sales']['calls'], 1)
+        self.assertEqual(metrics['labels']['ingest_sales']['commits'], 1)
+        [select_sales] = [entry for entry in metrics['statements']
+                          if entry['label'] == 'top_offices' and 'FROM office_monthly_sales' in entry['statement']]
+        self.assertEqual(select_sales['count'], sum(select_sales['buckets'].values()))
+        text = instrumentation.exposition()
+        self.assertIn('db_label_commits_total{label="ingest_sales"} 1', text)
+        self.assertIn('le="+Inf"', text)
+
+    @unittest.skipIf(columnar.numpy is None, 'NumPy is not installed')
+    def test_analytics(self):
+        self._check_analytics(columnar.numpy.ndarray)
+
+    def test_analytics_without_numpy(self):
+        with mock.patch.object(columnar, 'numpy', None), mock.patch.object(analytics, 'numpy', None):
+            self._check_analytics(array.array)
+
+    def _check_analytics(self, array_type):
+        self.assertEqual(insert_data.seed(self.session), [])
+        commissions.run_commission_job(self.session)
+        columns = columnar.load(self.engine, chunk_size=3)
+        self.assertEqual(len(columns['sale_id']), self.session.query(Sale).count())
+        self.assertIsInstance(columns['sale_price'], array_type)
+        january = Period.month(2023, 1)
+        office_names = dict(self.session.query(Office.id, Office.office_name).all())
+        self.assertEqual([(office_names[office], total) for office, total in analytics.office_totals(columns, january, 5)],
+                         [tuple(row) for row in reports.top_offices(self.session, january, 5)])
+        self.assertEqual(analytics.agent_commissions(columns, january),
+                         [tuple(row) for row in reports.agent_commissions(self.session, january)])
+        self.assertEqual(analytics.avg_days_on_market(columns, january), reports.avg_days_on_market(self.session, january))
+        self.assertEqual(analytics.avg_sale_price(columns, january), reports.avg_sale_price(self.session, january))
+        self.assertEqual(analytics.zip_averages(columns, january, 1), [tuple(reports.top_zip_codes(self.session, january, 1)[0])])
+        self.assertEqual(analytics.agent_totals(columns, Period.year(2023), 1)[0][1],
+                         reports.top_agents(self.session, Period.year(2023), 1)[0].amount_sold)
+        self.assertIsNone(analytics.avg_sale_price(columns, Period.month(2022, 1)))
+
+        tiers = commissions.load_tiers(self.session)
+        self.assertEqual(list(analytics.commissions_for(columns['sale_price'], tiers)), list(columns['agent_commissions']))
+        by_tier = analytics.commission_tiers(columns, tiers)
+        self.assertEqual(sum(count for _, _, count, _ in by_tier), len(columns['sale_id']))
+        self.assertEqual(sum(total for _, _, _, total in by_tier), sum(columns['agent_commissions']))
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertEqual(columnar.export(folder, self.engine, chunk_size=4), len(columns['sale_id']))
+            exported = columnar.concatenate(columnar.read_export(folder, ['sale_id', 'sale_price']))
+        self.assertEqual(list(exported['sale_price']), list(columns['sale_price']))
+        self.assertIsInstance(exported['sale_price'], array_type)
+        self.assertEqual(list(exported), ['sale_id', 'sale_price'])
+
+    def test_runner(self):
+        self.assertEqual(len(runner.periods((2022, 11), (2023, 2))), 4)
+        self.assertEqual(runner.periods((2022, 11), (2023, 2), 'quarter'), [Period.quarter(2022, 4), Period.quarter(2023, 1)])
+        with tempfile.TemporaryDirectory() as folder:
+            url = 'sqlite:///' + os.path.join(folder, 'runner.db')
+            other = db.make_engine(url)
+            generate.generate(other, scale=300, seed=5)
+            with sessionmaker(bind=other)() as session:
+                commissions.run_commission_job(session)
+                expected = reports.top_offices(session, Period.month(2021, 5), 5)
+                offices = [office_id for office_id, in session.query(Office.id)]
+                office_id = max(offices, key=lambda office_id: reports.office_sales(
+                    session, Period.month(2021, 5), office_id).sale_count)
+                office = reports.office_sales(session, Period.month(2021, 5), office_id)
+                self.assertGreater(office.sale_count, 0)
+            other.dispose()
+
+            tasks = runner.report_tasks(runner.periods((2021, 1), (2021, 12)), offices=offices)
+            self.assertEqual(len(tasks), 12 * (len(runner.REPORTS) + len(offices)))
+            output = os.path.join(folder, 'close.json')
+            key = runner.task_key('top_offices', Period.month(2021, 5))
+            results = runner.run(url, tasks, output, workers=2)
+            self.assertEqual(len(results), len(tasks))
+            self.assertEqual(results[key], [list(row) for row in expected])
+            self.assertEqual(results[runner.task_key('office_sales', Period.month(2021, 5), office_id)], list(office))
+
+            # a run that stopped resumes from its checkpoint, even with a line cut in the middle
+            checkpoint = json.dumps({'parameters': {'url': url, 'limit': 5}}) + '\n' + json.dumps(
+                {'task': key, 'result': 'from the checkpoint'}) + '\n{"task": "top_of'
+            with open(output + '.partial', 'w') as file:
+                file.write(checkpoint)
+            resumed = runner.run(url, tasks, output, workers=2, threads=True)
+            self.assertEqual(resumed[key], 'from the checkpoint')
+            self.assertEqual({name: value for name, value in resumed.items() if name != key},
+                             {name: value for name, value in results.items() if name != key})
+            self.assertFalse(os.path.exists(output + '.partial'))
+            with open(output) as file:
+                self.assertEqual(list(json.load(file)), list(resumed))
+
+            # the checkpoint of a run with another limit is not resumed
+            with open(output + '.partial', 'w') as file:
+                file.write(checkpoint)
+            self.assertEqual(runner.run(url, tasks, output, workers=2, threads=True, limit=5)[key], 'from the checkpoint')
+            with open(output + '.partial', 'w') as file:
+                file.write(checkpoint)
+            self.assertEqual(runner.run(url, tasks, output, workers=2, threads=True, limit=3)[key], results[key][:3])
+
+    def test_async_api(self):
+        async def scenario(url):
+            engine = db.make_async_engine(url)
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            sessions = async_api.sessionmaker(engine)
+            async with sessions() as session:
+                self.assertEqual(await session.run_sync(insert_data.seed), [])
+            results = await async_api.run_reports(sessions, 2023, 1)
+            async with sessions() as session:
+                with self.assertRaises(ValueError):
+                    await async_api.update_sales_info(session, {'buyer_id': 1, 'sale_price': 100000, 'agent_id': 1,
+                                                                'sell_date': datetime(2023, 1, 2), 'house_id': 99})
+            await engine.dispose()
+            return results
+
+        with tempfile.TemporaryDirectory() as folder:
+            results = asyncio.run(scenario('sqlite:///' + os.path.join(folder, 'async.db')))
+        self.assertEqual(results['top offices'][0], ('san jose', 8327962))
+        self.assertEqual(results['agent commissions'], [(1, 115897), (2, 149194), (3, 73118), (4, 183291), (6, 149828)])
+        self.assertEqual(results['average days on the market'], 250)
+        self.assertEqual(results['top zip codes'][0], (94111, 4582273.0))
+
+        throughput = bench.concurrency(scale=100, requests=4, concurrency=2)
+        self.assertGreater(throughput['sync_requests_per_s'], 0)
+        self.assertGreater(throughput['async_requests_per_s'], 0)
+
+    def test_search(self):
+        generate.generate(self.engine, scale=200, seed=1, chunk_size=100)
+        filters = {'min_bedrooms': 2, 'max_price': 300000000}
+        expected = self.session.execute(
+            select(Listing.id).join(House, House.id == Listing.house_id).where(
+                Listing.listing_state == 'AVAILABLE', House.no_of_bedrooms >= 2, Listing.listing_price <= 300000000)
+            .order_by(Listing.listing_price.desc(), Listing.id.desc())).scalars().all()
+        self.assertTrue(expected)
+        found, cursor = [], None
+        while True:
+            rows, cursor = search.search_listings(self.session, **filters, sort='price_desc', after=cursor, limit=7)
+            found.extend(row.id for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(found, expected)
+
+        # the pages walk the partial indexes of the listings for sale, and stop when they are full
+        plan = explain_query_plan(search.search_statement(**filters, after=(100000, 1)), self.engine)
+        self.assertIn('USING INDEX ix_listings_available_price', plan[0])
+        plan = explain_query_plan(search.search_statement(sort='newest'), self.engine)
+        self.assertEqual(plan[0], 'SCAN listings USING INDEX ix_listings_available_date')
+        self.assertRaises(ValueError, search.search_listings, self.session, sort='cheapest')
+
+    def test_streaming(self):
+        self.assertEqual(insert_data.seed(self.session), [])
+        customers = self.session.query(Customer).order_by(Customer.id).all()
+        self.assertEqual(list(streaming.rows(self.session, Customer, page_size=3)), customers)
+        self.assertEqual(list(streaming.rows(self.session, Sale, ['id', 'sale_price'], page_size=4,
+                                             condition=Sale.sale_price > 1000000)),
+                         self.session.execute(select(Sale.id, Sale.sale_price).where(Sale.sale_price > 1000000)
+                                              .order_by(Sale.id)).all())
+        # the rollups have composite primary keys
+        rollup = [(row.year, row.month, row.office_id) for row in
+                  self.session.query(OfficeMonthlySales).order_by('year', 'month', 'office_id')]
+        self.assertEqual(list(streaming.rows(self.session, OfficeMonthlySales, ['year', 'month', 'office_id'], 2)), rollup)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'sales.jsonl')
+            with open(path, 'w') as file:
+                self.assertEqual(streaming.export(self.session, 'sales', file, 'jsonl', page_size=5),
+                                 self.session.query(Sale).count())
+            with open(path) as file:
+                first = json.loads(file.readline())
+            self.assertEqual(first['id'], 1)
+            self.assertEqual(first['sell_date'], self.session.get(Sale, 1).sell_date.isoformat())
+
+    def test_config(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'database.ini')
+            with open(path, 'w') as file:
+                file.write('[database]\nurl = sqlite:///other.db\npool_size = 2\npool_pre_ping = false\n')
+            config = db.load_config(path, environ={'DATABASE_POOL_SIZE': '8'})
+        self.assertEqual(config['url'], 'sqlite:///other.db')
+        self.assertEqual(config['pool_size'], 8)
+        self.assertIs(config['pool_pre_ping'], False)
+        self.assertEqual(config['sqlite_journal_mode'], 'WAL')
+
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+
     # def tearDown(self):
     #     self.session.close()
     #     self.engine.dispose()
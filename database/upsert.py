@@ -0,0 +1,45 @@
+from sqlalchemy import true
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def upsert(session, model, key, source, increment=(), replace=()):
+    '''
+    Inserts rows into the table of a model, updating the rows whose key already exists instead
+    (INSERT ... ON CONFLICT DO UPDATE).
+
+    Args:
+        session (Session): The session the statement is executed in, as part of its transaction.
+        model (Base): The model of the table.
+        key (List[str]): The columns of the primary key or unique constraint the rows conflict on.
+        source (List[dict] | Select): The rows to insert, either as a list of dicts (executed with
+            executemany) or as a select statement whose column labels are the column names.
+        increment (List[str]): The columns that are added to the existing values on conflict.
+        replace (List[str]): The columns that overwrite the existing values on conflict.
+    '''
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        statement = sqlite.insert(model)
+    elif dialect == 'postgresql':
+        statement = postgresql.insert(model)
+    else:
+        raise NotImplementedError(f"upsert is not supported on {dialect}.")
+
+    table = model.__table__
+    if isinstance(source, list):
+        if not source:
+            return
+        parameters = source
+    else:
+        if source.whereclause is None:
+            # without a WHERE clause SQLite would parse ON CONFLICT as the join constraint of the select
+            source = source.where(true())
+        statement = statement.from_select([column.key for column in source.selected_columns], source)
+        parameters = None
+
+    updates = {column: table.c[column] + statement.excluded[column] for column in increment}
+    updates.update({column: statement.excluded[column] for column in replace})
+    if updates:
+        statement = statement.on_conflict_do_update(index_elements=key, set_=updates)
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=key)
+    session.execute(statement, parameters)